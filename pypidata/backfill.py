@@ -0,0 +1,49 @@
+import re
+import time
+
+from .db import add_info_columns, connect, drop_info_columns, info_columns, shard_paths
+
+# Maintain the generated columns over json_data.info (see db.py).
+#
+# Adding a virtual column is instant, but building its index decodes the
+# info of every page, once. After that, queries filtering on the column
+# (e.g. WHERE info_requires_python = '>=3.8') use the index.
+
+NAME_RE = re.compile(r"[a-z_][a-z0-9_]*")
+
+def parse_column(spec):
+    name, sep, path = spec.partition("=")
+    if not sep or not NAME_RE.fullmatch(name) or not path.startswith("$"):
+        raise SystemExit(f"Invalid column {spec!r}: expected NAME=$.json.path")
+    return name, path
+
+def main(args):
+    db = connect(args.database, "raw", "bulk", shards=False)
+    with db:
+        for spec in args.add or []:
+            name, path = parse_column(spec)
+            db.execute(
+                "INSERT INTO info_columns (name, path) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET path = excluded.path",
+                (name, path)
+            )
+        for name in args.drop or []:
+            db.execute("DELETE FROM info_columns WHERE name = ?", (name,))
+    columns = info_columns(db)
+
+    if args.list:
+        for name, path in columns.items():
+            print(f"{name} = json_extract(info, '{path}')")
+        return
+
+    db.close()
+
+    # A changed path needs the column recreating
+    changed = {name for name, _ in (parse_column(spec) for spec in args.add or [])}
+    keep = {name: path for name, path in columns.items() if name not in changed}
+    for path in [args.database] + shard_paths(args.database):
+        start = time.perf_counter()
+        with connect(path, shards=False) as db:
+            drop_info_columns(db, "main", keep)
+            add_info_columns(db, "main", columns)
+        db.close()
+        print(f"Indexed {', '.join(columns)} in {path} in {time.perf_counter() - start:.1f}s")
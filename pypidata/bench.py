@@ -0,0 +1,81 @@
+import json
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from . import metrics
+from .build_package import write_package
+from .db import connect, shard_schemas
+from .meta import SELECT as WHEELS_SQL
+from .raw import out_of_date_sql
+
+# Timings of the hot paths, against any raw and metadata databases, but
+# meant for those written by "synth". Each case is run --repeat times,
+# and reported as the minimum, median and maximum, which also go to
+# --metrics-report as the bench_seconds histogram.
+
+INFO_FILTER_SQL = "SELECT count(*) FROM json_data WHERE info_requires_python = ?"
+
+def out_of_date(args, sample):
+    with connect(args.raw, "raw", "read", readonly=True) as db:
+        db.execute(out_of_date_sql("json", shard_schemas(db))).fetchall()
+
+def get_wheels(args, sample):
+    with connect(args.meta, "meta", "read", attach={"pkg": (args.raw, "raw")}, readonly=True) as db:
+        db.execute(WHEELS_SQL).fetchall()
+
+def info_filter(args, sample):
+    with connect(args.raw, "raw", "read", readonly=True) as db:
+        db.execute(INFO_FILTER_SQL, (">=3.9",)).fetchone()
+
+def transform(args, sample):
+    # Decoding the pages and writing the package rows, which is pkg's
+    # work, into a scratch database that is rolled back
+    with tempfile.TemporaryDirectory() as tmp:
+        db = connect(Path(tmp) / "PackageData.db", "pkg", "bulk", attach={"raw": (args.raw, "raw")})
+        try:
+            db.execute("BEGIN")
+            for name in sample:
+                serial, info, releases = db.execute(
+                    "SELECT serial, info, releases FROM json_data WHERE name = ?", (name,)
+                ).fetchone()
+                write_package(db, name, dict(
+                    info=json.loads(info),
+                    releases=json.loads(releases),
+                    last_serial=serial,
+                ))
+            db.rollback()
+        finally:
+            db.close()
+
+CASES = {
+    "out_of_date": out_of_date,
+    "get_wheels": get_wheels,
+    "info_filter": info_filter,
+    "transform": transform,
+}
+
+def sample_names(args):
+    with connect(args.raw, "raw", "read", readonly=True) as db:
+        # An even spread through the projects, the same every run
+        names = [name for name, in db.execute("SELECT name FROM packages ORDER BY name")]
+    step = max(1, len(names) // args.sample)
+    return names[::step][:args.sample]
+
+def main(args):
+    sample = sample_names(args)
+
+    for case in args.case or list(CASES):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            CASES[case](args, sample)
+            elapsed = time.perf_counter() - start
+            metrics.observe("bench_seconds", elapsed, case=case)
+            times.append(elapsed)
+        print(
+            f"{case:12} min {min(times):8.3f}s"
+            f"  median {statistics.median(times):8.3f}s"
+            f"  max {max(times):8.3f}s"
+        )
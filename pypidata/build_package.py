@@ -1,3 +1,11 @@
+import json
+
+from .classifiers import write_terms
+from .graph import write_requirements
+from .requires_python import write_specifiers
+from .versions import parse, sort_key
+from .wheel_tags import write_file_tags
+
 PROJECTS_SQL = """\
 INSERT INTO projects (
     name,
@@ -164,6 +172,108 @@ ON CONFLICT (file_id, digest_type) DO UPDATE SET
     digest = :digest
 """
 
+RELEASES_SQL = """\
+INSERT INTO releases (
+    project_name,
+    version,
+    sort_key,
+    is_prerelease,
+    is_postrelease,
+    is_devrelease,
+    yanked,
+    file_count,
+    upload_time
+)
+VALUES (
+    :project_name,
+    :version,
+    :sort_key,
+    :is_prerelease,
+    :is_postrelease,
+    :is_devrelease,
+    :yanked,
+    :file_count,
+    :upload_time
+)
+"""
+
+LATEST_RELEASES_SQL = """\
+INSERT INTO latest_releases (
+    project_name,
+    latest_version,
+    latest_stable_version
+)
+VALUES (
+    :project_name,
+    :latest_version,
+    :latest_stable_version
+)
+ON CONFLICT (project_name) DO UPDATE SET
+    latest_version = :latest_version,
+    latest_stable_version = :latest_stable_version
+"""
+
+PROJECT_STATS_SQL = """\
+INSERT INTO project_stats (
+    project_name,
+    file_count,
+    total_size,
+    release_count,
+    sdist_count,
+    wheel_count,
+    first_upload,
+    last_upload
+)
+VALUES (
+    :project_name,
+    :file_count,
+    :total_size,
+    :release_count,
+    :sdist_count,
+    :wheel_count,
+    :first_upload,
+    :last_upload
+)
+ON CONFLICT (project_name) DO UPDATE SET
+    file_count = excluded.file_count,
+    total_size = excluded.total_size,
+    release_count = excluded.release_count,
+    sdist_count = excluded.sdist_count,
+    wheel_count = excluded.wheel_count,
+    first_upload = excluded.first_upload,
+    last_upload = excluded.last_upload
+"""
+
+def write_releases(db, name, releases):
+    db.execute("DELETE FROM releases WHERE project_name = ?", (name,))
+    rows = []
+    for rel, files in releases.items():
+        v = parse(rel)
+        upload_times = [f["upload_time_iso_8601"] for f in files if f.get("upload_time_iso_8601")]
+        rows.append(dict(
+            project_name = name,
+            version = rel,
+            sort_key = sort_key(rel),
+            is_prerelease = v.is_prerelease if v else None,
+            is_postrelease = v.is_postrelease if v else None,
+            is_devrelease = v.is_devrelease if v else None,
+            # A release is yanked when all of its files are
+            yanked = bool(files) and all(f.get("yanked") for f in files),
+            file_count = len(files),
+            upload_time = min(upload_times) if upload_times else None,
+        ))
+    db.executemany(RELEASES_SQL, rows)
+
+    candidates = [r for r in rows if r["sort_key"] is not None and not r["yanked"]]
+    stable = [r for r in candidates if not r["is_prerelease"]]
+    latest = max(candidates, key=lambda r: r["sort_key"], default=None)
+    latest_stable = max(stable, key=lambda r: r["sort_key"], default=None)
+    db.execute(LATEST_RELEASES_SQL, dict(
+        project_name = name,
+        latest_version = latest and latest["version"],
+        latest_stable_version = latest_stable and latest_stable["version"],
+    ))
+
 def write_package(db, name, package_data):
     info = package_data["info"]
 
@@ -209,12 +319,16 @@ def write_package(db, name, package_data):
     )
 
     db.execute(PROJECTS_SQL, projects_args)
+    project_id, = db.execute("SELECT project_id FROM projects WHERE name = ?", (name,)).fetchone()
+    write_terms(db, project_id, info["classifiers"], info.get("keywords"))
+    write_requirements(db, name, info["requires_dist"])
 
     urls = info.get("project_urls")
     if urls:
         db.executemany(PROJECT_URLS_SQL, [dict(project_name=name, url_type=k, url=v) for k, v in urls.items()])
 
     releases = package_data["releases"]
+    write_releases(db, name, releases)
     for rel in releases:
         for file in releases[rel]:
             project_files_args = dict(
@@ -235,8 +349,59 @@ def write_package(db, name, package_data):
                 yanked_reason = file.get("yanked_reason"),
             )
             db.execute(PROJECT_FILES_SQL, project_files_args)
-            cursor = db.execute("SELECT file_id FROM project_files WHERE project_name = ? AND version = ?", (name, rel))
+            cursor = db.execute("SELECT file_id FROM project_files WHERE project_name = ? AND filename = ?", (name, file.get("filename")))
             file_id, = cursor.fetchone()
+            write_file_tags(db, file_id, file.get("filename") or "")
             digests = file.get("digests")
             if digests:
-                db.executemany(FILE_DIGESTS_SQL, [dict(file_id=file_id, digest_type=k, digest=v) for k, v in digests.items()])
\ No newline at end of file
+                db.executemany(FILE_DIGESTS_SQL, [dict(file_id=file_id, digest_type=k, digest=v) for k, v in digests.items()])
+    write_specifiers(db, {info.get("requires_python")} | {
+        file.get("requires_python") for files in releases.values() for file in files
+    })
+    db.execute(PROJECT_STATS_SQL, project_stats(name, releases))
+
+def delete_package(db, name):
+    # Remove a project deleted from PyPI, whose page raw now stores as
+    # missing. Deleting the projects row also removes it from the search
+    # index (see the projects_fts triggers).
+    row = db.execute("SELECT project_id FROM projects WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        return
+    file_ids = "SELECT file_id FROM project_files WHERE project_name = ?"
+    db.execute(f"DELETE FROM file_tags WHERE file_id IN ({file_ids})", (name,))
+    db.execute(f"DELETE FROM file_digests WHERE file_id IN ({file_ids})", (name,))
+    db.execute("DELETE FROM project_terms WHERE project_id = ?", row)
+    for table in ("project_files", "releases", "latest_releases", "project_urls", "requirements", "project_stats"):
+        db.execute(f"DELETE FROM {table} WHERE project_name = ?", (name,))
+    db.execute("DELETE FROM projects WHERE name = ?", (name,))
+
+def project_stats(name, releases):
+    # The totals are over the files of the current page, as files removed
+    # upstream are never deleted from project_files
+    files = [file for files in releases.values() for file in files]
+    uploads = [f["upload_time_iso_8601"] for f in files if f.get("upload_time_iso_8601")]
+    return dict(
+        project_name = name,
+        file_count = len(files),
+        total_size = sum(f.get("size") or 0 for f in files),
+        release_count = len(releases),
+        sdist_count = sum(f.get("packagetype") == "sdist" for f in files),
+        wheel_count = sum(f.get("packagetype") == "bdist_wheel" for f in files),
+        first_upload = min(uploads, default=None),
+        last_upload = max(uploads, default=None),
+    )
+
+def rebuild_stats(db, schemas):
+    # From the JSON pages in the raw database, whose shard schemas are
+    # schemas, for the projects in the package database
+    db.execute("DELETE FROM project_stats")
+    count = 0
+    for schema in schemas:
+        rows = db.execute(f"""\
+            SELECT j.name, j.releases FROM {schema}.json_data j
+            WHERE j.name IN (SELECT name FROM projects)
+        """)
+        for name, releases in rows:
+            db.execute(PROJECT_STATS_SQL, project_stats(name, json.loads(releases)))
+            count += 1
+    return count
@@ -0,0 +1,282 @@
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+import xmlrpc.client
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from . import metrics
+from .db import connect
+
+# An on-disk cache of the responses from PyPI, for reprocessing runs.
+#
+# Response bodies are stored by their sha256, under objects/, and an index
+# database maps each request (method, URL and anything else that selects
+# the response, such as the Accept header or an XML-RPC request body) to
+# its body, headers and validators. Entries are evicted least recently
+# used first once the bodies exceed max_size.
+#
+# Online, pages with an ETag are revalidated with If-None-Match, wheels
+# (which never change) are served straight from the cache, and XML-RPC
+# calls are always made, and recorded. With replay, nothing goes to the
+# network, and a request that isn't in the cache raises CacheMiss.
+#
+# Enabled with the global --cache-dir option, which sets active.
+
+active = None
+
+class CacheMiss(Exception):
+    pass
+
+class Entry(NamedTuple):
+    key: str
+    url: str
+    status: int
+    headers: dict
+    etag: Optional[str]
+    digest: str
+    size: int
+
+# Headers that describe the encoding of the body on the wire, which the
+# cache doesn't keep
+HOP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+class HTTPCache:
+    def __init__(self, directory, max_size, replay=False):
+        self.directory = Path(directory)
+        self.objects = self.directory / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.db = connect(self.directory / "index.db", "cache", check_same_thread=False)
+        self.total, = self.db.execute(
+            "SELECT coalesce(sum(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)"
+        ).fetchone()
+
+    @staticmethod
+    def key(method, url, vary=b""):
+        if isinstance(vary, str):
+            vary = vary.encode("utf-8")
+        return hashlib.sha256(f"{method} {url}\n".encode("utf-8") + vary).hexdigest()
+
+    def path(self, digest):
+        return self.objects / digest[:2] / digest
+
+    def lookup(self, key):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT key, url, status, headers, etag, digest, size FROM entries WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row is None or not self.path(row[5]).exists():
+                # A body that is gone (removed by hand, or by a crash) is
+                # a miss, and the entry is dropped
+                if row is not None:
+                    self.drop(key, row[5], row[6])
+                metrics.inc("cache_lookups", result="miss")
+                return None
+            with self.db:
+                self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        metrics.inc("cache_lookups", result="hit")
+        key, url, status, headers, etag, digest, size = row
+        return Entry(key, url, status, json.loads(headers), etag, digest, size)
+
+    def load(self, entry):
+        return self.path(entry.digest).read_bytes()
+
+    # The entry is recorded before its body is written. Once it is, the
+    # body is referenced, so evicting another entry with the same body
+    # can't remove it, and a body removed before then is written again.
+
+    def store(self, key, url, status, headers, body, etag=None):
+        digest = hashlib.sha256(body).hexdigest()
+        self.record(key, url, status, headers, etag, digest, len(body))
+        path = self.path(digest)
+        if not path.exists():
+            self.write_object(path, lambda f: f.write(body))
+
+    def store_file(self, key, url, f, digest, size):
+        # f is positioned at the start of a body whose sha256 is known
+        self.record(key, url, 200, {}, None, digest, size)
+        path = self.path(digest)
+        if not path.exists():
+            self.write_object(path, lambda out: shutil.copyfileobj(f, out, 1 << 20))
+
+    def write_object(self, path, write):
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+
+    def record(self, key, url, status, headers, etag, digest, size):
+        headers = {k: v for k, v in headers.items() if k.lower() not in HOP_HEADERS}
+        with self.lock:
+            old = self.db.execute("SELECT digest, size FROM entries WHERE key = ?", (key,)).fetchone()
+            if not self.referenced(digest):
+                self.total += size
+            with self.db:
+                self.db.execute("""\
+                    INSERT INTO entries (key, url, status, headers, etag, digest, size, last_used)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET
+                        url = excluded.url,
+                        status = excluded.status,
+                        headers = excluded.headers,
+                        etag = excluded.etag,
+                        digest = excluded.digest,
+                        size = excluded.size,
+                        last_used = excluded.last_used
+                    """,
+                    (key, url, status, json.dumps(headers), etag, digest, size, time.time())
+                )
+            if old and old[0] != digest:
+                self.release(*old)
+            metrics.inc("cache_stores")
+            self.evict()
+        metrics.gauge("cache_bytes", self.total)
+
+    def referenced(self, digest):
+        row = self.db.execute("SELECT size FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone()
+        return row is not None
+
+    def release(self, digest, size):
+        # Remove a body no longer referenced by any entry
+        if self.referenced(digest):
+            return
+        self.total -= size
+        try:
+            self.path(digest).unlink()
+        except FileNotFoundError:
+            pass
+
+    def drop(self, key, digest, size):
+        # Called with the lock held
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self.release(digest, size)
+
+    def evict(self):
+        while self.total > self.max_size:
+            rows = self.db.execute(
+                "SELECT key, digest, size FROM entries ORDER BY last_used LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for key, digest, size in rows:
+                self.drop(key, digest, size)
+                metrics.inc("cache_evictions")
+                if self.total <= self.max_size:
+                    break
+
+    # raw: pages fetched with httpx
+
+    def response(self, entry, status=None):
+        import httpx
+        return httpx.Response(
+            status or entry.status,
+            headers=entry.headers,
+            content=self.load(entry) if status is None else b"",
+            request=httpx.Request("GET", entry.url),
+        )
+
+    async def fetch_async(self, url, headers, fetch):
+        # fetch(headers) makes the request, returning an httpx.Response (or
+        # None if it failed)
+        headers = dict(headers or {})
+        caller_etag = headers.pop("If-None-Match", None)
+        key = self.key("GET", url, headers.get("Accept", ""))
+        entry = await asyncio.to_thread(self.lookup, key)
+        if self.replay:
+            if entry is None:
+                raise CacheMiss(url)
+            if caller_etag and caller_etag == entry.etag:
+                return self.response(entry, 304)
+            return await asyncio.to_thread(self.response, entry)
+
+        etag = entry.etag if entry is not None and entry.etag else caller_etag
+        if etag:
+            headers["If-None-Match"] = etag
+        response = await fetch(headers)
+        if response is None:
+            return None
+        if response.status_code == 304 and entry is not None and etag == entry.etag:
+            metrics.inc("cache_revalidated")
+            if caller_etag == entry.etag:
+                return response
+            return await asyncio.to_thread(self.response, entry)
+        if response.status_code == 200:
+            await asyncio.to_thread(
+                self.store, key, url, 200, dict(response.headers), response.content,
+                response.headers.get("ETag"),
+            )
+        return response
+
+    # meta: wheels, which are immutable
+
+    def fetch_file(self, url, data, fetch, expected=None):
+        # fetch() downloads url into the file data, returning its sha256.
+        # With the expected sha256, only a body that matches it is served
+        # from or stored in the cache, so a bad download is fetched again.
+        key = self.key("GET", url)
+        entry = self.lookup(key)
+        if entry is not None and expected is not None and entry.digest != expected:
+            entry = None
+        if entry is not None:
+            with open(self.path(entry.digest), "rb") as f:
+                shutil.copyfileobj(f, data, 1 << 20)
+            return entry.digest
+        if self.replay:
+            raise CacheMiss(url)
+        digest = fetch()
+        if expected is None or digest == expected:
+            size = data.tell()
+            data.seek(0)
+            self.store_file(key, url, data, digest, size)
+        return digest
+
+    # chg: XML-RPC calls
+
+    def transport(self, uri):
+        return CachingTransport(self, uri)
+
+class CachingTransport(xmlrpc.client.SafeTransport):
+    # PyPI's XML-RPC API is only served over HTTPS
+    def __init__(self, cache, uri):
+        super().__init__()
+        self.cache = cache
+        self.uri = uri
+        self.body = None
+
+    def request(self, host, handler, request_body, verbose=False):
+        key = self.cache.key("POST", self.uri, request_body)
+        if self.cache.replay:
+            entry = self.cache.lookup(key)
+            if entry is None:
+                raise CacheMiss(self.uri)
+            self.verbose = verbose
+            return super().parse_response(io.BytesIO(self.cache.load(entry)))
+        result = super().request(host, handler, request_body, verbose)
+        self.cache.store(key, self.uri, 200, {}, self.body)
+        return result
+
+    def parse_response(self, response):
+        body = response.read()
+        if response.getheader("Content-Encoding", "") == "gzip":
+            body = gzip.decompress(body)
+        self.body = body
+        return super().parse_response(io.BytesIO(body))
+
+def configure(args):
+    global active
+    if args.replay and not args.cache_dir:
+        raise SystemExit("--replay needs a --cache-dir to replay from")
+    if args.cache_dir:
+        active = HTTPCache(args.cache_dir, args.http_cache_size * 2**20, args.replay)
@@ -1,10 +1,12 @@
 import re
-import sqlite3
 import time
 import xmlrpc.client
 
 from rich.progress import Progress
 
+from . import cache, metrics
+from .db import connect
+
 
 def normalize(name):
     return re.sub(r"[-_.]+", "-", name).lower()
@@ -15,8 +17,16 @@ def params(batch):
 
 class RateLimitedServerProxy(xmlrpc.client.ServerProxy):
     # See https://github.com/pypi/warehouse/issues/8753
+    def __init__(self, uri, **kw):
+        if cache.active is not None:
+            kw.setdefault("transport", cache.active.transport(uri))
+        super().__init__(uri, **kw)
+
     def __getattr__(self, name):
-        time.sleep(1)
+        # Replayed calls don't reach PyPI, so aren't rate limited
+        if cache.active is None or not cache.active.replay:
+            with metrics.timer("rate_limit_seconds"):
+                time.sleep(1)
         return super(RateLimitedServerProxy, self).__getattr__(name)
 
 def main(args):
@@ -24,21 +34,32 @@ def main(args):
     pypi = RateLimitedServerProxy(URL)
 
     # Open the database
-    conn = sqlite3.connect(args.database)
+    conn = connect(args.database, "raw", "bulk")
 
     since, = conn.execute("SELECT max(serial) FROM changelog").fetchone()
     with Progress() as progress:
-        latest = pypi.changelog_last_serial()
+        # Looking up a method waits out the rate limit, which isn't part of
+        # the call's latency
+        changelog_last_serial = pypi.changelog_last_serial
+        with metrics.timer("xmlrpc_seconds", method="changelog_last_serial"):
+            latest = changelog_last_serial()
         print(f"Fetching {since}..{latest}")
         start = since
         task = progress.add_task("Getting changelog...", total=latest-start)
         while True:
             progress.update(task, completed=since-start)
-            next_batch = pypi.changelog_since_serial(since)
+            try:
+                changelog_since_serial = pypi.changelog_since_serial
+                with metrics.timer("xmlrpc_seconds", method="changelog_since_serial"):
+                    next_batch = changelog_since_serial(since)
+            except cache.CacheMiss:
+                print(f"Replayed the cached changelog up to {since}")
+                break
             if not next_batch:
                 break
+            metrics.inc("changelog_entries", len(next_batch))
             next_since = max(c[-1] for c in next_batch)
-            with conn:
+            with metrics.timer("commit_seconds"), conn:
                 conn.executemany("""\
                         INSERT INTO changelog (
                             name, display_name, version, timestamp, action, serial
@@ -47,6 +68,8 @@ def main(args):
                     """,
                     params(next_batch)
                 )
+            metrics.inc("rows_written", len(next_batch), table="changelog")
+            metrics.gauge("queue_depth", latest - next_since, stage="changelog")
             since = next_since
 
     conn.close()
@@ -0,0 +1,88 @@
+import re
+
+# Classifiers and keyword tokens are interned into the terms table, and
+# each term has a posting list of project ids in project_terms. Filters
+# on several terms are answered by intersecting the postings, starting
+# from the rarest term.
+
+CLASSIFIER = "classifier"
+KEYWORD = "keyword"
+
+INTERN_SQL = """\
+INSERT INTO terms (kind, term)
+VALUES (?, ?)
+ON CONFLICT (kind, term) DO NOTHING
+"""
+
+def keyword_tokens(keywords):
+    if not keywords:
+        return []
+    return sorted({k for k in re.split(r"[,;\s]+", keywords.lower()) if k})
+
+def intern(db, kind, terms):
+    db.executemany(INTERN_SQL, [(kind, t) for t in terms])
+    return [
+        term_id for term_id, in (
+            db.execute("SELECT term_id FROM terms WHERE kind = ? AND term = ?", (kind, t)).fetchone()
+            for t in terms
+        )
+    ]
+
+def write_terms(db, project_id, classifiers, keywords):
+    db.execute("DELETE FROM project_terms WHERE project_id = ?", (project_id,))
+    ids = intern(db, CLASSIFIER, classifiers or []) + intern(db, KEYWORD, keyword_tokens(keywords))
+    db.executemany(
+        "INSERT OR IGNORE INTO project_terms (term_id, project_id) VALUES (?, ?)",
+        [(term_id, project_id) for term_id in ids]
+    )
+
+def rebuild_terms(db):
+    db.execute("DELETE FROM project_terms")
+    rows = db.execute("SELECT project_id, classifiers, keywords FROM projects").fetchall()
+    for project_id, classifiers, keywords in rows:
+        classifiers = classifiers.split("\n") if classifiers else []
+        write_terms(db, project_id, classifiers, keywords)
+    db.execute("DELETE FROM terms WHERE term_id NOT IN (SELECT term_id FROM project_terms)")
+    return len(rows)
+
+def term_ids(db, classifiers=(), keywords=()):
+    # Returns None if any of the terms is unknown, as then nothing can match
+    wanted = [(CLASSIFIER, c) for c in classifiers]
+    wanted += [(KEYWORD, k) for k in keyword_tokens(" ".join(keywords))]
+    ids = []
+    for kind, term in wanted:
+        row = db.execute("SELECT term_id FROM terms WHERE kind = ? AND term = ?", (kind, term)).fetchone()
+        if row is None:
+            return None
+        ids.append(row[0])
+    return ids
+
+def intersect_sql(db, ids, select):
+    # Drive the join from the shortest posting list, probing the others
+    # through the primary key.
+    sizes = {
+        term_id: db.execute("SELECT count(*) FROM project_terms WHERE term_id = ?", (term_id,)).fetchone()[0]
+        for term_id in ids
+    }
+    ids = sorted(set(ids), key=sizes.get)
+    joins = "".join(
+        f" JOIN project_terms t{i} ON t{i}.term_id = ? AND t{i}.project_id = t0.project_id"
+        for i in range(1, len(ids))
+    )
+    SQL = f"SELECT {select} FROM project_terms t0{joins} WHERE t0.term_id = ? ORDER BY t0.project_id"
+    return SQL, ids[1:] + ids[:1]
+
+def project_ids(db, classifiers=(), keywords=()):
+    ids = term_ids(db, classifiers, keywords)
+    if not ids:
+        return []
+    SQL, params = intersect_sql(db, ids, "t0.project_id")
+    return [pid for pid, in db.execute(SQL, params)]
+
+def projects_with(db, classifiers=(), keywords=()):
+    # Names of the projects that have all of the given classifiers and keywords
+    ids = term_ids(db, classifiers, keywords)
+    if not ids:
+        return []
+    SQL, params = intersect_sql(db, ids, "(SELECT name FROM projects WHERE project_id = t0.project_id)")
+    return [name for name, in db.execute(SQL, params)]
@@ -1,5 +1,316 @@
 import json
+import sqlite3
+import threading
 import zlib
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+# Opening databases.
+#
+# All commands open their databases through connect() (or connect_async()
+# for aiosqlite), which creates or migrates the schema the first time a
+# database is opened in a process, and applies the pragmas for the kind of
+# work the connection does.
+#
+# Each schema is a list of migrations, applied in order. The version a
+# database has reached is recorded in its schema_version table. A
+# migration is either a file in the sql directory, or a function taking
+# the connection. Only ever append to these lists.
+
+SQL_DIR = Path(__file__).parent / "sql"
+
+def table_exists(db, name, schema="main"):
+    row = db.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row is not None
+
+def raw_base(db):
+    had_queue = table_exists(db, "pkg_dirty")
+    db.executescript((SQL_DIR / "raw_schema.sql").read_text(encoding="utf-8"))
+    if not had_queue:
+        # The dirty queue triggers weren't there when the existing pages
+        # were stored, so queue all of them for pkg.
+        with db:
+            db.execute("INSERT OR IGNORE INTO pkg_dirty (name, serial) SELECT name, serial FROM json_data")
+
+def pkg_base(db):
+    had_index = table_exists(db, "projects_fts")
+    db.executescript((SQL_DIR / "pkg_schema.sql").read_text(encoding="utf-8"))
+    if not had_index:
+        # Existing projects need adding to a newly created search index
+        with db:
+            db.execute("INSERT INTO projects_fts (projects_fts) VALUES ('rebuild')")
+
+def pkg_project_ids(db):
+    # Give projects an explicit INTEGER PRIMARY KEY, project_id, for other
+    # tables to refer to, as VACUUM may renumber the implicit rowids of a
+    # table with a TEXT primary key. The ids are the existing rowids, so
+    # references to those stay valid.
+    columns = [name for _, name, *_ in db.execute("PRAGMA table_info(projects)")]
+    if "project_id" in columns:
+        return
+    types = dict((name, type) for _, name, type, *_ in db.execute("PRAGMA table_info(projects)"))
+    definitions = ["project_id INTEGER PRIMARY KEY", "name TEXT NOT NULL UNIQUE"] + [
+        f"{name} {types[name]}" for name in columns if name != "name"
+    ]
+    names = ", ".join(columns)
+    # Dropping the table drops its triggers, which the schema recreates
+    db.executescript(f"""\
+        BEGIN;
+        CREATE TABLE projects_new ({", ".join(definitions)});
+        INSERT INTO projects_new (project_id, {names}) SELECT rowid, {names} FROM projects;
+        DROP TABLE projects;
+        ALTER TABLE projects_new RENAME TO projects;
+        {(SQL_DIR / "pkg_schema.sql").read_text(encoding="utf-8")}
+        COMMIT;
+    """)
+
+def pkg_fts_project_id(db):
+    # Point the search index at project_id, rather than the implicit rowid.
+    # The content_rowid of an FTS5 table is fixed when it is created, so
+    # the index and its triggers are recreated, and the index rebuilt.
+    sql, = db.execute("SELECT sql FROM sqlite_master WHERE name = 'projects_fts'").fetchone()
+    if "content_rowid='project_id'" in sql:
+        return
+    db.executescript(f"""\
+        BEGIN;
+        DROP TRIGGER projects_fts_insert;
+        DROP TRIGGER projects_fts_delete;
+        DROP TRIGGER projects_fts_update;
+        DROP TABLE projects_fts;
+        {(SQL_DIR / "pkg_schema.sql").read_text(encoding="utf-8")}
+        INSERT INTO projects_fts (projects_fts) VALUES ('rebuild');
+        COMMIT;
+    """)
+
+# Generated columns over hot paths in json_data.info, so that queries can
+# filter on them through an index, rather than decoding the JSON of every
+# row. The info_columns table of the raw database lists them; "backfill"
+# adds or drops columns and builds the indexes, in every shard.
+
+def generated_columns(db, schema, table):
+    rows = db.execute(f"PRAGMA {schema}.table_xinfo({table})")
+    return [row[1] for row in rows if row[6] in (2, 3)]
+
+def stored_columns(db, schema, table):
+    # The columns that can be inserted into
+    rows = db.execute(f"PRAGMA {schema}.table_xinfo({table})")
+    return [row[1] for row in rows if row[6] == 0]
+
+def info_columns(db, schema="main"):
+    return dict(db.execute(f"SELECT name, path FROM {schema}.info_columns ORDER BY name"))
+
+def add_info_columns(db, schema, columns, index=True):
+    existing = set(generated_columns(db, schema, "json_data"))
+    for name, path in columns.items():
+        if name not in existing:
+            path = path.replace("'", "''")
+            db.execute(f"""\
+                ALTER TABLE {schema}.json_data ADD COLUMN {name}
+                GENERATED ALWAYS AS (json_extract(info, '{path}')) VIRTUAL
+            """)
+        if index:
+            db.execute(f"CREATE INDEX IF NOT EXISTS {schema}.json_data_{name} ON json_data ({name})")
+
+def drop_info_columns(db, schema, columns):
+    # Drop the generated columns that aren't in columns
+    for name in generated_columns(db, schema, "json_data"):
+        if name not in columns:
+            db.execute(f"DROP INDEX IF EXISTS {schema}.json_data_{name}")
+            db.execute(f"ALTER TABLE {schema}.json_data DROP COLUMN {name}")
+
+def raw_info_columns(db):
+    db.executescript((SQL_DIR / "raw_info_columns.sql").read_text(encoding="utf-8"))
+    # Building the indexes means decoding every page, so existing
+    # databases are left for "backfill" to index.
+    empty, = db.execute("SELECT NOT EXISTS (SELECT 1 FROM json_data)").fetchone()
+    with db:
+        add_info_columns(db, "main", info_columns(db), index=empty)
+
+MIGRATIONS = {
+    "raw": [
+        raw_base, "raw_shards.sql", "raw_replication.sql", raw_info_columns,
+        "json_history.sql", "raw_history.sql", "raw_fetch_queue.sql",
+    ],
+    "raw_shard": ["raw_shard_schema.sql", "json_history.sql"],
+    "pkg": [
+        pkg_base, "pkg_wheel_tags.sql", "pkg_project_stats.sql", "pkg_python_intervals.sql",
+        pkg_project_ids, pkg_fts_project_id,
+    ],
+    "meta": ["meta_schema.sql", "meta_snapshots.sql"],
+    "cache": ["cache_schema.sql"],
+}
+
+# Pragmas for each workload. Journal mode is persistent, so it is only set
+# by connections that can write.
+PROFILES = {
+    # Long running updates, writing many rows
+    "bulk": dict(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size=-262144,
+        mmap_size=1 << 30,
+        temp_store="MEMORY",
+    ),
+    # Read-mostly access, such as queries and the mirror server
+    "read": dict(
+        cache_size=-65536,
+        mmap_size=1 << 32,
+        temp_store="MEMORY",
+    ),
+    "default": dict(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size=-65536,
+        mmap_size=1 << 28,
+        temp_store="MEMORY",
+    ),
+}
+
+SCHEMA_VERSION_SQL = """\
+CREATE TABLE IF NOT EXISTS schema_version (
+    schema TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    applied TEXT
+)
+"""
+
+migrated = set()
+migrate_lock = threading.Lock()
+
+def migrate(path, schema):
+    key = (str(Path(path).resolve()), schema)
+    with migrate_lock:
+        if key in migrated:
+            return
+        db = sqlite3.connect(path, timeout=60)
+        try:
+            db.execute(SCHEMA_VERSION_SQL)
+            row = db.execute("SELECT version FROM schema_version WHERE schema = ?", (schema,)).fetchone()
+            version = row[0] if row else 0
+            for n, step in enumerate(MIGRATIONS[schema][version:], start=version + 1):
+                if callable(step):
+                    step(db)
+                else:
+                    db.executescript((SQL_DIR / step).read_text(encoding="utf-8"))
+                with db:
+                    db.execute("""\
+                        INSERT INTO schema_version (schema, version, applied)
+                        VALUES (?, ?, datetime('now'))
+                        ON CONFLICT (schema) DO UPDATE SET
+                            version = excluded.version,
+                            applied = excluded.applied
+                        """,
+                        (schema, n)
+                    )
+        finally:
+            db.close()
+        migrated.add(key)
+
+def ro_uri(path):
+    return Path(path).resolve().as_uri() + "?mode=ro"
+
+def pragmas(profile, readonly=False, alias=None):
+    prefix = f"{alias}." if alias else ""
+    for name, value in PROFILES[profile].items():
+        if readonly and name in ("journal_mode", "synchronous"):
+            continue
+        # temp_store is per connection, not per database
+        if name == "temp_store":
+            yield f"PRAGMA {name} = {value}"
+        else:
+            yield f"PRAGMA {prefix}{name} = {value}"
+
+# A raw database can keep its pages in separate shard files (see
+# shard.py), listed in its shards table. Connections to it attach the
+# shards, as <alias>_shard<n>, and get temporary views of the sharded
+# tables that UNION ALL the shards. Temporary objects are found before
+# those of attached databases, so queries that name these tables
+# unqualified work whether or not the database is sharded. The views are
+# read-only, so writes must go to the shard's own table.
+SHARDED_TABLES = ("json_data", "simple_data", "pkg_dirty", "json_history")
+
+def shard_paths(path):
+    if not Path(path).exists():
+        return []
+    conn = sqlite3.connect(ro_uri(path), uri=True)
+    try:
+        if not table_exists(conn, "shards"):
+            return []
+        rows = conn.execute("SELECT path FROM shards ORDER BY shard").fetchall()
+    finally:
+        conn.close()
+    return [Path(path).parent / p for p, in rows]
+
+def shard_schemas(db, alias="main"):
+    # The schemas that hold the sharded tables of a raw database
+    names = [name for _, name, _ in db.execute("PRAGMA database_list")]
+    return select_shards(names, alias)
+
+async def shard_schemas_async(db, alias="main"):
+    async with db.execute("PRAGMA database_list") as cursor:
+        names = [name async for _, name, _ in cursor]
+    return select_shards(names, alias)
+
+def select_shards(names, alias):
+    return [name for name in names if name.startswith(f"{alias}_shard")] or [alias]
+
+def attach_shards(path, alias="main", profile="default", readonly=False):
+    # The statements (with their parameters) to attach the shards of the
+    # raw database at path
+    paths = shard_paths(path)
+    aliases = [f"{alias}_shard{i}" for i in range(len(paths))]
+    for shard_alias, shard_path in zip(aliases, paths):
+        if not readonly:
+            migrate(shard_path, "raw_shard")
+        yield f"ATTACH DATABASE ? AS {shard_alias}", (ro_uri(shard_path) if readonly else str(shard_path),)
+        for pragma in pragmas(profile, readonly, shard_alias):
+            yield pragma, ()
+    if not aliases:
+        return
+    for table in SHARDED_TABLES:
+        union = " UNION ALL ".join(f"SELECT * FROM {a}.{table}" for a in aliases)
+        yield f"CREATE TEMP VIEW {table} AS {union}", ()
+
+def connect(path, schema=None, profile="default", attach=None, readonly=False, timeout=60, shards=True, **kw):
+    # attach maps an alias to (path, schema) for each database to attach.
+    # shards=False leaves out the shards and views of a sharded raw
+    # database, for changes to the main file's schema (SQLite rechecks the
+    # main file's triggers against the views).
+    if schema and not readonly:
+        migrate(path, schema)
+    if readonly:
+        conn = sqlite3.connect(ro_uri(path), uri=True, timeout=timeout, **kw)
+    else:
+        conn = sqlite3.connect(path, timeout=timeout, **kw)
+    for pragma in pragmas(profile, readonly):
+        conn.execute(pragma)
+    if shards:
+        for sql, params in attach_shards(path, "main", profile, readonly):
+            conn.execute(sql, params)
+    for alias, (attach_path, attach_schema) in (attach or {}).items():
+        if attach_schema and not readonly:
+            migrate(attach_path, attach_schema)
+        conn.execute(f"ATTACH DATABASE ? AS {alias}", (ro_uri(attach_path) if readonly else attach_path,))
+        for pragma in pragmas(profile, readonly, alias):
+            conn.execute(pragma)
+        for sql, params in attach_shards(attach_path, alias, profile, readonly):
+            conn.execute(sql, params)
+    # Set last, as it also prevents creating the temporary views
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+@asynccontextmanager
+async def connect_async(path, schema=None, profile="default", timeout=60):
+    import aiosqlite
+    if schema:
+        migrate(path, schema)
+    async with aiosqlite.connect(path, timeout=timeout) as db:
+        for pragma in pragmas(profile):
+            await db.execute(pragma)
+        for sql, params in attach_shards(path, "main", profile):
+            await db.execute(sql, params)
+        yield db
 
 def add_json(db, name, serial, data):
     # TODO: What if data is None, or serial is 0?
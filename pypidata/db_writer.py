@@ -1,11 +1,14 @@
 import queue
-import sqlite3
 import threading
 
+from . import metrics
+from .db import connect
+
 
 class DBWriter(threading.Thread):
-    def __init__(self, dbname, SQL):
+    def __init__(self, dbname, SQL, schema=None):
         self.dbname = dbname
+        self.schema = schema
         self.SQL = SQL
         self.queue = queue.Queue()
         self.stop_event = threading.Event()
@@ -32,11 +35,16 @@ class DBWriter(threading.Thread):
                 pass
 
     def run(self):
-        with sqlite3.connect(self.dbname) as conn:
+        with connect(self.dbname, self.schema, "bulk") as conn:
             while not self.stop_event.is_set():
                 records = list(self.pending())
                 #print(f"Inserting {len(records)} rows")
                 if records:
-                    conn.executemany(self.SQL, records)
-                    conn.commit()
+                    # The depth the queue had built up to, recorded only
+                    # when there is work, as this loop spins when idle
+                    metrics.gauge("queue_depth", len(records), stage="db_writer")
+                    with metrics.timer("commit_seconds"):
+                        conn.executemany(self.SQL, records)
+                        conn.commit()
                     self.inserted += len(records)
+                    metrics.inc("rows_written", len(records), table="db_writer")
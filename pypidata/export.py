@@ -0,0 +1,243 @@
+import json
+import sys
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from .db import connect
+
+# Each export is a query, the arrow type of each column it returns, the
+# columns to dictionary encode, and the column holding the serial used
+# for incremental exports. Queries run against the package database with
+# the raw database attached as "raw".
+
+EXPORTS = {
+    "projects": dict(
+        SQL="""\
+            SELECT
+                name, display_name, last_serial, author, author_email,
+                classifiers, description_content_type, home_page, keywords,
+                license, requires_dist, requires_python, summary, version,
+                yanked, yanked_reason
+            FROM projects
+            WHERE last_serial > ?
+        """,
+        columns=[
+            ("name", "string"),
+            ("display_name", "string"),
+            ("last_serial", "int64"),
+            ("author", "string"),
+            ("author_email", "string"),
+            ("classifiers", "string"),
+            ("description_content_type", "string"),
+            ("home_page", "string"),
+            ("keywords", "string"),
+            ("license", "string"),
+            ("requires_dist", "string"),
+            ("requires_python", "string"),
+            ("summary", "string"),
+            ("version", "string"),
+            ("yanked", "bool_"),
+            ("yanked_reason", "string"),
+        ],
+        dictionary={"description_content_type", "license", "requires_python"},
+        serial="last_serial",
+    ),
+    "project_files": dict(
+        SQL="""\
+            SELECT
+                f.project_name, p.last_serial, f.version, f.filename,
+                f.packagetype, f.python_version, f.requires_python, f.size,
+                f.upload_time_iso_8601, f.url, f.yanked
+            FROM project_files f JOIN projects p ON p.name = f.project_name
+            WHERE p.last_serial > ?
+        """,
+        columns=[
+            ("project_name", "string"),
+            ("last_serial", "int64"),
+            ("version", "string"),
+            ("filename", "string"),
+            ("packagetype", "string"),
+            ("python_version", "string"),
+            ("requires_python", "string"),
+            ("size", "int64"),
+            ("upload_time_iso_8601", "string"),
+            ("url", "string"),
+            ("yanked", "bool_"),
+        ],
+        dictionary={"project_name", "version", "packagetype", "python_version", "requires_python"},
+        serial="last_serial",
+    ),
+    "changelog": dict(
+        SQL="""\
+            SELECT name, display_name, serial, version, timestamp, action
+            FROM raw.changelog
+            WHERE serial > ?
+        """,
+        columns=[
+            ("name", "string"),
+            ("display_name", "string"),
+            ("serial", "int64"),
+            ("version", "string"),
+            ("timestamp", "int64"),
+            ("action", "string"),
+        ],
+        dictionary={"name", "display_name", "action"},
+        serial="serial",
+    ),
+    # The releases JSON from the raw data, flattened to one row per file
+    "releases": dict(
+        SQL="""\
+            SELECT
+                j.name,
+                j.serial,
+                r.key,
+                json_extract(f.value, '$.filename'),
+                json_extract(f.value, '$.packagetype'),
+                json_extract(f.value, '$.python_version'),
+                json_extract(f.value, '$.requires_python'),
+                json_extract(f.value, '$.size'),
+                json_extract(f.value, '$.upload_time_iso_8601'),
+                json_extract(f.value, '$.digests.sha256'),
+                json_extract(f.value, '$.yanked')
+            FROM json_data j, json_each(j.releases) r, json_each(r.value) f
+            WHERE j.serial > ?
+        """,
+        columns=[
+            ("project_name", "string"),
+            ("serial", "int64"),
+            ("version", "string"),
+            ("filename", "string"),
+            ("packagetype", "string"),
+            ("python_version", "string"),
+            ("requires_python", "string"),
+            ("size", "int64"),
+            ("upload_time_iso_8601", "string"),
+            ("sha256", "string"),
+            ("yanked", "bool_"),
+        ],
+        dictionary={"project_name", "version", "packagetype", "python_version", "requires_python"},
+        serial="serial",
+    ),
+}
+
+STATE_FILE = "export_state.json"
+
+def arrow_schema(spec):
+    fields = []
+    for name, typ in spec["columns"]:
+        t = getattr(pa, typ)()
+        if name in spec["dictionary"]:
+            t = pa.dictionary(pa.int32(), t)
+        fields.append(pa.field(name, t))
+    return pa.schema(fields)
+
+def record_batch(spec, schema, rows):
+    arrays = []
+    for i, (name, typ) in enumerate(spec["columns"]):
+        values = [row[i] for row in rows]
+        if typ == "bool_":
+            values = [None if v is None else bool(v) for v in values]
+        arr = pa.array(values, type=getattr(pa, typ)())
+        if name in spec["dictionary"]:
+            arr = arr.dictionary_encode()
+        arrays.append(arr)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+class ParquetOutput:
+    suffix = ".parquet"
+    def __init__(self, path, spec, schema):
+        self.writer = pq.ParquetWriter(
+            path,
+            schema,
+            compression="zstd",
+            use_dictionary=sorted(spec["dictionary"]),
+        )
+    def write(self, batch):
+        self.writer.write_batch(batch)
+    def close(self):
+        self.writer.close()
+
+class ArrowOutput:
+    # The IPC stream format allows each batch to carry its own dictionaries
+    suffix = ".arrows"
+    def __init__(self, path, spec, schema):
+        self.sink = pa.OSFile(str(path), "wb")
+        self.writer = pa.ipc.new_stream(self.sink, schema)
+    def write(self, batch):
+        self.writer.write_batch(batch)
+    def close(self):
+        self.writer.close()
+        self.sink.close()
+
+FORMATS = {
+    "parquet": ParquetOutput,
+    "arrow": ArrowOutput,
+}
+
+def export_table(db, table, since, output, fmt, chunk_size):
+    spec = EXPORTS[table]
+    schema = arrow_schema(spec)
+    serial_col = [name for name, _ in spec["columns"]].index(spec["serial"])
+
+    # Each run writes a new partition, holding the rows changed since the
+    # previous export.
+    part = output / table / f"since={since}"
+    part.mkdir(parents=True, exist_ok=True)
+    cls = FORMATS[fmt]
+    path = part / f"part-0{cls.suffix}"
+    writer = cls(path, spec, schema)
+
+    rows_written = 0
+    high_water = since
+    try:
+        cursor = db.execute(spec["SQL"], (since,))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            writer.write(record_batch(spec, schema, rows))
+            rows_written += len(rows)
+            high_water = max(high_water, max(row[serial_col] for row in rows))
+    finally:
+        writer.close()
+
+    if rows_written == 0:
+        path.unlink()
+        try:
+            part.rmdir()
+        except OSError:
+            pass
+    return rows_written, high_water
+
+def main(args):
+    if pa is None:
+        sys.exit("The export command requires pyarrow (pip install pyarrow)")
+
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    state_file = output / STATE_FILE
+    if state_file.exists():
+        state = json.loads(state_file.read_text(encoding="utf-8"))
+    else:
+        state = {}
+
+    tables = args.table or list(EXPORTS)
+    with connect(args.database, "pkg", "read", attach={"raw": (args.raw, "raw")}, readonly=True) as db:
+        for table in tables:
+            if args.since is not None:
+                since = args.since
+            elif args.full:
+                since = 0
+            else:
+                since = state.get(table, 0)
+            print(f"Exporting {table} changed since serial {since}")
+            rows, high_water = export_table(db, table, since, output, args.format, args.chunk_size)
+            print(f"Exported {rows} rows from {table} (up to serial {high_water})")
+            state[table] = max(high_water, state.get(table, 0))
+            state_file.write_text(json.dumps(state, indent=4), encoding="utf-8")
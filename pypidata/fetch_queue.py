@@ -0,0 +1,174 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from collections import Counter
+
+from rich.progress import Progress
+
+from . import metrics
+from .db import connect_async
+from .raw import fetch_page, get_out_of_date, store_page
+from .shard import writers
+
+# A shared queue of pages to fetch, for running raw on several processes
+# or machines at once.
+#
+# "raw --enqueue" updates the package list and puts the out of date pages
+# in the fetch_queue table of the raw database. Each "raw --worker" then
+# claims a batch at a time, by giving the rows its name and a lease that
+# expires after --lease seconds, fetches them and stores the pages, and
+# removes the rows it completed. Claims are made in an IMMEDIATE
+# transaction, so two workers never claim the same page. The rows of a
+# worker that dies are claimed again once their lease expires, and pages
+# that fail to fetch go back in the queue, until they have been tried
+# --max-attempts times.
+#
+# A batch is fetched into memory, and only written once all of it has
+# arrived, in short transactions, so that a worker doesn't hold the write
+# lock while it waits on the network. Before writing, the worker renews
+# its lease on the pages it still holds, and drops those whose lease ran
+# out and that another worker has claimed since.
+#
+# Workers need the database on a filesystem where SQLite's locking works,
+# so on several machines a shared filesystem that supports it.
+
+ENQUEUE_SQL = """\
+INSERT INTO fetch_queue (page_type, name, serial, etag)
+VALUES (?, ?, ?, ?)
+ON CONFLICT (page_type, name) DO UPDATE SET
+    serial = max(serial, excluded.serial),
+    etag = excluded.etag,
+    attempts = 0
+"""
+
+CLAIM_SQL = """\
+UPDATE fetch_queue
+SET worker = :worker, lease_expires = :expires, attempts = attempts + 1
+WHERE rowid IN (
+    SELECT rowid FROM fetch_queue
+    WHERE page_type IN (SELECT value FROM json_each(:types))
+    AND (lease_expires IS NULL OR lease_expires < :now)
+    AND attempts < :max_attempts
+    ORDER BY name
+    LIMIT :limit
+)
+RETURNING page_type, name, serial, etag
+"""
+
+# The rows of the batch the worker still holds, with their lease renewed
+# for the time it takes to write them
+RENEW_SQL = """\
+UPDATE fetch_queue SET lease_expires = :expires
+WHERE worker = :worker
+AND (page_type, name) IN (SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(:pages))
+RETURNING page_type, name
+"""
+
+# Only the rows the worker still holds, and that haven't been queued
+# again for a newer serial while they were being fetched
+DONE_SQL = """\
+DELETE FROM fetch_queue
+WHERE page_type = ? AND name = ? AND worker = ? AND serial <= ?
+"""
+
+RETRY_SQL = """\
+UPDATE fetch_queue SET worker = NULL, lease_expires = NULL
+WHERE page_type = ? AND name = ? AND worker = ?
+"""
+
+# Results of update_page that complete a page
+DONE = {"Fetched", "Not modified"}
+
+async def enqueue(db, args):
+    for page_type in args.type:
+        packages = await get_out_of_date(db, page_type, args)
+        await db.executemany(ENQUEUE_SQL, [
+            (page_type, name, serial, etag) for name, serial, etag in packages
+        ])
+        print(f"Queued {len(packages)} {page_type} pages")
+    await db.commit()
+    await status(db, args)
+
+async def status(db, args):
+    async with db.execute("""\
+        SELECT
+            page_type,
+            count(*),
+            count(*) FILTER (WHERE lease_expires > ?),
+            count(*) FILTER (WHERE attempts >= ?)
+        FROM fetch_queue GROUP BY page_type
+        """,
+        (time.time(), args.max_attempts)
+    ) as cursor:
+        async for page_type, total, leased, failed in cursor:
+            print(f"{page_type}: {total} queued, {leased} being fetched, {failed} given up on")
+
+async def immediate(db, sql, params):
+    # Run sql in an IMMEDIATE transaction, returning its rows
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        async with db.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+    return rows
+
+async def claim(db, worker, args):
+    now = time.time()
+    return await immediate(db, CLAIM_SQL, dict(
+        worker=worker,
+        expires=now + args.lease,
+        types=json.dumps(args.type),
+        now=now,
+        max_attempts=args.max_attempts,
+        limit=args.claim_size,
+    ))
+
+async def renew(db, worker, batch, args):
+    # The (page_type, name) pairs of the batch that the worker still holds
+    rows = await immediate(db, RENEW_SQL, dict(
+        worker=worker,
+        expires=time.time() + args.lease,
+        pages=json.dumps([[page_type, name] for page_type, name, _, _ in batch]),
+    ))
+    return set(rows)
+
+async def work(args):
+    worker = args.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    results = Counter()
+    async with connect_async(args.database, "raw", "bulk") as db, writers(db, args.database) as shards:
+        sem = asyncio.Semaphore(100)
+        with Progress() as progress:
+            task = progress.add_task(f"Worker {worker}", total=None)
+            while True:
+                batch = await claim(db, worker, args)
+                if not batch:
+                    break
+                fetched = await asyncio.gather(*[
+                    fetch_page(sem, page_type, name, serial, etag)
+                    for page_type, name, serial, etag in batch
+                ])
+                held = await renew(db, worker, batch, args)
+                for (page_type, name, _, _), (result, page) in zip(batch, fetched):
+                    if page is not None and (page_type, name) in held:
+                        await store_page(shards.for_name(name), page_type, page, shards.history)
+                with metrics.timer("commit_seconds"):
+                    await shards.commit()
+                for (page_type, name, serial, _), (result, _) in zip(batch, fetched):
+                    if (page_type, name) not in held:
+                        result = "Lease lost"
+                    metrics.inc("pages", type=page_type, result=result)
+                    results[page_type, result] += 1
+                    if result in DONE:
+                        await db.execute(DONE_SQL, (page_type, name, worker, serial))
+                    elif result != "Lease lost":
+                        await db.execute(RETRY_SQL, (page_type, name, worker))
+                await db.commit()
+                progress.update(task, advance=len(batch))
+        for (page_type, result), count in results.most_common():
+            print(page_type, result, count)
+        await status(db, args)
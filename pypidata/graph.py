@@ -0,0 +1,309 @@
+import re
+from array import array
+from collections import deque
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+from packaging.markers import Marker, default_environment
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
+
+from .db import connect
+
+# The dependency graph of PyPI projects.
+#
+# write_package parses each project's requires_dist once, into rows of
+# the requirements table. Graph loads those rows into compressed sparse
+# row (CSR) arrays: for node i, its outgoing edge ids are
+# fwd_edges[fwd_offsets[i]:fwd_offsets[i+1]], and similarly for incoming
+# edges with rev_offsets/rev_edges. Projects rewritten since the graph was
+# loaded are held in an overlay, which replaces their forward edges, until
+# the next compact().
+
+REQUIREMENTS_SQL = """\
+INSERT INTO requirements (
+    project_name,
+    requirement_name,
+    specifier,
+    extras,
+    extra,
+    marker
+)
+VALUES (
+    :project_name,
+    :requirement_name,
+    :specifier,
+    :extras,
+    :extra,
+    :marker
+)
+"""
+
+EXTRA_RE = re.compile(r"""\bextra\s*==\s*['"]([^'"]*)['"]""")
+
+class Edge(NamedTuple):
+    source: str
+    target: str
+    specifier: str
+    extras: tuple
+    extra: Optional[str]
+    marker: Optional[str]
+
+def parse_requirements(name, requires_dist):
+    edges = []
+    for line in requires_dist or []:
+        try:
+            req = Requirement(line)
+        except InvalidRequirement:
+            continue
+        marker = str(req.marker) if req.marker else None
+        # One edge for each extra the marker mentions, as in
+        # 'extra == "a" or extra == "b"', or a single one for none
+        extras = dict.fromkeys(canonicalize_name(e) for e in EXTRA_RE.findall(marker or ""))
+        for extra in extras or [None]:
+            edges.append(Edge(
+                source = name,
+                target = canonicalize_name(req.name),
+                specifier = str(req.specifier),
+                extras = tuple(sorted(canonicalize_name(e) for e in req.extras)),
+                extra = extra,
+                marker = marker,
+            ))
+    return edges
+
+def write_requirements(db, name, requires_dist):
+    db.execute("DELETE FROM requirements WHERE project_name = ?", (name,))
+    db.executemany(REQUIREMENTS_SQL, [
+        dict(e._asdict(), project_name=e.source, requirement_name=e.target, extras=",".join(e.extras) or None)
+        for e in parse_requirements(name, requires_dist)
+    ])
+
+def rebuild_requirements(db):
+    db.execute("DELETE FROM requirements")
+    rows = db.execute("SELECT name, requires_dist FROM projects").fetchall()
+    for name, requires_dist in rows:
+        write_requirements(db, name, requires_dist.split("\n") if requires_dist else [])
+    return len(rows)
+
+@lru_cache(maxsize=10_000)
+def marker_matches(marker, extra, environment):
+    env = default_environment()
+    env.update(environment)
+    env["extra"] = extra or ""
+    return Marker(marker).evaluate(env)
+
+class Graph:
+    def __init__(self, edges):
+        self.load(edges)
+
+    @classmethod
+    def from_db(cls, db):
+        rows = db.execute("""\
+            SELECT project_name, requirement_name, specifier, extras, extra, marker
+            FROM requirements
+        """)
+        return cls(
+            Edge(src, dst, spec, tuple(extras.split(",")) if extras else (), extra, marker)
+            for src, dst, spec, extras, extra, marker in rows
+        )
+
+    def load(self, edges):
+        strings = {}
+        def intern(s):
+            if s is None:
+                return -1
+            return strings.setdefault(s, len(strings))
+
+        nodes = {}
+        src, dst, spec, extras, extra, marker = (array("l") for _ in range(6))
+        for e in edges:
+            src.append(nodes.setdefault(e.source, len(nodes)))
+            dst.append(nodes.setdefault(e.target, len(nodes)))
+            spec.append(intern(e.specifier))
+            extras.append(intern(",".join(e.extras)))
+            extra.append(intern(e.extra))
+            marker.append(intern(e.marker))
+
+        self.names = list(nodes)
+        self.index = nodes
+        self.strings = list(strings)
+        self.edge_src, self.edge_dst = src, dst
+        self.edge_spec, self.edge_extras = spec, extras
+        self.edge_extra, self.edge_marker = extra, marker
+        self.fwd_offsets, self.fwd_edges = self.csr(src)
+        self.rev_offsets, self.rev_edges = self.csr(dst)
+        self.overlay = {}
+        self.overlay_rev = {}
+
+    def csr(self, keys):
+        # Counting sort of the edge ids by key
+        n = len(self.names)
+        offsets = array("q", bytes(8 * (n + 1)))
+        for k in keys:
+            offsets[k + 1] += 1
+        for i in range(n):
+            offsets[i + 1] += offsets[i]
+        fill = array("q", offsets)
+        edges = array("l", bytes(array("l").itemsize * len(keys)))
+        for eid, k in enumerate(keys):
+            edges[fill[k]] = eid
+            fill[k] += 1
+        return offsets, edges
+
+    def edge(self, eid):
+        s = self.strings
+        def get(i):
+            return s[i] if i >= 0 else None
+        extras = get(self.edge_extras[eid])
+        return Edge(
+            self.names[self.edge_src[eid]],
+            self.names[self.edge_dst[eid]],
+            get(self.edge_spec[eid]),
+            tuple(extras.split(",")) if extras else (),
+            get(self.edge_extra[eid]),
+            get(self.edge_marker[eid]),
+        )
+
+    def update(self, db, names):
+        # Pick up the rewritten requirements of the given projects
+        for name in names:
+            old = self.overlay.get(name)
+            if old is not None:
+                for e in old:
+                    self.overlay_rev[e.target].remove(e)
+            rows = db.execute("""\
+                SELECT project_name, requirement_name, specifier, extras, extra, marker
+                FROM requirements
+                WHERE project_name = ?
+            """, (name,))
+            edges = [
+                Edge(src, dst, spec, tuple(extras.split(",")) if extras else (), extra, marker)
+                for src, dst, spec, extras, extra, marker in rows
+            ]
+            self.overlay[name] = edges
+            for e in edges:
+                self.overlay_rev.setdefault(e.target, []).append(e)
+
+    def compact(self):
+        # Merge the overlay back into the CSR arrays
+        edges = [e for name, edges in self.overlay.items() for e in edges]
+        edges += [
+            self.edge(eid) for eid in range(len(self.edge_src))
+            if self.names[self.edge_src[eid]] not in self.overlay
+        ]
+        self.load(edges)
+
+    def out_edges(self, name):
+        if name in self.overlay:
+            return list(self.overlay[name])
+        i = self.index.get(name)
+        if i is None:
+            return []
+        return [self.edge(eid) for eid in self.fwd_edges[self.fwd_offsets[i]:self.fwd_offsets[i + 1]]]
+
+    def in_edges(self, name):
+        i = self.index.get(name)
+        edges = []
+        if i is not None:
+            for eid in self.rev_edges[self.rev_offsets[i]:self.rev_offsets[i + 1]]:
+                if self.names[self.edge_src[eid]] not in self.overlay:
+                    edges.append(self.edge(eid))
+        edges += self.overlay_rev.get(name, [])
+        return edges
+
+    @staticmethod
+    def wanted(edge, extras, environment):
+        # extras is the set of extras requested of edge.source, or None
+        # to follow every edge regardless of extras.
+        if extras is not None and edge.extra is not None and edge.extra not in extras:
+            return False
+        if environment is not None and edge.marker is not None:
+            env = tuple(sorted(environment.items()))
+            if not marker_matches(edge.marker, edge.extra, env):
+                return False
+        return True
+
+    def dependencies(self, name, extras=(), environment=None):
+        name = canonicalize_name(name)
+        if extras is not None:
+            extras = {canonicalize_name(e) for e in extras}
+        return [e for e in self.out_edges(name) if self.wanted(e, extras, environment)]
+
+    def dependents(self, name, extras=None, environment=None):
+        # By default, a project counts as a dependent even if it only
+        # needs name for one of its extras.
+        name = canonicalize_name(name)
+        if extras is not None:
+            extras = {canonicalize_name(e) for e in extras}
+        return [e for e in self.in_edges(name) if self.wanted(e, extras, environment)]
+
+    def transitive_dependencies(self, name, extras=(), environment=None):
+        # Extras requested by a requirement are followed into the
+        # dependency, so foo[bar] pulls in foo's "bar" dependencies.
+        name = canonicalize_name(name)
+        start = (name, frozenset(canonicalize_name(e) for e in extras))
+        seen = {start}
+        result = {}
+        todo = deque([start])
+        while todo:
+            node, node_extras = todo.popleft()
+            for e in self.dependencies(node, node_extras, environment):
+                result.setdefault(e.target, e)
+                nxt = (e.target, frozenset(e.extras))
+                if nxt not in seen:
+                    seen.add(nxt)
+                    todo.append(nxt)
+        result.pop(name, None)
+        return result
+
+    def transitive_dependents(self, name, extras=None, environment=None):
+        # Everything that depends, directly or indirectly, on name
+        name = canonicalize_name(name)
+        seen = {name}
+        result = {}
+        todo = deque([name])
+        while todo:
+            node = todo.popleft()
+            for e in self.dependents(node, extras, environment):
+                if e.source not in seen:
+                    seen.add(e.source)
+                    result[e.source] = e
+                    todo.append(e.source)
+        return result
+
+def environment(args):
+    env = {}
+    if args.python:
+        env["python_version"] = ".".join(args.python.split(".")[:2])
+        env["python_full_version"] = args.python if args.python.count(".") >= 2 else args.python + ".0"
+    if args.platform:
+        env["sys_platform"] = args.platform
+    return env if (env or args.markers) else None
+
+def main(args):
+    with connect(args.database, "pkg") as db:
+        if args.rebuild:
+            print("Rebuilding the requirements table...")
+            count = rebuild_requirements(db)
+            print(f"Parsed requirements for {count} projects")
+            return
+        graph = Graph.from_db(db)
+
+    env = environment(args)
+    for name in args.name:
+        if args.reverse:
+            extras = args.extra or None
+            if args.transitive:
+                edges = graph.transitive_dependents(name, extras, env).values()
+            else:
+                edges = graph.dependents(name, extras, env)
+            for e in sorted(edges, key=lambda e: e.source):
+                print(f"{e.source}: {e.target}{e.specifier}" + (f" ; {e.marker}" if e.marker else ""))
+        else:
+            extras = args.extra or ()
+            if args.transitive:
+                edges = graph.transitive_dependencies(name, extras, env).values()
+            else:
+                edges = graph.dependencies(name, extras, env)
+            for e in sorted(edges, key=lambda e: e.target):
+                print(f"{e.target}{e.specifier}" + (f" (from {e.source})" if e.source != name else ""))
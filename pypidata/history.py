@@ -0,0 +1,230 @@
+import json
+import zlib
+from typing import NamedTuple, Optional
+
+from .db import connect, shard_schemas
+
+# The history of the JSON pages.
+#
+# Once enabled (with "history --enable"), each page that raw replaces is
+# kept in json_history, in the same file as the page, as the changes that
+# turn its successor back into it: the info fields and releases that
+# differ, rather than the whole page, compressed with zlib. Every
+# keyframe_interval-th entry of a project is the whole page instead, so a
+# page is never more than that many steps from one that is stored whole.
+#
+# Reconstructing the page at a serial starts from the nearest keyframe or
+# current page after it, and undoes the changes back to the serial. Old
+# entries can be dropped freely, as nothing newer depends on them.
+
+COLUMNS = ("info", "releases", "vulnerabilities")
+
+class Settings(NamedTuple):
+    keyframe_interval: int
+    keep: Optional[int]
+    keep_days: Optional[int]
+
+def encode(obj):
+    return zlib.compress(json.dumps(obj, separators=(",", ":")).encode("utf-8"))
+
+def decode(data):
+    return json.loads(zlib.decompress(data))
+
+def diff(old, new):
+    # The changes to new that give old. Objects (info and releases) are
+    # compared key by key.
+    changes = {}
+    for col in COLUMNS:
+        o, n = old[col], new[col]
+        if o == n:
+            continue
+        if isinstance(o, dict) and isinstance(n, dict):
+            changes[col] = {
+                "set": {k: v for k, v in o.items() if k not in n or n[k] != v},
+                "del": [k for k in n if k not in o],
+            }
+        else:
+            changes[col] = {"value": o}
+    return changes
+
+def patch(new, changes):
+    old = dict(new)
+    for col, change in changes.items():
+        if "value" in change:
+            old[col] = change["value"]
+        else:
+            value = {k: v for k, v in new[col].items() if k not in change["del"]}
+            value.update(change["set"])
+            old[col] = value
+    return old
+
+def page(info, releases, vulnerabilities):
+    # The decoded columns of a json_data row, or None for a missing page
+    if info is None:
+        return None
+    return dict(
+        info=json.loads(info),
+        releases=json.loads(releases),
+        vulnerabilities=json.loads(vulnerabilities) if vulnerabilities else [],
+    )
+
+async def load_settings(db):
+    async with db.execute("SELECT keyframe_interval, keep, keep_days FROM history_settings") as cursor:
+        row = await cursor.fetchone()
+    return Settings(*row) if row else None
+
+async def record(db, settings, name, serial, info, releases, vulnerabilities):
+    # Keep the page that the new one (with the given columns) replaces.
+    # db is the connection that the new page is written through.
+    async with db.execute(
+        "SELECT serial, info, releases, vulnerabilities FROM json_data WHERE name = ?", (name,)
+    ) as cursor:
+        row = await cursor.fetchone()
+    if row is None or row[0] == serial:
+        return
+    old_serial, *old = row
+    async with db.execute("""\
+        SELECT count(*) FROM json_history
+        WHERE name = ? AND serial > coalesce(
+            (SELECT max(serial) FROM json_history WHERE name = ? AND keyframe), 0
+        )
+        """,
+        (name, name)
+    ) as cursor:
+        since_keyframe, = await cursor.fetchone()
+
+    old = page(*old)
+    new = page(info, releases, vulnerabilities)
+    # A missing page has nothing to be a change to, so the entry before it
+    # is a keyframe
+    keyframe = old is None or new is None or since_keyframe + 1 >= settings.keyframe_interval
+    data = encode(old if keyframe else diff(old, new))
+    await db.execute("""\
+        INSERT OR REPLACE INTO json_history (name, serial, keyframe, data, superseded)
+        VALUES (?, ?, ?, ?, datetime('now'))
+        """,
+        (name, old_serial, keyframe, data)
+    )
+    if settings.keep is not None or settings.keep_days is not None:
+        await db.execute(PRUNE_SQL.format(history="json_history", where="name = :name"), dict(
+            name=name, keep=settings.keep, keep_days=settings.keep_days,
+        ))
+
+PRUNE_SQL = """\
+DELETE FROM {history}
+WHERE rowid IN (
+    SELECT rowid FROM (
+        SELECT rowid, superseded,
+            row_number() OVER (PARTITION BY name ORDER BY serial DESC) n
+        FROM {history}
+        WHERE {where}
+    )
+    WHERE n > coalesce(:keep, n)
+    OR superseded < datetime('now', '-' || :keep_days || ' days')
+)
+"""
+
+def page_at(db, name, serial):
+    # The JSON page of name as it was at serial, as a dict with the
+    # serial it was fetched at, or None if there was no page (or it is
+    # from before the history was kept)
+    row = db.execute(
+        "SELECT serial, info, releases, vulnerabilities FROM json_data WHERE name = ?", (name,)
+    ).fetchone()
+    if row is None:
+        return None
+    if row[0] <= serial:
+        current = page(*row[1:])
+        return current and dict(current, serial=row[0])
+    target = db.execute(
+        "SELECT max(serial) FROM json_history WHERE name = ? AND serial <= ?", (name, serial)
+    ).fetchone()[0]
+    if target is None:
+        return None
+
+    # The changes from the target up to the first keyframe, or the current
+    # page if there isn't one
+    changes = []
+    base = page(*row[1:])
+    rows = db.execute(
+        "SELECT serial, keyframe, data FROM json_history WHERE name = ? AND serial >= ? ORDER BY serial",
+        (name, target)
+    )
+    for entry_serial, keyframe, data in rows:
+        if keyframe:
+            base = decode(data)
+            break
+        changes.append(decode(data))
+    rows.close()
+    for change in reversed(changes):
+        base = patch(base, change)
+    return base and dict(base, serial=target)
+
+def seal(db):
+    # Make each project's newest entry a keyframe, as the page it is a
+    # change to won't be kept once the history is disabled
+    sealed = 0
+    with db:
+        for schema in shard_schemas(db):
+            rows = db.execute(f"""\
+                SELECT name, max(serial), keyframe FROM {schema}.json_history GROUP BY name
+            """).fetchall()
+            for name, serial, keyframe in rows:
+                if keyframe:
+                    continue
+                old = page_at(db, name, serial)
+                db.execute(
+                    f"UPDATE {schema}.json_history SET keyframe = 1, data = ? WHERE name = ? AND serial = ?",
+                    (encode(old and {col: old[col] for col in COLUMNS}), name, serial)
+                )
+                sealed += 1
+    return sealed
+
+def prune(db, keep, keep_days):
+    deleted = 0
+    with db:
+        for schema in shard_schemas(db):
+            cursor = db.execute(
+                PRUNE_SQL.format(history=f"{schema}.json_history", where="true"),
+                dict(keep=keep, keep_days=keep_days),
+            )
+            deleted += cursor.rowcount
+    return deleted
+
+def main(args):
+    with connect(args.database, "raw") as db:
+        if args.enable:
+            with db:
+                db.execute("DELETE FROM history_settings")
+                db.execute(
+                    "INSERT INTO history_settings (keyframe_interval, keep, keep_days) VALUES (?, ?, ?)",
+                    (args.keyframe_interval, args.keep, args.keep_days)
+                )
+            print(f"Keeping the history of the JSON pages in {args.database}")
+        elif args.disable:
+            with db:
+                db.execute("DELETE FROM history_settings")
+            seal(db)
+            print("No longer keeping the history of the JSON pages (existing history is kept)")
+        elif args.prune:
+            row = db.execute("SELECT keep, keep_days FROM history_settings").fetchone()
+            keep, keep_days = row or (None, None)
+            if args.keep is not None:
+                keep = args.keep
+            if args.keep_days is not None:
+                keep_days = args.keep_days
+            if keep is None and keep_days is None:
+                raise SystemExit("No retention policy to prune by (give --keep or --keep-days)")
+            print(f"Dropped {prune(db, keep, keep_days)} old pages")
+
+        for name in args.name:
+            if args.serial is None:
+                for serial, keyframe, size, superseded in db.execute("""\
+                    SELECT serial, keyframe, length(data), superseded
+                    FROM json_history WHERE name = ? ORDER BY serial
+                    """,
+                    (name,)
+                ):
+                    print(f"{name} {serial}: {size} bytes{' (keyframe)' if keyframe else ''}, replaced {superseded}")
+            else:
+                print(json.dumps(page_at(db, name, args.serial), indent=2))
@@ -1,60 +1,243 @@
 import argparse
-import asyncio
+import importlib
 
-#from .pkg import main as pkg_main
-from .chg import main as chg_main
-#from .req import main as req_main
-from .meta import main as meta_main
-from .raw import main as raw_main
+from .metrics import collect
+
+# The subcommands. Each is implemented by the main() function of the
+# module of the same name, which is only imported when the command runs,
+# so that startup (and --help) doesn't pay for importing httpx, rich,
+# aiosqlite and friends. The argument definitions here must stay
+# similarly lightweight.
+COMMANDS = {}
+
+def command(name, description, help, module=None, run_async=False):
+    def register(add_arguments):
+        COMMANDS[name] = dict(
+            description=description,
+            help=help,
+            module=module or "." + name,
+            run_async=run_async,
+            add_arguments=add_arguments,
+        )
+        return add_arguments
+    return register
+
+@command("raw", description="Update raw PyPI information database", help="Manage raw data from PyPI", run_async=True)
+def raw_arguments(parser):
+    parser.add_argument("name", nargs="*", help="Names of projects to update")
+    parser.add_argument("--file", help="A file of projects to update")
+    parser.add_argument("--limit", "-L", type=int, help="Maximum number of projects to update")
+    parser.add_argument("--database", "--DB", default="PyPI_raw.db", help="The database to update")
+    parser.add_argument("--type", action="append", help="The type of data (json or simple) to update")
+    parser.add_argument("--list", "-l", action="store_true", help="List the packages to be updated")
+    parser.add_argument("--enqueue", action="store_true", help="Put the pages to update in the fetch queue, for workers")
+    parser.add_argument("--worker", action="store_true", help="Fetch pages from the fetch queue until it is empty")
+    parser.add_argument("--worker-id", help="The name of this worker (default host-pid)")
+    parser.add_argument("--lease", type=float, default=300, help="Seconds a worker holds the pages it claims")
+    parser.add_argument("--claim-size", type=int, default=100, help="Number of pages a worker claims at a time")
+    parser.add_argument("--max-attempts", type=int, default=5, help="Number of times to try fetching a page")
+
+@command("pkg", description="Update package data from raw JSON", help="Manage package data")
+def pkg_arguments(parser):
+    parser.add_argument("name", nargs="*", help="Names of projects to update")
+    parser.add_argument("--file", help="A file of projects to update")
+    parser.add_argument("--limit", "-l", type=int, help="Maximum number of projects to update")
+    parser.add_argument("--database", "--DB", default="PackageData.db", help="The database to update")
+    parser.add_argument("--raw", default="PyPI_raw.db", help="The source database of raw PyPI data")
+    parser.add_argument("--list", "-L", action="store_true", help="List the packages to be updated")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of queued projects to update per transaction")
+    parser.add_argument("--rescan", action="store_true", help="Queue every project that is missing or out of date")
+    parser.add_argument("--all", action="store_true", help="Queue every project (to backfill new tables)")
+    parser.add_argument("--rebuild-terms", action="store_true", help="Rebuild the classifier and keyword index from the projects table")
+    parser.add_argument("--rebuild-tags", action="store_true", help="Rebuild the wheel tag index from the project_files table")
+    parser.add_argument("--rebuild-stats", action="store_true", help="Rebuild the project_stats table from the JSON pages in the raw database")
+    parser.add_argument("--rebuild-requires-python", action="store_true", help="Rebuild the Requires-Python intervals from the projects and project_files tables")
+
+@command("chg", description="Update changelog data", help="Manage changelog data")
+def chg_arguments(parser):
+    parser.add_argument("--database", "--DB", default="PyPI_raw.db", help="The database to update")
+
+@command("meta", description="Add wheel metadata", help="Add wheel metadata")
+def meta_arguments(parser):
+    parser.add_argument("--database", "--DB", default="Metadata.db", help="The database to update")
+    parser.add_argument("--raw", default="PyPI_raw.db", help="The raw PyPI data")
+    parser.add_argument("--limit", "-l", type=int, help="Maximum number of files to update")
+    parser.add_argument("--spool-size", type=int, default=64, help="MiB of each wheel to hold in memory before spilling to disk")
+    parser.add_argument("--memory-budget", type=int, default=512, help="MiB of wheel data to hold in memory across all workers")
+    parser.add_argument("--large-size", type=int, default=10, help="Wheels of at least this many MiB go in the large lane")
+    parser.add_argument("--small-workers", type=int, default=16, help="Number of threads fetching small wheels")
+    parser.add_argument("--large-workers", type=int, default=4, help="Number of threads fetching large wheels")
+    parser.add_argument("--max-in-flight", type=int, default=2048, help="MiB of wheels to process at once across both lanes")
+
+@command("search", description="Search project summaries, descriptions and keywords", help="Search package data")
+def search_arguments(parser):
+    parser.add_argument("query", nargs="*", help="The search terms (FTS5 query syntax)")
+    parser.add_argument("--database", "--DB", default="PackageData.db", help="The package database to search")
+    parser.add_argument("--limit", "-l", type=int, default=20, help="Maximum number of results")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the search index")
+
+@command("export", description="Export tables to Parquet or Arrow files", help="Export data for analysis")
+def export_arguments(parser):
+    parser.add_argument("output", help="The directory to write the exported data to")
+    parser.add_argument("--database", "--DB", default="PackageData.db", help="The package database to export")
+    parser.add_argument("--raw", default="PyPI_raw.db", help="The raw PyPI data")
+    parser.add_argument("--table", action="append", choices=["projects", "project_files", "changelog", "releases"], help="The tables to export (default all)")
+    parser.add_argument("--format", choices=["parquet", "arrow"], default="parquet", help="The output file format")
+    parser.add_argument("--since", type=int, help="Export rows changed since this serial (default: since the last export)")
+    parser.add_argument("--full", action="store_true", help="Export all rows, not just those changed since the last export")
+    parser.add_argument("--chunk-size", type=int, default=100_000, help="Number of rows to hold in memory at once")
+
+@command("serve", description="Serve the simple and JSON APIs from the raw data", help="Run a local PyPI mirror server")
+def serve_arguments(parser):
+    parser.add_argument("--database", "--DB", default="PyPI_raw.db", help="The raw database to serve")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="The port to listen on")
+    parser.add_argument("--cache-size", type=int, default=10_000, help="Number of rendered pages to keep in memory")
+    parser.add_argument("--ttl", type=float, default=60, help="Seconds before a cached page is checked against the database")
+
+@command("graph", description="Query the dependency graph", help="Query dependencies")
+def graph_arguments(parser):
+    parser.add_argument("name", nargs="*", help="Names of projects to query")
+    parser.add_argument("--database", "--DB", default="PackageData.db", help="The package database")
+    parser.add_argument("--reverse", "-r", action="store_true", help="Show the projects that depend on the named projects")
+    parser.add_argument("--transitive", "-t", action="store_true", help="Include indirect dependencies")
+    parser.add_argument("--extra", action="append", help="Include the dependencies of this extra")
+    parser.add_argument("--markers", action="store_true", help="Only follow requirements whose markers match this environment")
+    parser.add_argument("--python", help="Evaluate markers for this Python version")
+    parser.add_argument("--platform", help="Evaluate markers for this sys.platform")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the requirements table from the projects table")
+
+@command("refresh", description="Run the changelog, raw, pkg and meta updates as a single streaming pipeline", help="Refresh all data")
+def refresh_arguments(parser):
+    parser.add_argument("--raw", default="PyPI_raw.db", help="The raw PyPI database")
+    parser.add_argument("--pkg", default="PackageData.db", help="The package database")
+    parser.add_argument("--meta", default="Metadata.db", help="The metadata database")
+    parser.add_argument("--since", type=int, help="Process changes since this serial (default: the latest in the changelog)")
+    parser.add_argument("--type", action="append", help="The type of raw data (json or simple) to update")
+    parser.add_argument("--no-meta", action="store_true", help="Don't fetch wheel metadata")
+    parser.add_argument("--workers", type=int, default=100, help="Number of concurrent page fetches")
+    parser.add_argument("--meta-workers", type=int, default=8, help="Number of threads fetching wheels")
+    parser.add_argument("--spool-size", type=int, default=64, help="MiB of each wheel to hold in memory before spilling to disk")
+    parser.add_argument("--memory-budget", type=int, default=512, help="MiB of wheel data to hold in memory across all workers")
+    parser.add_argument("--queue-size", type=int, default=1000, help="Maximum number of items waiting between stages")
+    parser.add_argument("--batch-size", type=int, default=100, help="Number of projects per pkg transaction")
+    parser.add_argument("--commit-interval", type=float, default=1.0, help="Seconds between commits of fetched pages")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for a locked database")
+
+@command("shard", description="Split the raw pages across shard files by project name hash, or merge them back", help="Reshard the raw database")
+def shard_arguments(parser):
+    parser.add_argument("shards", type=int, help="The number of shards (1 to keep all the pages in the main file)")
+    parser.add_argument("--database", "--DB", default="PyPI_raw.db", help="The raw database")
+    parser.add_argument("--batch-size", type=int, default=10_000, help="Number of rows to copy at a time")
+
+@command("snapshot", description="Write the changes since a serial to a compressed delta, for replicas", help="Write a replication delta")
+def snapshot_arguments(parser):
+    parser.add_argument("--since", type=int, required=True, help="Include changes after this serial (a replica's high-water serial)")
+    parser.add_argument("--output", "-o", help="The delta file to write (default pypidata-SINCE-SERIAL.db.gz)")
+    parser.add_argument("--raw", default="PyPI_raw.db", help="The raw PyPI database")
+    parser.add_argument("--meta", default="Metadata.db", help="The metadata database")
+
+@command("apply", description="Apply replication deltas written by snapshot", help="Apply replication deltas", module=".snapshot")
+def apply_arguments(parser):
+    parser.add_argument("delta", nargs="+", help="The delta files to apply, in order")
+    parser.add_argument("--raw", default="PyPI_raw.db", help="The raw PyPI database")
+    parser.add_argument("--meta", default="Metadata.db", help="The metadata database")
+    parser.add_argument("--force", action="store_true", help="Apply the deltas even if they don't follow on from the replica's serial")
+
+@command("backfill", description="Add, drop and index the generated columns over json_data.info", help="Maintain indexed info columns")
+def backfill_arguments(parser):
+    parser.add_argument("--database", "--DB", default="PyPI_raw.db", help="The raw database")
+    parser.add_argument("--add", action="append", metavar="NAME=PATH", help="Add (or change) a column, e.g. info_author=$.author")
+    parser.add_argument("--drop", action="append", metavar="NAME", help="Drop a column")
+    parser.add_argument("--list", action="store_true", help="List the columns")
+
+@command("history", description="Keep, prune and query the history of the JSON pages", help="Manage the JSON page history")
+def history_arguments(parser):
+    parser.add_argument("name", nargs="*", help="Projects to list the history of (or show at --serial)")
+    parser.add_argument("--database", "--DB", default="PyPI_raw.db", help="The raw database")
+    parser.add_argument("--serial", type=int, help="Show the JSON page of each project as it was at this serial")
+    parser.add_argument("--enable", action="store_true", help="Keep the pages that raw replaces")
+    parser.add_argument("--disable", action="store_true", help="Stop keeping replaced pages")
+    parser.add_argument("--prune", action="store_true", help="Drop the pages outside the retention policy")
+    parser.add_argument("--keyframe-interval", type=int, default=16, help="Store every this many pages of a project whole, rather than as changes")
+    parser.add_argument("--keep", type=int, help="Keep at most this many old pages per project")
+    parser.add_argument("--keep-days", type=int, help="Drop old pages replaced more than this many days ago")
+
+@command("synth", description="Generate synthetic raw and metadata databases at PyPI-like scale", help="Generate benchmark data")
+def synth_arguments(parser):
+    parser.add_argument("--database", "--DB", default="PyPI_raw.db", help="The raw database to create")
+    parser.add_argument("--meta", default="Metadata.db", help="The metadata database to create")
+    parser.add_argument("--projects", type=int, default=10_000, help="Number of projects")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random data")
+    parser.add_argument("--release-alpha", type=float, default=1.2, help="Shape of the Pareto distribution of releases per project (smaller means a longer tail)")
+    parser.add_argument("--max-releases", type=int, default=5000, help="Maximum releases per project")
+    parser.add_argument("--binary-fraction", type=float, default=0.1, help="Fraction of projects with a wheel per platform and Python version")
+    parser.add_argument("--file-size", type=int, default=50_000, help="Median file size in bytes")
+    parser.add_argument("--description-size", type=int, default=2000, help="Median description size in bytes")
+    parser.add_argument("--metadata-size", type=int, default=2000, help="Median METADATA size in bytes")
+    parser.add_argument("--metadata-fraction", type=float, default=1.0, help="Fraction of wheels with metadata")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of projects per transaction")
+
+@command("bench", description="Time the SQL and transform hot paths", help="Run benchmarks")
+def bench_arguments(parser):
+    parser.add_argument("--case", action="append", choices=["out_of_date", "get_wheels", "info_filter", "transform"], help="The cases to run (default all)")
+    parser.add_argument("--raw", default="PyPI_raw.db", help="The raw PyPI database")
+    parser.add_argument("--meta", default="Metadata.db", help="The metadata database")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of times to run each case")
+    parser.add_argument("--sample", type=int, default=1000, help="Number of projects for the per-project cases")
+
+#@command("req", description="Add requirement data", help="Add requirement data")
+#def req_arguments(parser):
+#    parser.add_argument("--database", "--DB", default="Requirements.db", help="The database to update")
+#    parser.add_argument("--pkg", default="PackageData.db", help="The package information database")
+#    parser.add_argument("name", nargs="*", help="Names of projects to update")
 
 
 def make_parser():
     # create the top-level parser
     parser = argparse.ArgumentParser(prog='pypidata')
-    subparsers = parser.add_subparsers()
-
-    parser_raw = subparsers.add_parser("raw", description="Update raw PyPI information database", help="Manage raw data from PyPI")
-    parser_raw.add_argument("name", nargs="*", help="Names of projects to update")
-    parser_raw.add_argument("--file", help="A file of projects to update")
-    parser_raw.add_argument("--limit", "-L", type=int, help="Maximum number of projects to update")
-    parser_raw.add_argument("--database", "--DB", default="PyPI_raw.db", help="The database to update")
-    parser_raw.add_argument("--type", action="append", help="The type of data (json or simple) to update")
-    parser_raw.add_argument("--list", "-l", action="store_true", help="List the packages to be updated")
-    parser_raw.set_defaults(main=raw_main)
-
-    #parser_pkg = subparsers.add_parser("pkg", description="Update package data from raw JSON", help="Manage package data")
-    #parser_pkg.add_argument("name", nargs="*", help="Names of projects to update")
-    #parser_pkg.add_argument("--file", help="A file of projects to update")
-    #parser_pkg.add_argument("--limit", "-l", type=int, help="Maximum number of projects to update")
-    #parser_pkg.add_argument("--database", "--DB", default="PackageData.db", help="The database to update")
-    #parser_pkg.add_argument("--raw", default="PyPI_raw.db", help="The source database of raw PyPI data")
-    #parser_pkg.add_argument("--list", "-L", action="store_true", help="List the packages to be updated")
-    #parser_pkg.set_defaults(main=pkg_main)
-    
-    parser_chg = subparsers.add_parser("chg", description="Update changelog data", help="Manage changelog data")
-    parser_chg.add_argument("--database", "--DB", default="PyPI_raw.db", help="The database to update")
-    parser_chg.set_defaults(main=chg_main)
-
-    parser_meta = subparsers.add_parser("meta", description="Add wheel metadata", help="Add wheel metadata")
-    parser_meta.add_argument("--database", "--DB", default="Metadata.db", help="The database to update")
-    parser_meta.add_argument("--raw", default="PyPI_raw.db", help="The raw PyPI data")
-    parser_meta.add_argument("--limit", "-l", type=int, help="Maximum number of files to update")
-    parser_meta.set_defaults(main=meta_main)
-
-    #parser_req = subparsers.add_parser("req", description="Add requirement data", help="Add requirement data")
-    #parser_req.add_argument("--database", "--DB", default="Requirements.db", help="The database to update")
-    #parser_req.add_argument("--pkg", default="PackageData.db", help="The package information database")
-    #parser_req.add_argument("name", nargs="*", help="Names of projects to update")
-    #parser_req.set_defaults(main=req_main)
+    parser.add_argument("--metrics-report", help="Write a JSON report of the run's metrics to this file")
+    parser.add_argument("--prometheus", help="Write the run's metrics to this Prometheus textfile")
+    parser.add_argument("--metrics-interval", type=float, help="Rewrite the metrics files every this many seconds during the run")
+    parser.add_argument("--profile", choices=["cpu", "alloc", "wall"], help="Profile the command (CPU time, memory allocations or wall clock samples)")
+    parser.add_argument("--profile-dir", default="profiles", help="The directory to write profiles to")
+    parser.add_argument("--profile-top", type=int, default=30, help="Number of entries in the profile summary")
+    parser.add_argument("--cache-dir", help="Cache the responses from PyPI in this directory")
+    parser.add_argument("--http-cache-size", type=int, default=10240, help="Maximum size of the response cache in MiB")
+    parser.add_argument("--replay", action="store_true", help="Work offline, from the responses in the cache")
+    subparsers = parser.add_subparsers(dest="command")
+
+    for name, cmd in COMMANDS.items():
+        subparser = subparsers.add_parser(name, description=cmd["description"], help=cmd["help"])
+        cmd["add_arguments"](subparser)
 
     return parser
 
+def run(args):
+    cmd = COMMANDS[args.command]
+    module = importlib.import_module(cmd["module"], __package__)
+    if cmd["run_async"]:
+        import asyncio
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(module.main(args))
+    else:
+        module.main(args)
+
 def main():
     parser = make_parser()
     args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        return
 
-    if args.main == raw_main:
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(args.main(args))
+    if args.cache_dir or args.replay:
+        from .cache import configure
+        configure(args)
+
+    if args.profile:
+        from .profiling import profile
+        with collect(args, args.command), profile(args, args.command):
+            run(args)
     else:
-        args.main(args)
+        with collect(args, args.command):
+            run(args)
@@ -1,10 +1,13 @@
 import argparse
 import concurrent.futures
-import io
+import hashlib
 import json
-import sqlite3
+import tempfile
+import threading
+import time
 import zlib
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from functools import partial
 from pathlib import Path
 from signal import SIGINT, signal
@@ -15,6 +18,8 @@ from lazyfile import LazyFile
 from packaging.utils import canonicalize_name, canonicalize_version
 from rich.progress import BarColumn, Progress, TimeRemainingColumn
 
+from . import cache, metrics
+from .db import connect
 from .db_writer import DBWriter
 
 # Get the metadata from a wheel by lazily reading just enough
@@ -55,10 +60,81 @@ def getter(url, lo, hi):
 #    if complete:
 #        complete()
 
-def get_meta(filename, url, db):
-    try:
+# Wheels are streamed into a spooled temporary file, which moves to disk
+# once it reaches spool_size, and hashed as they are read. A memory budget
+# caps the wheel data held in memory by all the worker threads together.
+
+SPOOL_SIZE = 64 * 2**20
+CHUNK_SIZE = 2**20
+
+class ByteBudget:
+    # A limit on the total bytes reserved by all threads
+    def __init__(self, limit, name):
+        self.limit = limit
+        self.name = name
+        self.used = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        size = min(size, self.limit)
+        with self.cond:
+            self.cond.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+            metrics.gauge(f"{self.name}_bytes", self.used, type="wheel")
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.used -= size
+                self.cond.notify_all()
+
+def download(url, data, sha256=None):
+    # Copy the wheel at url to the file data, returning its sha256, which
+    # is checked against the expected sha256 (if given) before caching it
+    if cache.active is not None:
+        return cache.active.fetch_file(url, data, lambda: fetch_wheel(url, data), sha256)
+    return fetch_wheel(url, data)
+
+def fetch_wheel(url, data):
+    digest = hashlib.sha256()
+    total = 0
+    with metrics.timer("http_request_seconds", type="wheel"):
         with urlopen(url) as f:
-            data = io.BytesIO(f.read())
+            metrics.inc("http_responses", type="wheel", status=f.status)
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                data.write(chunk)
+                total += len(chunk)
+    metrics.inc("bytes_in", total, type="wheel")
+    return digest.hexdigest()
+
+def get_meta(filename, url, db, sha256=None, size=None, budget=None, spool_size=SPOOL_SIZE):
+    # size and sha256 are from the simple index. The memory reservation
+    # lasts until the wheel has been parsed.
+    in_memory = min(size or spool_size, spool_size)
+    with budget.reserve(in_memory) if budget else nullcontext():
+        with tempfile.SpooledTemporaryFile(max_size=in_memory) as data:
+            try:
+                digest = download(url, data, sha256)
+            except Exception as e:
+                metrics.inc("errors", type="wheel", error=type(e).__name__)
+                print("Error:", e)
+                return
+            if sha256 and digest != sha256:
+                # Left out of the database, so it is retried on the next run
+                print(f"{filename}: sha256 {digest} does not match the simple index - skipping")
+                metrics.inc("errors", type="wheel", error="HashMismatch")
+                return
+            data.seek(0)
+            parse_wheel(filename, url, data, db)
+
+def parse_wheel(filename, url, data, db):
+    try:
+        start = time.perf_counter()
         z = ZipFile(data)
         name, version, *_ = filename.split("-", 2)
         name = canonicalize_name(name)
@@ -80,11 +156,14 @@ def get_meta(filename, url, db):
                 f"{url} does not contain metadata file {name}-{version}.dist-info/METADATA:",
                 [n for n in z.namelist() if n.endswith("METADATA")]
             )
+            metrics.observe("parse_seconds", time.perf_counter() - start, type="wheel")
             db.submit({"filename": filename, "content": json.dumps(content), "data": None})
             return
         metadata_content = z.read(file)
+        metrics.observe("parse_seconds", time.perf_counter() - start, type="wheel")
         db.submit({"filename": filename, "content": json.dumps(content), "data": zlib.compress(metadata_content)})
     except Exception as e:
+        metrics.inc("errors", type="wheel", error=type(e).__name__)
         print("Error:", e)
 
 SELECT = """\
@@ -95,20 +174,42 @@ SELECT = """\
 """
 
 SELECT = """\
-    SELECT filename, url
+    SELECT filename, url, sha256, size
     FROM (
         SELECT
             json_extract(f.value, '$.filename') filename,
-            json_extract(f.value, '$.url') url
-        FROM pkg.simple_data, json_each(files) f
+            json_extract(f.value, '$.url') url,
+            json_extract(f.value, '$.hashes.sha256') sha256,
+            json_extract(f.value, '$.size') size
+        FROM simple_data, json_each(files) f
     )
     WHERE filename like '%.whl'
     AND filename NOT IN (SELECT filename FROM project_metadata)
 """
 
+# The wheels of the named projects that don't have metadata yet
+SELECT_FOR = """\
+    SELECT filename, url, sha256, size
+    FROM (
+        SELECT
+            json_extract(f.value, '$.filename') filename,
+            json_extract(f.value, '$.url') url,
+            json_extract(f.value, '$.hashes.sha256') sha256,
+            json_extract(f.value, '$.size') size
+        FROM simple_data, json_each(files) f
+        WHERE name IN (SELECT value FROM json_each(?))
+    )
+    WHERE filename like '%.whl'
+    AND filename NOT IN (SELECT filename FROM project_metadata)
+"""
+
+def get_wheels_for(conn, names):
+    # conn is a connection to the metadata database, with the raw
+    # database attached as "pkg"
+    return conn.execute(SELECT_FOR, (json.dumps(names),)).fetchall()
+
 def get_wheels(pkg: str, meta: str):
-    with sqlite3.connect(meta) as conn:
-        conn.execute("ATTACH DATABASE ? AS pkg", (pkg,))
+    with connect(meta, "meta", attach={"pkg": (pkg, "raw")}) as conn:
         rows = conn.execute(SELECT).fetchall()
     # Return rows as a physical list so we can close the
     # database connection before returning
@@ -126,6 +227,36 @@ INSERT INTO project_metadata (filename, content, metadata)
 VALUES (:filename, :content, :data)
 """
 
+# Wheels are processed in two lanes by size, each with its own workers,
+# so a run of large wheels can't hold up thousands of small ones. The
+# small lane takes the smallest first, and the large lane the largest
+# first, so the longest downloads don't end up at the tail of the run.
+# Wheels whose size isn't in the index go in the large lane. The total
+# size of the wheels being processed in both lanes is capped.
+
+def lanes(rows, threshold):
+    small = [row for row in rows if row[3] is not None and row[3] < threshold]
+    large = [row for row in rows if row[3] is None or row[3] >= threshold]
+    small.sort(key=lambda row: row[3])
+    large.sort(key=lambda row: row[3] or threshold, reverse=True)
+    return {"small": small, "large": large}
+
+class Throughput:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        with self.lock:
+            self.files += 1
+            self.bytes += size or 0
+
+    def __str__(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return f"{self.files / elapsed:.1f} files/s, {self.bytes / elapsed / 1e6:.1f} MB/s"
+
 def main(args: argparse.Namespace):
     print("Fetching list of wheels")
     rows = get_wheels(args.raw, args.database)
@@ -135,33 +266,50 @@ def main(args: argparse.Namespace):
     else:
         print(f"Processing {len(rows)} wheels")
 
-    db = DBWriter(args.database, UPD)
+    threshold = args.large_size * 2**20
+    work = lanes(rows, threshold)
+    total_bytes = sum(row[3] or 0 for row in rows)
+    print(f"{len(work['small'])} small and {len(work['large'])} large wheels, {total_bytes / 1e6:.1f} MB")
+    workers = {"small": args.small_workers, "large": args.large_workers}
+
+    db = DBWriter(args.database, UPD, schema="meta")
     db.start()
+    memory = ByteBudget(args.memory_budget * 2**20, "memory")
+    in_flight = ByteBudget(args.max_in_flight * 2**20, "in_flight")
+    throughput = Throughput()
 
     with Progress(*PROGRESS_DISPLAY) as progress:
-        submit = progress.add_task("Submit tasks", total=len(rows))
-        task = progress.add_task("Fetch wheels", total=len(rows))
+        tasks = {lane: progress.add_task(f"Fetch {lane} wheels", total=len(work[lane])) for lane in work}
+        downloaded = progress.add_task("Downloaded", total=total_bytes)
         ins = progress.add_task("Insert records", total=len(rows))
-        def task():
-            get_meta(filename, url, db)
-            progress.update(task, advance=1)
+        def fetch(lane, filename, url, sha256, size):
+            with in_flight.reserve(size or threshold):
+                get_meta(filename, url, db, sha256, size, memory, args.spool_size * 2**20)
+            throughput.add(size)
+            metrics.inc("wheels", lane=lane)
+            progress.update(tasks[lane], advance=1)
+            progress.update(downloaded, advance=size or 0, description=f"Downloaded ({throughput})")
             progress.update(ins, completed=db.inserted)
-        with ThreadPoolExecutor() as executor:
-            try:
-                results = []
-                for filename, url in rows:
-                    results.append(executor.submit(task))
-                    progress.update(submit, advance=1)
-                # If we don't wait here for the futures, the executor waits in __exit__,
-                # but that's too late to catch keyboard interrupts, so Ctrl-C hangs the
-                # process.
-                concurrent.futures.wait(results)
-            except KeyboardInterrupt:
+        executors = {lane: ThreadPoolExecutor(workers[lane]) for lane in work}
+        try:
+            results = [
+                executors[lane].submit(fetch, lane, filename, url, sha256, size)
+                for lane in work
+                for filename, url, sha256, size in work[lane]
+            ]
+            # If we don't wait here for the futures, the executor waits in __exit__,
+            # but that's too late to catch keyboard interrupts, so Ctrl-C hangs the
+            # process.
+            concurrent.futures.wait(results)
+        except KeyboardInterrupt:
+            for executor in executors.values():
                 executor.shutdown(False, cancel_futures=True)
+        for executor in executors.values():
+            executor.shutdown()
     db.stop()
     print("Waiting for DB updates to complete")
     db.join()
-    print("Done")
+    print(f"Processed {throughput.files} wheels, {throughput.bytes / 1e6:.1f} MB ({throughput})")
 
 if __name__ == "__main__":
     metadata = Path(__file__).parent / "Metadata.db"
@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Run metrics, shared by all the subcommands.
+#
+# Counters and gauges are keyed by name and labels. Latencies go into
+# histograms with fixed buckets (in seconds), as Prometheus expects. At the
+# end of a run, main() writes them as a JSON report and/or a Prometheus
+# textfile, and with --metrics-interval the same files are rewritten
+# periodically while the run is in progress.
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Estimated as the upper bound of the bucket holding the quantile
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def as_dict(self):
+        return dict(
+            count=self.count,
+            sum=self.sum,
+            max=self.max,
+            p50=self.quantile(0.5),
+            p90=self.quantile(0.9),
+            p99=self.quantile(0.99),
+            buckets={str(b): n for b, n in zip(BUCKETS + ("+Inf",), self.counts)},
+        )
+
+def key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, command=None):
+        with self.lock:
+            self.command = command
+            self.started = time.time()
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        k = key(name, labels)
+        with self.lock:
+            self.counters[k] = self.counters.get(k, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        k = key(name, labels)
+        with self.lock:
+            h = self.histograms.get(k)
+            if h is None:
+                h = self.histograms[k] = Histogram()
+            h.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def report(self):
+        def entries(d, conv=lambda v: v):
+            return [dict(name=n, labels=dict(l), value=conv(v)) for (n, l), v in sorted(d.items())]
+        with self.lock:
+            now = time.time()
+            return dict(
+                command=self.command,
+                started=self.started,
+                elapsed=now - self.started,
+                counters=entries(self.counters),
+                gauges=entries(self.gauges),
+                histograms=entries(self.histograms, Histogram.as_dict),
+            )
+
+    def prometheus(self):
+        def fmt(name, labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return f"pypidata_{name}"
+            inner = ",".join(f'{k}="{v}"' for k, v in labels)
+            return f"pypidata_{name}{{{inner}}}"
+        lines = []
+        typed = set()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE pypidata_{name} {kind}")
+        with self.lock:
+            for (name, labels), v in sorted(self.counters.items()):
+                declare(name + "_total", "counter")
+                lines.append(f"{fmt(name + '_total', labels)} {v}")
+            for (name, labels), v in sorted(self.gauges.items()):
+                declare(name, "gauge")
+                lines.append(f"{fmt(name, labels)} {v}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                declare(name, "histogram")
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ("+Inf",), h.counts):
+                    cumulative += n
+                    lines.append(f"{fmt(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{fmt(name + '_sum', labels)} {h.sum}")
+                lines.append(f"{fmt(name + '_count', labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+inc = METRICS.inc
+gauge = METRICS.gauge
+observe = METRICS.observe
+timer = METRICS.timer
+
+def write_atomic(path, text):
+    # Readers (such as the node exporter) must never see a partial file
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text, encoding="utf-8")
+    os.replace(tmp, path)
+
+def write(args):
+    if args.metrics_report:
+        write_atomic(args.metrics_report, json.dumps(METRICS.report(), indent=4))
+    if args.prometheus:
+        write_atomic(args.prometheus, METRICS.prometheus())
+
+class Reporter(threading.Thread):
+    # Rewrites the metrics files every interval seconds
+    def __init__(self, args):
+        self.args = args
+        self.stop_event = threading.Event()
+        super().__init__(daemon=True)
+
+    def run(self):
+        while not self.stop_event.wait(self.args.metrics_interval):
+            write(self.args)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+@contextmanager
+def collect(args, command):
+    METRICS.reset(command)
+    reporter = None
+    if args.metrics_interval and (args.metrics_report or args.prometheus):
+        reporter = Reporter(args)
+        reporter.start()
+    try:
+        yield METRICS
+    finally:
+        if reporter:
+            reporter.stop()
+        METRICS.gauge("run_seconds", time.time() - METRICS.started)
+        write(args)
@@ -1,10 +1,15 @@
 import sys
 import json
 from pathlib import Path
-import sqlite3
-from rich.progress import Progress, BarColumn, TimeRemainingColumn
-import zlib
-from .build_package import write_package
+import time
+from rich.progress import Progress
+from . import metrics
+from .build_package import delete_package, rebuild_stats, write_package
+from .classifiers import rebuild_terms
+from .db import connect, shard_schemas
+from .requires_python import rebuild_specifiers
+from .shard import shard_of
+from .wheel_tags import rebuild_wheel_tags
 
 # conn = sqlite3.connect("PackageData.db")
 # conn.execute("ATTACH DATABASE 'PyPI_raw.db' AS raw")
@@ -39,69 +44,189 @@ from .build_package import write_package
 #     conn.commit()
 
 
-def get_package_names(db, args):
+# The queue of projects whose JSON data has changed since they were last
+# written to the package database is the pkg_dirty table in the raw
+# database, maintained by triggers on json_data (see raw_schema.sql).
+# The raw tables are named unqualified, so that they resolve to the views
+# over the shards if the raw database is sharded (see db.py).
+
+# Queue everything that is missing from, or out of date in, the
+# package database, and deleted projects that it still has. These run
+# against each shard of the raw database.
+RESCAN_SQL = """\
+INSERT INTO {raw}.pkg_dirty (name, serial)
+SELECT j.name, j.serial
+FROM {raw}.json_data j
+WHERE CASE WHEN j.info IS NULL
+    THEN EXISTS (SELECT 1 FROM projects p WHERE p.name = j.name)
+    ELSE NOT EXISTS (
+        SELECT 1 FROM projects p
+        WHERE p.name = j.name AND p.last_serial = j.serial
+    )
+END
+ON CONFLICT(name) DO UPDATE SET serial = excluded.serial
+"""
+
+# Queue every project, to backfill tables added to the package database
+ALL_SQL = """\
+INSERT INTO {raw}.pkg_dirty (name, serial)
+SELECT name, serial FROM {raw}.json_data WHERE true
+ON CONFLICT(name) DO UPDATE SET serial = excluded.serial
+"""
+
+def read_names(args):
+    if args.file == "-":
+        text = sys.stdin.read()
+    else:
+        text = Path(args.file).read_text(encoding="utf-8")
     names = []
+    for name in text.splitlines():
+        name = name.strip()
+        if not name or name.startswith("#"):
+            continue
+        names.append(name)
+    return names
+
+def get_package_names(db, args):
     if args.file:
-        if args.file == "-":
-            text = sys.stdin.read()
-        else:
-            text = Path(args.file).read_text(encoding="utf-8")
-        for name in text.splitlines():
-            name = name.strip()
-            if not name or name.startswith("#"):
-                continue
-            names.append(name)
+        names = read_names(args)
     elif len(args.name) > 0:
         names = args.name[:]
     else:
-        SQL = """\
-            SELECT
-                p.name
-            FROM
-                projects p,
-                raw.json_data j
-            WHERE
-                p.name = j.name and
-                p.last_serial != j.serial
-            ORDER BY
-                p.name
-        """
-        for row in db.execute(SQL):
-            name, = row
-            names.append(name)
-    
+        names = [name for (name,) in db.execute("SELECT name FROM pkg_dirty ORDER BY name")]
+
     if args.limit:
         names = names[:args.limit]
     return names
 
-def update(db, name):
-    cursor = db.execute("SELECT data FROM raw.json_data WHERE name=?", (name,))
-    data, = cursor.fetchone()
-    if not data:
-        return
-    data = json.loads(zlib.decompress(data).decode("utf-8"))
-    write_package(db, name, data)
+def update(db, name, schemas=None):
+    # schemas are the raw database's shard schemas, which callers updating
+    # many projects look up once
+    if schemas is None:
+        schemas = shard_schemas(db, "raw")
+    # The page and queue entry are in the project's shard of the raw
+    # database, if it is sharded
+    schema = schemas[shard_of(name, len(schemas))]
+    row = db.execute(
+        f"SELECT serial, info, releases FROM {schema}.json_data WHERE name=?",
+        (name,)
+    ).fetchone()
+    if row is None:
+        # Nothing to write, but the entry must go, or the queue never drains
+        db.execute(f"DELETE FROM {schema}.pkg_dirty WHERE name = ?", (name,))
+        return None
+    serial, info, releases = row
+    if info is not None:
+        with metrics.timer("parse_seconds", type="json"):
+            data = dict(
+                info=json.loads(info),
+                releases=json.loads(releases),
+                last_serial=serial,
+            )
+        with metrics.timer("db_write_seconds", table="projects"):
+            write_package(db, name, data)
+        metrics.inc("rows_written", table="projects")
+    else:
+        # Deleted from PyPI
+        delete_package(db, name)
+    # Only clear the queue entry if it hasn't been re-dirtied since we
+    # read the data
+    db.execute(f"DELETE FROM {schema}.pkg_dirty WHERE name = ? AND serial <= ?", (name, serial))
+    return serial
+
+def drain_queue(db, batch_size, limit=None):
+    # Each batch is written, and removed from the queue, in a single
+    # transaction, so an interrupted run simply resumes from the queue.
+    done = 0
+    remaining, = db.execute("SELECT count(*) FROM pkg_dirty").fetchone()
+    while limit is None or done < limit:
+        size = batch_size if limit is None else min(batch_size, limit - done)
+        # The first names of each shard's queue, read in primary key order,
+        # as ordering the view over the shards would sort the whole queue
+        schemas = shard_schemas(db, "raw")
+        batch = sorted(
+            row for schema in schemas
+            for row in db.execute(f"SELECT name FROM {schema}.pkg_dirty ORDER BY name LIMIT ?", (size,))
+        )[:size]
+        if not batch:
+            break
+        with db:
+            for name, in batch:
+                update(db, name, schemas)
+            commit_start = time.perf_counter()
+        metrics.observe("commit_seconds", time.perf_counter() - commit_start)
+        done += len(batch)
+        remaining -= len(batch)
+        metrics.gauge("queue_depth", max(remaining, 0), stage="pkg")
+        yield len(batch)
 
 
+def open_db(database, raw, rescan=False, **kw):
+    db = connect(database, "pkg", "bulk", attach={"raw": (raw, "raw")}, **kw)
+    if rescan:
+        queue_all(db, RESCAN_SQL)
+    return db
+
+def queue_all(db, sql):
+    with db:
+        for schema in shard_schemas(db, "raw"):
+            db.execute(sql.format(raw=schema))
+
 def main(args):
-    with sqlite3.connect(args.database) as db:
-        print("Attaching the raw database...")
-        db.execute("ATTACH DATABASE ? AS raw", (args.raw,))
-        print("Getting packages to process...")
-        names = get_package_names(db, args)
-        print(f"Processing {len(names)} packages")
+    with open_db(args.database, args.raw, rescan=args.rescan) as db:
+        if args.all:
+            queue_all(db, ALL_SQL)
+
+        if args.rebuild_terms:
+            print("Rebuilding the classifier and keyword index...")
+            with db:
+                count = rebuild_terms(db)
+            print(f"Indexed {count} projects")
+            return
+
+        if args.rebuild_tags:
+            print("Rebuilding the wheel tag index...")
+            with db:
+                count = rebuild_wheel_tags(db)
+            print(f"Indexed {count} wheels")
+            return
+
+        if args.rebuild_stats:
+            print("Rebuilding the project statistics...")
+            with db:
+                count = rebuild_stats(db, shard_schemas(db, "raw"))
+            print(f"Updated {count} projects")
+            return
+
+        if args.rebuild_requires_python:
+            print("Rebuilding the Requires-Python intervals...")
+            with db:
+                count = rebuild_specifiers(db)
+            print(f"Parsed {count} distinct specifiers")
+            return
 
         if args.list:
-            for name in names:
+            for name in get_package_names(db, args):
                 print(name)
             return
 
         with Progress() as progress:
-            t = progress.add_task("Updating...", total=len(names))
-            for name in names:
-                update(db, name)
-                progress.update(t, advance=1)
-        print("Committing changes")
-        db.commit()
+            if args.file or args.name:
+                names = get_package_names(db, args)
+                print(f"Processing {len(names)} packages")
+                t = progress.add_task("Updating...", total=len(names))
+                schemas = shard_schemas(db, "raw")
+                for name in names:
+                    with db:
+                        update(db, name, schemas)
+                    progress.update(t, advance=1)
+            else:
+                total, = db.execute("SELECT count(*) FROM pkg_dirty").fetchone()
+                if args.limit:
+                    total = min(total, args.limit)
+                print(f"Processing {total} queued packages")
+                t = progress.add_task("Updating...", total=total)
+                for count in drain_queue(db, args.batch_size, args.limit):
+                    progress.update(t, advance=count)
         print("Detaching the raw database")
         db.execute("DETACH DATABASE raw")
@@ -0,0 +1,217 @@
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+# Profiling for the --profile option.
+#
+# Each profiler covers every thread of the run (the event loop in "raw"
+# and the worker threads in "meta" included), and writes to its own
+# timestamped directory:
+#
+#   stacks.collapsed - "frame;frame;frame count" lines, for flamegraph.pl
+#                      or speedscope
+#   summary.txt      - the top N entries
+#
+# plus the profiler's native output where it has one.
+
+def label(filename, lineno, name):
+    return f"{name} ({Path(filename).name}:{lineno})"
+
+def write_collapsed(path, stacks):
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in sorted(stacks.items()):
+            if count > 0:
+                f.write(f"{';'.join(stack)} {count}\n")
+
+class CPUProfiler:
+    # cProfile. Before Python 3.12 it only sees the thread that enabled it,
+    # so there is a separate profile for each thread started during the
+    # run, merged at the end. From 3.12 it uses sys.monitoring, which sees
+    # every thread, and a second profiler can't be enabled.
+    def __init__(self):
+        self.profiles = []
+
+    def start(self):
+        if sys.version_info < (3, 12):
+            def start_thread(*args):
+                sys.setprofile(None)
+                p = cProfile.Profile()
+                self.profiles.append(p)
+                p.enable()
+            threading.setprofile(start_thread)
+        self.main = cProfile.Profile()
+        self.main.enable()
+
+    def stop(self):
+        self.main.disable()
+        if sys.version_info < (3, 12):
+            threading.setprofile(None)
+        for p in self.profiles:
+            p.create_stats()
+
+    def write(self, outdir, top):
+        stats = pstats.Stats(self.main)
+        for p in self.profiles:
+            stats.add(p)
+        stats.dump_stats(outdir / "profile.pstats")
+
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(top)
+        stats.sort_stats("tottime").print_stats(top)
+        (outdir / "summary.txt").write_text(out.getvalue(), encoding="utf-8")
+
+        write_collapsed(outdir / "stacks.collapsed", self.collapse(stats.stats))
+
+    @staticmethod
+    def collapse(stats, max_depth=64, min_fraction=0.001):
+        # cProfile only records caller/callee pairs, so expand the call
+        # graph from its roots, splitting each function's time between
+        # the paths to it in proportion to the time spent via each caller.
+        # Counts are in microseconds.
+        callees = {}
+        for func, (cc, nc, tt, ct, callers) in stats.items():
+            for caller, edge in callers.items():
+                callees.setdefault(caller, []).append((func, edge[3]))
+        roots = [func for func, s in stats.items() if not s[4]]
+        total = sum(stats[r][3] for r in roots) or 1.0
+        stacks = Counter()
+        placed = Counter()
+
+        def walk(func, stack, path_time):
+            ct = stats[func][3]
+            if ct <= 0 or path_time < total * min_fraction or len(stack) >= max_depth:
+                return
+            stack = stack + (label(*func),)
+            fraction = min(path_time / ct, 1.0)
+            time = int(stats[func][2] * fraction * 1e6)
+            stacks[stack] += time
+            placed[func] += time
+            for callee, edge_time in callees.get(func, []):
+                if label(*callee) not in stack:
+                    walk(callee, stack, edge_time * fraction)
+
+        for root in roots:
+            walk(root, (), stats[root][3])
+
+        # From Python 3.12, cProfile records every thread as one call stack,
+        # so the callers of functions run by other threads are wrong, and
+        # often have no time. Time the walk couldn't place goes on a stack
+        # of its own, so that it isn't lost.
+        for func, (cc, nc, tt, ct, callers) in stats.items():
+            rest = int(tt * 1e6) - placed[func]
+            if rest > total * min_fraction * 1e6:
+                stacks[label(*func),] += rest
+        return stacks
+
+class AllocProfiler:
+    # tracemalloc, which sees allocations from all threads. The collapsed
+    # stacks are of the memory still allocated at the end of the run, in
+    # bytes.
+    def __init__(self, frames=32):
+        self.frames = frames
+
+    def start(self):
+        tracemalloc.start(self.frames)
+
+    def stop(self):
+        self.snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+        self.peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    def write(self, outdir, top):
+        self.snapshot.dump(str(outdir / "alloc.snapshot"))
+
+        lines = [f"Peak traced memory: {self.peak / 2**20:.1f} MiB", ""]
+        lines.append(f"Top {top} allocation sites:")
+        for stat in self.snapshot.statistics("lineno")[:top]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size / 1024:10.1f} KiB {stat.count:8} blocks  {frame.filename}:{frame.lineno}")
+        (outdir / "summary.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+        stacks = Counter()
+        for stat in self.snapshot.statistics("traceback"):
+            # Tracebacks are most recent call first
+            stack = tuple(f"{Path(f.filename).name}:{f.lineno}" for f in reversed(stat.traceback))
+            stacks[stack] += stat.size
+        write_collapsed(outdir / "stacks.collapsed", stacks)
+
+class WallProfiler(threading.Thread):
+    # A sampling profiler: every interval, record the stack of every
+    # thread, whether it is running, waiting for I/O or blocked on a lock.
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        super().__init__(daemon=True)
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(label(code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def write(self, outdir, top):
+        write_collapsed(outdir / "stacks.collapsed", self.stacks)
+
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack[1:]):
+                inclusive[frame] += count
+        lines = [f"{self.samples} samples at {self.interval * 1000:g} ms intervals", ""]
+        for title, counter in (("Self", own), ("Inclusive", inclusive)):
+            lines.append(f"Top {top} frames by {title.lower()} time:")
+            for frame, count in counter.most_common(top):
+                lines.append(f"{count * self.interval:10.2f}s  {frame}")
+            lines.append("")
+        (outdir / "summary.txt").write_text("\n".join(lines), encoding="utf-8")
+
+PROFILERS = {
+    "cpu": CPUProfiler,
+    "alloc": AllocProfiler,
+    "wall": WallProfiler,
+}
+
+@contextmanager
+def profile(args, command):
+    if not args.profile:
+        yield
+        return
+    profiler = PROFILERS[args.profile]()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        outdir = Path(args.profile_dir) / f"{command}-{args.profile}-{stamp}"
+        outdir.mkdir(parents=True, exist_ok=True)
+        profiler.write(outdir, args.profile_top)
+        print(f"Profile written to {outdir}")
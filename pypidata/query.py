@@ -0,0 +1,306 @@
+import json
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from email.parser import BytesParser
+from typing import NamedTuple, Optional
+
+from .db import connect
+from .requires_python import MATCHING_SQL
+from .versions import sort_key
+
+# Read-only access to the pypidata databases for other services.
+#
+# Each thread gets its own read-only connection (SQLite connections can't
+# be shared between threads), with the package and metadata databases
+# attached. Statements are fixed strings, so they stay in the connection's
+# prepared statement cache. Results for a project are cached, keyed on the
+# project's last_serial in the packages table, so a cached entry is never
+# returned once the project has changed.
+
+def normalize(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+class Project(NamedTuple):
+    name: str
+    display_name: str
+    last_serial: int
+    version: Optional[str]
+    summary: Optional[str]
+    requires_python: Optional[str]
+    requires_dist: list
+    classifiers: list
+    license: Optional[str]
+    home_page: Optional[str]
+    yanked: bool
+
+class File(NamedTuple):
+    project_name: str
+    version: str
+    filename: str
+    packagetype: Optional[str]
+    python_version: Optional[str]
+    requires_python: Optional[str]
+    size: Optional[int]
+    upload_time: Optional[str]
+    url: Optional[str]
+    sha256: Optional[str]
+    yanked: bool
+
+class ChangelogEntry(NamedTuple):
+    name: str
+    display_name: str
+    version: Optional[str]
+    timestamp: int
+    action: str
+    serial: int
+
+class WheelMetadata(NamedTuple):
+    filename: str
+    files: Optional[list]
+    metadata: object
+
+PROJECT_SQL = """\
+SELECT
+    name, display_name, last_serial, version, summary, requires_python,
+    requires_dist, classifiers, license, home_page, yanked
+FROM pkg.projects
+WHERE name = ?
+"""
+
+FILES_SQL = """\
+SELECT
+    f.project_name, f.version, f.filename, f.packagetype, f.python_version,
+    f.requires_python, f.size, f.upload_time_iso_8601, f.url, d.digest,
+    f.yanked
+FROM pkg.project_files f
+LEFT JOIN pkg.file_digests d ON d.file_id = f.file_id AND d.digest_type = 'sha256'
+WHERE f.project_name = ? AND f.version = ?
+ORDER BY f.filename
+"""
+
+SERIAL_SQL = "SELECT last_serial FROM main.packages WHERE name = ?"
+
+# The serial of the JSON page that the project's rows in the package
+# database were written from, which only changes when pkg rewrites them
+PKG_SERIAL_SQL = "SELECT last_serial FROM pkg.projects WHERE name = ?"
+
+CHANGELOG_SQL = """\
+SELECT name, display_name, version, timestamp, action, serial
+FROM main.changelog
+WHERE serial > ?
+ORDER BY serial
+LIMIT ?
+"""
+
+METADATA_SQL = "SELECT content, metadata FROM meta.project_metadata WHERE filename = ?"
+
+TAG_PROJECTS_SQL = """\
+SELECT DISTINCT f.project_name
+FROM pkg.wheel_tags t
+JOIN pkg.file_tags ft ON ft.tag_id = t.tag_id
+JOIN pkg.project_files f ON f.file_id = ft.file_id
+WHERE {where}
+ORDER BY f.project_name
+"""
+
+# A missing or blank requires_python allows any version
+PROJECTS_SUPPORTING_SQL = f"""\
+SELECT name
+FROM pkg.projects
+WHERE coalesce(trim(requires_python), '') = ''
+OR requires_python IN ({MATCHING_SQL.format(schema="pkg.")})
+ORDER BY name
+"""
+
+RELEASES_SUPPORTING_SQL = f"""\
+SELECT r.version
+FROM pkg.releases r
+WHERE r.project_name = :name
+AND EXISTS (
+    SELECT 1 FROM pkg.project_files f
+    WHERE f.project_name = r.project_name AND f.version = r.version
+    AND (
+        coalesce(trim(f.requires_python), '') = ''
+        OR f.requires_python IN ({MATCHING_SQL.format(schema="pkg.")})
+    )
+)
+ORDER BY r.sort_key
+"""
+
+PLATFORM_COVERAGE_SQL = """\
+SELECT t.platform, count(DISTINCT f.project_name)
+FROM pkg.wheel_tags t
+JOIN pkg.file_tags ft ON ft.tag_id = t.tag_id
+JOIN pkg.project_files f ON f.file_id = ft.file_id
+GROUP BY t.platform
+ORDER BY 2 DESC
+"""
+
+def split_lines(value):
+    return value.split("\n") if value else []
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+# Distinguishes "not cached" from a cached None
+MISSING = object()
+
+class PyPIData:
+    def __init__(self, raw="PyPI_raw.db", pkg="PackageData.db", meta="Metadata.db", cache_size=10_000):
+        self.raw = raw
+        self.pkg = pkg
+        self.meta = meta
+        self.local = threading.local()
+        self.cache = LRUCache(cache_size)
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        attach = {
+            alias: (path, None)
+            for alias, path in (("pkg", self.pkg), ("meta", self.meta))
+            if path is not None
+        }
+        return connect(
+            self.raw,
+            profile="read",
+            attach=attach,
+            readonly=True,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+
+    @property
+    def db(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def last_serial(self, name):
+        row = self.db.execute(SERIAL_SQL, (normalize(name),)).fetchone()
+        return row[0] if row else None
+
+    def cached(self, kind, name, fetch):
+        # The cached values are from the package database, so they are
+        # keyed on the serial it was written at, rather than the raw one,
+        # which moves ahead of it between a raw and a pkg run
+        name = normalize(name)
+        row = self.db.execute(PKG_SERIAL_SQL, (name,)).fetchone()
+        key = (kind, name, row[0] if row else None)
+        value = self.cache.get(key, MISSING)
+        if value is MISSING:
+            value = fetch(name)
+            self.cache.put(key, value)
+        return value
+
+    def project(self, name):
+        def fetch(name):
+            row = self.db.execute(PROJECT_SQL, (name,)).fetchone()
+            if row is None:
+                return None
+            (name, display_name, last_serial, version, summary, requires_python,
+                requires_dist, classifiers, license, home_page, yanked) = row
+            return Project(
+                name, display_name, last_serial, version, summary, requires_python,
+                split_lines(requires_dist), split_lines(classifiers),
+                license, home_page, bool(yanked),
+            )
+        return self.cached("project", name, fetch)
+
+    def latest_version(self, name):
+        project = self.project(name)
+        return project.version if project else None
+
+    def files(self, name, version):
+        def fetch(name):
+            return [
+                File(*row[:-1], bool(row[-1]))
+                for row in self.db.execute(FILES_SQL, (name, version))
+            ]
+        return self.cached(("files", version), name, fetch)
+
+    def changelog_since(self, serial, limit=10_000):
+        return [ChangelogEntry(*row) for row in self.db.execute(CHANGELOG_SQL, (serial, limit))]
+
+    def wheel_metadata(self, filename):
+        # Wheels are immutable, so their metadata can be cached by filename.
+        # A wheel that meta hasn't processed yet isn't cached, as it will
+        # have metadata once it has.
+        key = ("metadata", filename)
+        value = self.cache.get(key)
+        if value is None:
+            row = self.db.execute(METADATA_SQL, (filename,)).fetchone()
+            if row is None:
+                return None
+            content, data = row
+            files = json.loads(content) if content else None
+            metadata = BytesParser().parsebytes(zlib.decompress(data)) if data else None
+            value = WheelMetadata(filename, files, metadata)
+            self.cache.put(key, value)
+        return value
+
+    def projects_with_tag(self, interpreter=None, abi=None, platform=None):
+        # The projects with wheels for any tag matching all of the given
+        # parts, e.g. platform="manylinux_2_28_aarch64" or interpreter="cp313"
+        parts = dict(interpreter=interpreter, abi=abi, platform=platform)
+        where = " AND ".join(f"t.{k} = :{k}" for k, v in parts.items() if v is not None) or "true"
+        return [name for name, in self.db.execute(TAG_PROJECTS_SQL.format(where=where), parts)]
+
+    def platform_coverage(self):
+        # The number of projects with wheels for each platform tag
+        return dict(self.db.execute(PLATFORM_COVERAGE_SQL))
+
+    def projects_supporting(self, python):
+        # The projects whose latest Requires-Python allows the given Python
+        # version, e.g. "3.14"
+        return [name for name, in self.db.execute(PROJECTS_SUPPORTING_SQL, dict(python=sort_key(python)))]
+
+    def releases_supporting(self, name, python):
+        # The versions of a project with a file installable on the given
+        # Python version, oldest first
+        def fetch(name):
+            return [
+                version for version, in
+                self.db.execute(RELEASES_SUPPORTING_SQL, dict(name=name, python=sort_key(python)))
+            ]
+        return self.cached(("python", python), name, fetch)
@@ -8,10 +8,13 @@ import zlib
 from collections import Counter
 from pathlib import Path
 
-import aiosqlite
 import httpx
 from rich.progress import Progress
 
+from . import cache, history, metrics
+from .db import connect_async, shard_schemas_async
+from .shard import writers
+
 
 def normalize(name):
     return re.sub(r"[-_.]+", "-", name).lower()
@@ -22,6 +25,11 @@ URLs = {
 }
 
 async def fetch_url(client, url, headers=None):
+    if cache.active is not None:
+        return await cache.active.fetch_async(url, headers, lambda h: get_url(client, url, h))
+    return await get_url(client, url, headers)
+
+async def get_url(client, url, headers=None):
     tries = 0
     while True:
         try:
@@ -77,7 +85,12 @@ async def store_simple(db, **kw):
         kw
     )
 
-async def store_json(db, **kw):
+async def store_json(db, history_settings=None, **kw):
+    if history_settings is not None:
+        await history.record(
+            db, history_settings, kw["name"], kw["serial"],
+            kw["info"], kw["releases"], kw["vulnerabilities"],
+        )
     await db.execute(f"""\
         INSERT INTO json_data (
             name,
@@ -100,7 +113,9 @@ async def store_json(db, **kw):
         kw
     )
 
-async def update_page(sem, db, page_type, name, last_serial, prev_etag):
+async def fetch_page(sem, page_type, name, last_serial, prev_etag):
+    # Fetch a page, without storing it. Returns the result, and the page
+    # (the arguments for store_page) if it was fetched.
     async with sem:
         async with httpx.AsyncClient(headers={"User-Agent": "pypidata/0.1"}) as client:
             url = URLs[page_type].format(name=name)
@@ -113,13 +128,20 @@ async def update_page(sem, db, page_type, name, last_serial, prev_etag):
             if prev_etag:
                 headers["If-None-Match"] = prev_etag
 
-            response = await fetch_url(client, url, headers)
+            try:
+                with metrics.timer("http_request_seconds", type=page_type):
+                    response = await fetch_url(client, url, headers)
+            except cache.CacheMiss:
+                return "Not cached", None
             if response is None:
                 print(f"Failed to fetch {name} ({page_type}) - skipping...")
-                return "Timeout"
+                metrics.inc("http_timeouts", type=page_type)
+                return "Timeout", None
+            metrics.inc("http_responses", type=page_type, status=response.status_code)
+            metrics.inc("bytes_in", len(response.content), type=page_type)
             if response.status_code == 304:
                 # Not modified
-                return "Not modified"
+                return "Not modified", None
             etag = response.headers.get("ETag")
 
             data = response.text if not response.is_error else None
@@ -144,11 +166,47 @@ async def update_page(sem, db, page_type, name, last_serial, prev_etag):
 
             #assert serial >= last_serial, f"{name}: Page has {serial}, package list has {last_serial}"
 
-            if page_type == "simple":
-                await store_simple(db, name=name, serial=serial, url=url, etag=etag, **simple_content(response))
-            else:
-                await store_json(db, name=name, serial=serial, url=url, etag=etag, **json_content(response))
-    return "Fetched"
+            with metrics.timer("parse_seconds", type=page_type):
+                content = simple_content(response) if page_type == "simple" else json_content(response)
+    return "Fetched", dict(name=name, serial=serial, url=url, etag=etag, **content)
+
+async def store_page(db, page_type, page, history_settings=None):
+    with metrics.timer("db_write_seconds", table=f"{page_type}_data"):
+        if page_type == "simple":
+            await store_simple(db, **page)
+        else:
+            await store_json(db, history_settings, **page)
+    metrics.inc("rows_written", table=f"{page_type}_data")
+
+async def update_page(sem, db, page_type, name, last_serial, prev_etag, history_settings=None):
+    result, page = await fetch_page(sem, page_type, name, last_serial, prev_etag)
+    if page is not None:
+        await store_page(db, page_type, page, history_settings)
+    return result
+
+
+# The pages that are missing, or older than the package list. Each shard's
+# page table is joined directly, by its primary key, rather than through
+# the view over the shards, which SQLite would copy whole (pages and all)
+# into a temporary table on every scan.
+OUT_OF_DATE_SQL = """\
+SELECT p.name, p.last_serial, coalesce({etags}, NULL)
+FROM main.packages p
+{joins}
+WHERE p.last_serial > coalesce({serials}, 0)
+ORDER BY p.name
+"""
+
+def out_of_date_sql(page_type, schemas):
+    # schemas are the raw database's shard schemas (see db.shard_schemas)
+    return OUT_OF_DATE_SQL.format(
+        etags=", ".join(f"d{i}.etag" for i in range(len(schemas))),
+        joins="\n".join(
+            f"LEFT JOIN {schema}.{page_type}_data d{i} ON d{i}.name = p.name"
+            for i, schema in enumerate(schemas)
+        ),
+        serials=", ".join(f"d{i}.serial" for i in range(len(schemas))),
+    )
 
 async def get_out_of_date(db, page_type, args):
     names = []
@@ -165,12 +223,7 @@ async def get_out_of_date(db, page_type, args):
     elif len(args.name) > 0:
         names = [(n,0, None) for n in args.name]
     else:
-        SQL = f"""\
-        SELECT name, last_serial, d.etag
-        FROM packages p LEFT JOIN {page_type}_data d USING (name)
-        WHERE p.last_serial > coalesce(d.serial, 0)
-        ORDER BY name
-        """
+        SQL = out_of_date_sql(page_type, await shard_schemas_async(db))
         async with db.execute(SQL) as cursor:
             async for row in cursor:
                 name, serial, etag = row
@@ -180,21 +233,28 @@ async def get_out_of_date(db, page_type, args):
         names = names[:args.limit]
     return names
 
-async def update_all_pages(db, page_type, args, progress):
+async def update_all_pages(db, shards, page_type, args, progress):
     packages = await get_out_of_date(db, page_type, args)
     print(f"Updating {len(packages)} {page_type} pages")
     taskbar = progress.add_task(f"Updating {page_type}", total=len(packages))
     sem = asyncio.Semaphore(100)
+    remaining = len(packages)
+    metrics.gauge("queue_depth", remaining, stage=page_type)
     async def upd(name, last_serial, etag):
+        nonlocal remaining
         result = await update_page(
             sem,
-            db,
+            shards.for_name(name),
             page_type,
             name,
             last_serial,
             etag,
+            shards.history,
         )
         progress.update(taskbar, advance=1)
+        remaining -= 1
+        metrics.gauge("queue_depth", remaining, stage=page_type)
+        metrics.inc("pages", type=page_type, result=result)
         return result
     updates = [
         upd(name, last_serial, etag)
@@ -206,11 +266,14 @@ async def update_all_pages(db, page_type, args, progress):
 async def update_packages(db):
     # Get the data from XMLRPC
     XMLRPC = "https://pypi.org/pypi"
-    pypi = xmlrpc.client.ServerProxy(XMLRPC)
-    packages = { normalize(n): (n, s) for (n, s) in pypi.list_packages_with_serial().items() }
+    transport = cache.active.transport(XMLRPC) if cache.active is not None else None
+    pypi = xmlrpc.client.ServerProxy(XMLRPC, transport=transport)
+    with metrics.timer("xmlrpc_seconds", method="list_packages_with_serial"):
+        packages = { normalize(n): (n, s) for (n, s) in pypi.list_packages_with_serial().items() }
     def params():
         for norm, (n, s) in packages.items():
             yield dict(name=norm, display_name=n, ser=s)
+    metrics.inc("rows_written", len(packages), table="packages")
     await db.executemany(
         """\
             INSERT INTO packages (name, display_name, last_serial)
@@ -225,20 +288,32 @@ async def update_packages(db):
 async def main(args):
     if not args.type:
         args.type = ["json", "simple"]
-    async with aiosqlite.connect(args.database) as db:
+    if args.worker:
+        from .fetch_queue import work
+        await work(args)
+        return
+    async with connect_async(args.database, "raw", "bulk") as db, writers(db, args.database) as shards:
         if not (args.file or args.name):
             print("Updating package list")
-            await update_packages(db)
+            try:
+                await update_packages(db)
+            except cache.CacheMiss:
+                print("The package list isn't cached, using the stored one")
         print("Got package list")
+        if args.enqueue:
+            from .fetch_queue import enqueue
+            await enqueue(db, args)
+            return
         with Progress() as progress:
             results = await asyncio.gather(*[
-                update_all_pages(db, page_type, args, progress)
+                update_all_pages(db, shards, page_type, args, progress)
                 for page_type in args.type
             ])
         for page_type, res in zip(args.type, results):
             for result, count in res:
                 print(page_type, result, count)
-        await db.commit()
+        with metrics.timer("commit_seconds"):
+            await shards.commit()
 
 if __name__ == "__main__":
     def parse_cmdline(args=None):
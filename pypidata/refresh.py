@@ -0,0 +1,284 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rich.progress import Progress
+
+from . import cache, metrics
+from .chg import RateLimitedServerProxy, params
+from .db import connect, connect_async
+from .db_writer import DBWriter
+from .meta import UPD, ByteBudget, get_meta, get_wheels_for
+from .pkg import open_db, update
+from .raw import update_page
+from .shard import writers
+
+# The whole refresh (changelog, raw pages, package data and wheel
+# metadata) as a single pipeline. Each stage passes the projects it has
+# finished with straight on to the next, through bounded queues:
+#
+#   changelog --names--> raw --json pages--> pkg
+#                            --simple pages--> meta
+#
+# so a project changed upstream is fully processed within seconds of its
+# changelog entry being read, rather than waiting for each full pass to
+# complete. None on a queue marks the end of the stream.
+
+CHANGELOG_SQL = """\
+INSERT OR IGNORE INTO changelog (
+    name, display_name, version, timestamp, action, serial
+)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+PACKAGES_SQL = """\
+INSERT INTO packages (name, display_name, last_serial)
+VALUES (?, ?, ?)
+ON CONFLICT(name) DO UPDATE SET
+    display_name = excluded.display_name,
+    last_serial = max(last_serial, excluded.last_serial)
+"""
+
+class Stage:
+    def __init__(self, name, progress):
+        self.name = name
+        self.count = 0
+        self.started = None
+        self.finished = None
+        self.progress = progress
+        self.task = progress.add_task(name, total=None)
+
+    def done(self, n=1):
+        if self.started is None:
+            self.started = time.monotonic()
+        self.count += n
+        self.progress.update(self.task, advance=n)
+        metrics.inc("pipeline_items", n, stage=self.name)
+
+    def close(self):
+        self.finished = time.monotonic()
+        self.progress.update(self.task, total=self.count, completed=self.count)
+
+    def summary(self):
+        if self.started is None:
+            return f"{self.name}: 0 items"
+        elapsed = max((self.finished or time.monotonic()) - self.started, 1e-9)
+        return f"{self.name}: {self.count} items in {elapsed:.1f}s ({self.count / elapsed:.1f}/s)"
+
+async def batches(queue, size):
+    # Yield lists of up to size items, as they become available
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        batch = [item]
+        while len(batch) < size:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if item is None:
+                yield batch
+                return
+            batch.append(item)
+        yield batch
+
+async def changelog_stage(db, args, out_q, stage):
+    pypi = RateLimitedServerProxy("https://pypi.org/pypi")
+    if args.since is not None:
+        since = args.since
+    else:
+        async with db.execute("SELECT max(serial) FROM changelog") as cursor:
+            since, = await cursor.fetchone()
+    # Looking up a method waits out the rate limit, so is done off the
+    # event loop, and outside the timing of the call
+    changelog_last_serial = await asyncio.to_thread(getattr, pypi, "changelog_last_serial")
+    with metrics.timer("xmlrpc_seconds", method="changelog_last_serial"):
+        latest = await asyncio.to_thread(changelog_last_serial)
+    print(f"Fetching changelog {since}..{latest}")
+    while True:
+        try:
+            changelog_since_serial = await asyncio.to_thread(getattr, pypi, "changelog_since_serial")
+            with metrics.timer("xmlrpc_seconds", method="changelog_since_serial"):
+                entries = await asyncio.to_thread(changelog_since_serial, since)
+        except cache.CacheMiss:
+            print(f"Replayed the cached changelog up to {since}")
+            break
+        if not entries:
+            break
+        rows = list(params(entries))
+        latest_serials = {}
+        for name, display_name, version, timestamp, action, serial in rows:
+            if serial > latest_serials.get(name, (None, 0))[1]:
+                latest_serials[name] = (display_name, serial)
+        await db.executemany(CHANGELOG_SQL, rows)
+        await db.executemany(PACKAGES_SQL, [(n, d, s) for n, (d, s) in latest_serials.items()])
+        with metrics.timer("commit_seconds", stage="changelog"):
+            await db.commit()
+        for name, (_, serial) in latest_serials.items():
+            await out_q.put((name, serial))
+        stage.done(len(entries))
+        since = max(serial for *_, serial in rows)
+    stage.close()
+    await out_q.put(None)
+
+async def raw_stage(db, shards, args, in_q, pkg_q, meta_q, stage):
+    sem = asyncio.Semaphore(args.workers)
+    # Limits the number of fetch tasks, so the input queue provides back
+    # pressure to the changelog stage
+    slots = asyncio.Semaphore(args.workers)
+    fetched = {page_type: [] for page_type in args.type}
+    in_flight = {}
+
+    async def fetch(name, serial):
+        try:
+            for page_type in args.type:
+                async with db.execute(f"SELECT etag FROM {page_type}_data WHERE name = ?", (name,)) as cursor:
+                    row = await cursor.fetchone()
+                result = await update_page(sem, shards.for_name(name), page_type, name, serial, row[0] if row else None, shards.history)
+                metrics.inc("pages", type=page_type, result=result)
+                if result == "Fetched":
+                    fetched[page_type].append(name)
+        except Exception as e:
+            print(f"Failed to update {name}: {e}")
+            metrics.inc("errors", stage="raw", error=type(e).__name__)
+        finally:
+            slots.release()
+        stage.done()
+
+    async def commit():
+        # Downstream stages read the pages through their own connections,
+        # so only pass names on once the pages are committed.
+        ready = {page_type: names[:] for page_type, names in fetched.items()}
+        for names in fetched.values():
+            names.clear()
+        with metrics.timer("commit_seconds", stage="raw"):
+            await shards.commit()
+        for name in ready.get("json", []):
+            await pkg_q.put(name)
+        for name in ready.get("simple", []):
+            await meta_q.put(name)
+
+    finished = asyncio.Event()
+    async def committer():
+        while not finished.is_set():
+            try:
+                await asyncio.wait_for(finished.wait(), args.commit_interval)
+            except asyncio.TimeoutError:
+                pass
+            await commit()
+
+    commit_task = asyncio.create_task(committer())
+    tasks = set()
+    while True:
+        item = await in_q.get()
+        if item is None:
+            break
+        name, serial = item
+        # A project can appear in several changelog batches; fetch it
+        # once, after its latest change.
+        if name in in_flight:
+            await in_flight[name]
+        await slots.acquire()
+        task = asyncio.create_task(fetch(name, serial))
+        in_flight[name] = task
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(lambda t, name=name: in_flight.pop(name, None) if in_flight.get(name) is t else None)
+    if tasks:
+        await asyncio.gather(*tasks)
+    finished.set()
+    await commit_task
+    stage.close()
+    await pkg_q.put(None)
+    await meta_q.put(None)
+
+async def pkg_stage(args, in_q, stage):
+    conn = open_db(args.pkg, args.raw, check_same_thread=False, timeout=args.timeout)
+
+    def process(names):
+        with conn:
+            for name in names:
+                with metrics.timer("transform_seconds", stage="pkg"):
+                    update(conn, name)
+
+    async for names in batches(in_q, args.batch_size):
+        await asyncio.to_thread(process, names)
+        stage.done(len(names))
+    conn.close()
+    stage.close()
+
+async def meta_stage(args, in_q, stage):
+    conn = connect(
+        args.meta, "meta",
+        attach={"pkg": (args.raw, "raw")},
+        check_same_thread=False,
+        timeout=args.timeout,
+    )
+    writer = DBWriter(args.meta, UPD, schema="meta")
+    writer.start()
+    budget = ByteBudget(args.memory_budget * 2**20, "memory")
+
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(args.meta_workers * 2)
+    pending = set()
+    with ThreadPoolExecutor(args.meta_workers) as executor:
+        async for names in batches(in_q, args.batch_size):
+            wheels = await asyncio.to_thread(get_wheels_for, conn, names)
+            for filename, url, sha256, size in wheels:
+                await sem.acquire()
+                fut = loop.run_in_executor(executor, get_meta, filename, url, writer, sha256, size, budget, args.spool_size * 2**20)
+                pending.add(fut)
+                def finished(f):
+                    pending.discard(f)
+                    sem.release()
+                    stage.done()
+                fut.add_done_callback(finished)
+        if pending:
+            await asyncio.wait(pending)
+    writer.stop()
+    await asyncio.to_thread(writer.join)
+    conn.close()
+    stage.close()
+
+async def run(args):
+    async with connect_async(args.raw, "raw", "bulk", timeout=args.timeout) as db, writers(db, args.raw, timeout=args.timeout) as shards:
+        with Progress() as progress:
+            stages = {
+                name: Stage(name, progress)
+                for name in ("changelog", "raw", "pkg", "meta")
+            }
+            names_q = asyncio.Queue(args.queue_size)
+            pkg_q = asyncio.Queue(args.queue_size)
+            meta_q = asyncio.Queue(args.queue_size)
+
+            async def report():
+                while True:
+                    metrics.gauge("queue_depth", names_q.qsize(), stage="raw")
+                    metrics.gauge("queue_depth", pkg_q.qsize(), stage="pkg")
+                    metrics.gauge("queue_depth", meta_q.qsize(), stage="meta")
+                    await asyncio.sleep(1)
+            reporter = asyncio.create_task(report())
+
+            jobs = [
+                changelog_stage(db, args, names_q, stages["changelog"]),
+                raw_stage(db, shards, args, names_q, pkg_q, meta_q, stages["raw"]),
+                pkg_stage(args, pkg_q, stages["pkg"]),
+            ]
+            if args.no_meta:
+                async def discard():
+                    while await meta_q.get() is not None:
+                        pass
+                jobs.append(discard())
+            else:
+                jobs.append(meta_stage(args, meta_q, stages["meta"]))
+            await asyncio.gather(*jobs)
+            reporter.cancel()
+
+    for stage in stages.values():
+        print(stage.summary())
+
+def main(args):
+    if not args.type:
+        args.type = ["json", "simple"]
+    asyncio.run(run(args))
@@ -0,0 +1,159 @@
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+from packaging.specifiers import InvalidSpecifier, SpecifierSet
+from packaging.version import Version
+
+from .versions import encode
+
+# Requires-Python specifiers as ranges of versions.
+#
+# There are only a few thousand distinct specifier strings on PyPI, so
+# each is parsed once, into the union of intervals of Python versions it
+# allows, stored in python_intervals with bounds that are version sort
+# keys. Whether a Python version satisfies a project's or file's
+# requires_python is then a range comparison on its sort key (see
+# MATCHING_SQL), rather than evaluating the specifier for every row.
+
+class Interval(NamedTuple):
+    # None bounds are unbounded
+    lower: Optional[Version]
+    lower_inclusive: bool
+    upper: Optional[Version]
+    upper_inclusive: bool
+
+EVERYTHING = Interval(None, False, None, False)
+
+def prefix_bounds(version):
+    # The versions matching "version.*" are from the first dev release of
+    # the prefix, up to (but not including) that of the next prefix
+    release = Version(version).release
+    bumped = release[:-1] + (release[-1] + 1,)
+    return (
+        Version(".".join(map(str, release)) + ".dev0"),
+        Version(".".join(map(str, bumped)) + ".dev0"),
+    )
+
+def clause_intervals(spec):
+    op, version = spec.operator, spec.version
+    if version.endswith(".*"):
+        lower, upper = prefix_bounds(version[:-2])
+        if op == "==":
+            return [Interval(lower, True, upper, False)]
+        return [Interval(None, False, lower, False), Interval(upper, True, None, False)]
+    v = Version(version)
+    if op == ">=":
+        return [Interval(v, True, None, False)]
+    if op == ">":
+        return [Interval(v, False, None, False)]
+    if op == "<=":
+        return [Interval(None, False, v, True)]
+    if op == "<":
+        # Pre-releases of v don't match <v, unless v is one itself
+        if not (v.is_prerelease or v.is_devrelease):
+            v = Version(f"{v.public}.dev0")
+        return [Interval(None, False, v, False)]
+    if op in ("==", "==="):
+        # === compares the strings, which version ranges can't express,
+        # so it is taken as ==
+        return [Interval(v, True, v, True)]
+    if op == "!=":
+        return [Interval(None, False, v, False), Interval(v, False, None, False)]
+    if op == "~=":
+        # ~=X.Y.Z means >=X.Y.Z, ==X.Y.*
+        _, upper = prefix_bounds(".".join(map(str, v.release[:-1])))
+        return [Interval(v, True, upper, False)]
+    raise InvalidSpecifier(str(spec))
+
+def lower_key(i):
+    # Orders lower bounds from least to most restrictive
+    if i.lower is None:
+        return (0,)
+    return (1, encode(i.lower), not i.lower_inclusive)
+
+def upper_key(i):
+    # Orders upper bounds from most to least restrictive
+    if i.upper is None:
+        return (2,)
+    return (1, encode(i.upper), i.upper_inclusive)
+
+def intersect(a, b):
+    lower = max(a, b, key=lower_key)
+    upper = min(a, b, key=upper_key)
+    result = Interval(lower.lower, lower.lower_inclusive, upper.upper, upper.upper_inclusive)
+    if result.lower is not None and result.upper is not None:
+        lo, hi = encode(result.lower), encode(result.upper)
+        if lo > hi or (lo == hi and not (result.lower_inclusive and result.upper_inclusive)):
+            return None
+    return result
+
+@lru_cache(maxsize=10_000)
+def intervals(specifier):
+    # The intervals of versions allowed by specifier, or None if it isn't
+    # a valid specifier
+    try:
+        specs = SpecifierSet(specifier)
+        result = [EVERYTHING]
+        for spec in specs:
+            result = [
+                i for a in result for b in clause_intervals(spec)
+                if (i := intersect(a, b)) is not None
+            ]
+    except (InvalidSpecifier, ValueError):
+        return None
+    return tuple(result)
+
+# The specifiers (as written) that allow the Python version with sort key
+# :python
+MATCHING_SQL = """\
+SELECT s.specifier
+FROM {schema}python_intervals i
+JOIN {schema}python_specifiers s ON s.specifier_id = i.specifier_id
+WHERE (i.lower IS NULL OR i.lower < :python OR (i.lower = :python AND i.lower_inclusive))
+AND (i.upper IS NULL OR i.upper > :python OR (i.upper = :python AND i.upper_inclusive))
+"""
+
+INTERVALS_SQL = """\
+INSERT INTO python_intervals (
+    specifier_id,
+    lower,
+    lower_version,
+    lower_inclusive,
+    upper,
+    upper_version,
+    upper_inclusive
+)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+def bound(version):
+    return (None, None) if version is None else (encode(version), str(version))
+
+def write_specifiers(db, specifiers):
+    # Add any of the specifiers that aren't in python_specifiers yet
+    for specifier in specifiers:
+        if not specifier or not specifier.strip():
+            continue
+        row = db.execute("SELECT 1 FROM python_specifiers WHERE specifier = ?", (specifier,)).fetchone()
+        if row is not None:
+            continue
+        allowed = intervals(specifier)
+        cursor = db.execute(
+            "INSERT INTO python_specifiers (specifier, valid) VALUES (?, ?)",
+            (specifier, allowed is not None)
+        )
+        db.executemany(INTERVALS_SQL, [
+            (cursor.lastrowid, *bound(i.lower), i.lower_inclusive, *bound(i.upper), i.upper_inclusive)
+            for i in allowed or ()
+        ])
+
+def rebuild_specifiers(db):
+    db.execute("DELETE FROM python_intervals")
+    db.execute("DELETE FROM python_specifiers")
+    specifiers = [s for s, in db.execute("""\
+        SELECT requires_python FROM projects
+        UNION
+        SELECT requires_python FROM project_files
+    """)]
+    write_specifiers(db, specifiers)
+    return db.execute("SELECT count(*) FROM python_specifiers").fetchone()[0]
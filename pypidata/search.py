@@ -0,0 +1,41 @@
+import sqlite3
+
+from .db import connect
+
+# Ranking weights for the summary, description and keywords columns
+WEIGHTS = (10.0, 1.0, 5.0)
+
+SEARCH_SQL = f"""\
+SELECT
+    p.name,
+    p.version,
+    bm25(projects_fts, {", ".join(str(w) for w in WEIGHTS)}) rank,
+    snippet(projects_fts, -1, '[', ']', '...', 16) snippet
+FROM projects_fts JOIN projects p ON p.project_id = projects_fts.rowid
+WHERE projects_fts MATCH ?
+ORDER BY rank
+LIMIT ?
+"""
+
+def rebuild_index(db):
+    db.execute("INSERT INTO projects_fts (projects_fts) VALUES ('rebuild')")
+
+def search(db, query, limit=20):
+    return db.execute(SEARCH_SQL, (query, limit)).fetchall()
+
+def main(args):
+    with connect(args.database, "pkg") as db:
+        if args.rebuild:
+            print("Rebuilding the search index...")
+            rebuild_index(db)
+            db.execute("INSERT INTO projects_fts (projects_fts) VALUES ('optimize')")
+            return
+        query = " ".join(args.query)
+        try:
+            results = search(db, query, args.limit)
+        except sqlite3.OperationalError as e:
+            # The query is in FTS5's syntax, so "c++" or "" don't parse
+            raise SystemExit(f"Invalid search query {query!r}: {e}")
+        for name, version, rank, snippet in results:
+            snippet = " ".join(snippet.split())
+            print(f"{name} {version} ({-rank:.2f}): {snippet}")
@@ -0,0 +1,282 @@
+import asyncio
+import gzip
+import html
+import json
+import time
+from urllib.parse import unquote, urlsplit
+
+from .db import connect
+from .query import LRUCache, normalize
+
+# A PyPI compatible server for the simple and JSON APIs, answered from the
+# pages stored by "raw". Rendered pages (and their gzipped form) are kept
+# in an in-memory cache, and only rechecked against the database once they
+# are older than the cache TTL, so hot projects never touch SQLite.
+
+SIMPLE_JSON = "application/vnd.pypi.simple.v1+json"
+SIMPLE_HTML = "application/vnd.pypi.simple.v1+html"
+
+JSON_SQL = """\
+SELECT
+    serial,
+    etag,
+    info,
+    releases,
+    json_extract(releases, '$."' || json_extract(info, '$.version') || '"'),
+    vulnerabilities
+FROM json_data
+WHERE name = ?
+"""
+
+SIMPLE_SQL = "SELECT serial, etag, files FROM simple_data WHERE name = ?"
+
+SERIAL_SQL = {
+    "json": "SELECT serial FROM json_data WHERE name = ?",
+    "simple": "SELECT serial FROM simple_data WHERE name = ?",
+}
+
+STATUS = {
+    200: "OK",
+    301: "Moved Permanently",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    406: "Not Acceptable",
+}
+
+class Page:
+    def __init__(self, serial, etag, content_type, body):
+        self.serial = serial
+        self.etag = etag
+        self.content_type = content_type
+        self.body = body
+        self.gzipped = None
+        self.checked = time.monotonic()
+
+    def gzip_body(self):
+        if self.gzipped is None:
+            self.gzipped = gzip.compress(self.body, compresslevel=6)
+        return self.gzipped
+
+def json_page(row):
+    serial, etag, info, releases, urls, vulnerabilities = row
+    if info is None:
+        return None
+    # Assemble the page from the stored JSON text, rather than parsing
+    # and re-serialising the (potentially huge) releases data.
+    body = "".join([
+        '{"info":', info,
+        ',"last_serial":', str(serial),
+        ',"releases":', releases,
+        ',"urls":', urls or "[]",
+        ',"vulnerabilities":', vulnerabilities or "[]",
+        "}",
+    ])
+    return Page(serial, etag, "application/json", body.encode("utf-8"))
+
+def simple_json_page(name, row):
+    serial, etag, files = row
+    if files is None:
+        return None
+    body = "".join([
+        '{"meta":{"api-version":"1.0","_last-serial":', str(serial), "}",
+        ',"name":', json.dumps(name),
+        ',"files":', files,
+        "}",
+    ])
+    return Page(serial, etag, SIMPLE_JSON, body.encode("utf-8"))
+
+def simple_html_page(name, row):
+    serial, etag, files = row
+    if files is None:
+        return None
+    lines = [
+        "<!DOCTYPE html>",
+        "<html>",
+        "  <head>",
+        '    <meta name="pypi:repository-version" content="1.0">',
+        f"    <title>Links for {html.escape(name)}</title>",
+        "  </head>",
+        "  <body>",
+        f"    <h1>Links for {html.escape(name)}</h1>",
+    ]
+    for file in json.loads(files):
+        href = file["url"]
+        hashes = file.get("hashes") or {}
+        if "sha256" in hashes:
+            href += "#sha256=" + hashes["sha256"]
+        attrs = [f'href="{html.escape(href)}"']
+        if file.get("requires-python"):
+            attrs.append(f'data-requires-python="{html.escape(file["requires-python"])}"')
+        metadata = file.get("core-metadata") or file.get("dist-info-metadata")
+        if isinstance(metadata, dict) and "sha256" in metadata:
+            value = html.escape("sha256=" + metadata["sha256"])
+            attrs.append(f'data-core-metadata="{value}"')
+            attrs.append(f'data-dist-info-metadata="{value}"')
+        elif metadata:
+            attrs.append('data-core-metadata="true"')
+            attrs.append('data-dist-info-metadata="true"')
+        yanked = file.get("yanked")
+        if yanked:
+            reason = yanked if isinstance(yanked, str) else ""
+            attrs.append(f'data-yanked="{html.escape(reason)}"')
+        lines.append(f'    <a {" ".join(attrs)}>{html.escape(file["filename"])}</a><br />')
+    lines += ["  </body>", "</html>", f"<!--SERIAL {serial}-->"]
+    # The HTML is our own rendering, so it can't share the upstream ETag
+    if etag:
+        etag = etag.rstrip('"') + '-html"'
+    return Page(serial, etag, SIMPLE_HTML, "\n".join(lines).encode("utf-8"))
+
+def simple_format(accept):
+    # Pick the simple API representation, following PEP 691 content
+    # negotiation (but only using quality values to exclude types).
+    if not accept:
+        return "html"
+    for item in accept.split(","):
+        mime, *params = item.split(";")
+        params = dict(p.strip().partition("=")[::2] for p in params)
+        try:
+            if float(params.get("q", 1)) == 0:
+                continue
+        except ValueError:
+            continue
+        mime = mime.strip()
+        if mime == SIMPLE_JSON:
+            return "json"
+        if mime in (SIMPLE_HTML, "text/html", "*/*", "application/*", "text/*"):
+            return "html"
+    return None
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    def strip(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+    return strip(etag) in {strip(t) for t in if_none_match.split(",")}
+
+class Server:
+    def __init__(self, database, cache_size=10_000, ttl=60):
+        self.db = connect(database, profile="read", readonly=True, check_same_thread=False)
+        self.cache = LRUCache(cache_size)
+        self.ttl = ttl
+
+    def load(self, kind, name):
+        if kind == "json":
+            row = self.db.execute(JSON_SQL, (name,)).fetchone()
+            return row and json_page(row)
+        row = self.db.execute(SIMPLE_SQL, (name,)).fetchone()
+        if kind == "simple-json":
+            return row and simple_json_page(name, row)
+        return row and simple_html_page(name, row)
+
+    def page(self, kind, name):
+        key = (kind, name)
+        page = self.cache.get(key)
+        now = time.monotonic()
+        if page is not None and now - page.checked > self.ttl:
+            table = "json" if kind == "json" else "simple"
+            row = self.db.execute(SERIAL_SQL[table], (name,)).fetchone()
+            if row is not None and row[0] == page.serial:
+                page.checked = now
+            else:
+                page = None
+        if page is None:
+            page = self.load(kind, name)
+            if page is not None:
+                self.cache.put(key, page)
+        return page
+
+    def route(self, path, headers):
+        # Returns (status, page or None, extra headers)
+        parts = [unquote(p) for p in urlsplit(path).path.split("/") if p]
+        if len(parts) == 2 and parts[0] == "simple":
+            name = normalize(parts[1])
+            if parts[1] != name or not path.endswith("/"):
+                return 301, None, {"Location": f"/simple/{name}/"}
+            fmt = simple_format(headers.get("accept"))
+            if fmt is None:
+                return 406, None, {}
+            page = self.page("simple-" + fmt, name)
+        elif len(parts) == 3 and parts[0] == "pypi" and parts[2] == "json":
+            name = normalize(parts[1])
+            page = self.page("json", name)
+        else:
+            return 404, None, {}
+        if page is None:
+            return 404, None, {}
+        return 200, page, {"Vary": "Accept, Accept-Encoding"}
+
+    def respond(self, method, path, headers):
+        status, page, extra = self.route(path, headers)
+        body = b""
+        if page is not None:
+            extra["X-PyPI-Last-Serial"] = str(page.serial)
+            if page.etag:
+                extra["ETag"] = page.etag
+            if etag_matches(headers.get("if-none-match"), page.etag):
+                status = 304
+            else:
+                extra["Content-Type"] = page.content_type
+                body = page.body
+                if "gzip" in headers.get("accept-encoding", ""):
+                    body = page.gzip_body()
+                    extra["Content-Encoding"] = "gzip"
+        extra["Content-Length"] = str(len(body))
+        if method == "HEAD":
+            body = b""
+        lines = [f"HTTP/1.1 {status} {STATUS[status]}"]
+        lines += [f"{k}: {v}" for k, v in extra.items()]
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        return head, body
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                try:
+                    method, path, version = request.decode("latin-1").split()
+                except ValueError:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = line.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                if method not in ("GET", "HEAD"):
+                    writer.write(b"HTTP/1.1 405 Method Not Allowed\r\nAllow: GET, HEAD\r\nContent-Length: 0\r\n\r\n")
+                else:
+                    head, body = self.respond(method, path, headers)
+                    writer.write(head)
+                    if body:
+                        writer.write(body)
+                await writer.drain()
+                keep_alive = version == "HTTP/1.1"
+                connection = headers.get("connection", "").lower()
+                if connection == "close" or (connection != "keep-alive" and not keep_alive):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(args):
+    server = Server(args.database, cache_size=args.cache_size, ttl=args.ttl)
+    srv = await asyncio.start_server(server.handle, args.host, args.port, backlog=1024)
+    print(f"Serving {args.database} on http://{args.host}:{args.port}/")
+    async with srv:
+        await srv.serve_forever()
+
+def main(args):
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,145 @@
+import zlib
+from contextlib import AsyncExitStack, asynccontextmanager
+from pathlib import Path
+
+from rich.progress import Progress
+
+from .db import SHARDED_TABLES, add_info_columns, connect, connect_async, info_columns, shard_paths, shard_schemas, stored_columns
+from .history import load_settings
+from .query import normalize
+
+# Sharding the raw database.
+#
+# The pages (json_data and simple_data, along with pkg's dirty queue,
+# which is maintained by triggers on json_data) can be split across
+# several shard files, by a hash of the normalised project name. The
+# changelog and package list stay in the main file, whose shards table
+# lists the shard files.
+#
+# Each shard has its own writer connection, so "raw" can write pages for
+# different projects concurrently, and each file is small enough to
+# VACUUM or copy separately. Readers see a single set of tables, through
+# the views set up by db.connect().
+
+# SQLite allows at most 10 attached databases, and query.PyPIData attaches
+# the package and metadata databases as well as the shards.
+MAX_SHARDS = 8
+
+def shard_of(name, count):
+    # A stable hash, unlike hash()
+    return zlib.crc32(normalize(name).encode("utf-8")) % count
+
+def shard_file(database, index, count):
+    p = Path(database)
+    return p.with_name(f"{p.stem}.{index:02}-of-{count:02}{p.suffix}")
+
+class Writers:
+    # The connection to write each project's pages through: the shard's
+    # connection, or the main one if the database isn't sharded. history
+    # is the database's history settings, if it keeps superseded pages.
+    def __init__(self, db, shards, history=None):
+        self.db = db
+        self.shards = shards
+        self.history = history
+
+    def for_name(self, name):
+        if not self.shards:
+            return self.db
+        return self.shards[shard_of(name, len(self.shards))]
+
+    async def commit(self):
+        for conn in self.shards:
+            await conn.commit()
+        await self.db.commit()
+
+@asynccontextmanager
+async def writers(db, database, profile="bulk", timeout=60):
+    async with AsyncExitStack() as stack:
+        shards = [
+            await stack.enter_async_context(connect_async(path, "raw_shard", profile, timeout))
+            for path in shard_paths(database)
+        ]
+        yield Writers(db, shards, await load_settings(db))
+
+def copy_table(src, targets, table, batch_size, progress, task):
+    columns = stored_columns(src, shard_schemas(src)[0], table)
+    cols = ", ".join(columns)
+    insert = f"INSERT INTO main.{table} ({cols}) VALUES ({', '.join('?' * len(columns))})"
+    cursor = src.execute(f"SELECT {cols} FROM {table}")
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        by_shard = [[] for _ in targets]
+        for row in rows:
+            by_shard[shard_of(row[0], len(targets))].append(row)
+        for conn, shard_rows in zip(targets, by_shard):
+            conn.executemany(insert, shard_rows)
+        progress.update(task, advance=len(rows))
+
+def reshard(database, count, batch_size=10_000):
+    old_paths = shard_paths(database)
+    if count > 1:
+        new_paths = [shard_file(database, i, count) for i in range(count)]
+    else:
+        new_paths = []
+    if [p.resolve() for p in old_paths] == [p.resolve() for p in new_paths]:
+        print(f"{database} already has {max(count, 1)} shard(s)")
+        return
+
+    # The source connection reads through the views of the old shards (or
+    # the main tables). The targets are the new shard files, or the main
+    # file if the pages are going back into it.
+    src = connect(database, "raw", "bulk")
+    if new_paths:
+        targets = [connect(path, "raw_shard", "bulk") for path in new_paths]
+    else:
+        targets = [connect(database, "raw", "bulk", shards=False)]
+
+    columns = info_columns(src)
+    try:
+        for conn in targets:
+            add_info_columns(conn, "main", columns, index=False)
+        with Progress() as progress:
+            for table in SHARDED_TABLES:
+                total, = src.execute(f"SELECT count(*) FROM {table}").fetchone()
+                task = progress.add_task(f"Copying {table}", total=total)
+                # Left over from an interrupted run, or (for pkg_dirty)
+                # added by the triggers on json_data as it was copied
+                for conn in targets:
+                    conn.execute(f"DELETE FROM main.{table}")
+                copy_table(src, targets, table, batch_size, progress, task)
+        for conn in targets:
+            add_info_columns(conn, "main", columns)
+            conn.commit()
+
+        # The switch to the new layout is a single transaction in the main
+        # file. Until then, readers keep using the old one.
+        with src:
+            src.execute("DELETE FROM main.shards")
+            src.executemany(
+                "INSERT INTO main.shards (shard, path) VALUES (?, ?)",
+                [(i, path.name) for i, path in enumerate(new_paths)]
+            )
+            if not old_paths:
+                for table in SHARDED_TABLES:
+                    src.execute(f"DELETE FROM main.{table}")
+    finally:
+        src.close()
+        for conn in targets:
+            conn.close()
+
+    for path in old_paths:
+        for suffix in ("", "-wal", "-shm"):
+            Path(str(path) + suffix).unlink(missing_ok=True)
+    if new_paths:
+        print(f"Split the pages of {database} across {count} shards")
+    else:
+        print(f"Merged the pages of {database} back into the one file")
+    if not old_paths:
+        print(f"Run VACUUM on {database} to reclaim the space")
+
+def main(args):
+    if not 1 <= args.shards <= MAX_SHARDS:
+        raise SystemExit(f"The number of shards must be between 1 and {MAX_SHARDS}")
+    reshard(args.database, args.shards, args.batch_size)
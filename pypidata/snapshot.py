@@ -0,0 +1,169 @@
+import gzip
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from .db import SHARDED_TABLES, connect, shard_schemas, stored_columns, table_exists
+from .shard import shard_of
+
+# Replication deltas.
+#
+# "snapshot --since SERIAL" writes the rows of the raw database changed
+# after SERIAL, and the wheel metadata added since the snapshot that
+# covered SERIAL, to a small SQLite database, compressed with gzip.
+# "apply" replays a delta on a replica in a single transaction and
+# records the serial it reached in the replica's replication table. That
+# serial is the --since for the replica's next delta.
+#
+# Metadata rows have no serial, so the metadata database records the
+# highest rowid included in each snapshot, in its snapshots table.
+#
+# Replicas get their package database by running pkg, which picks up the
+# pages changed by apply from the pkg_dirty queue.
+
+RAW_TABLES = {
+    "packages": "last_serial > :since",
+    "changelog": "serial > :since",
+    "json_data": "serial > :since",
+    "simple_data": "serial > :since",
+}
+
+def columns(db, schema, table):
+    return ", ".join(row[1] for row in db.execute(f"PRAGMA {schema}.table_info({table})"))
+
+def compress(src, dest):
+    with open(src, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+
+def decompress(src, dest):
+    with gzip.open(src, "rb") as f_in, open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+
+def snapshot(raw, meta, since, output=None):
+    attach = {"meta": (meta, "meta")} if meta and Path(meta).exists() else {}
+    fd, tmp = tempfile.mkstemp(suffix=".db", dir=Path(output).parent if output else ".")
+    os.close(fd)
+    db = connect(raw, "raw", "read", attach=attach)
+    try:
+        db.execute("ATTACH DATABASE ? AS delta", (tmp,))
+        # A single read transaction, so the tables are consistent
+        db.execute("BEGIN")
+        for table, where in RAW_TABLES.items():
+            # Not the generated columns, which apply can't insert into
+            schema = shard_schemas(db)[0] if table in SHARDED_TABLES else "main"
+            cols = ", ".join(stored_columns(db, schema, table))
+            db.execute(f"CREATE TABLE delta.{table} AS SELECT {cols} FROM {table} WHERE {where}", dict(since=since))
+        serial, = db.execute("""\
+            SELECT max(s) FROM (
+                SELECT max(last_serial) s FROM delta.packages UNION ALL
+                SELECT max(serial) FROM delta.changelog UNION ALL
+                SELECT max(serial) FROM delta.json_data UNION ALL
+                SELECT max(serial) FROM delta.simple_data
+            )
+        """).fetchone()
+        serial = max(serial or since, since)
+
+        if attach:
+            row = db.execute(
+                "SELECT meta_rowid FROM meta.snapshots WHERE serial <= ? ORDER BY serial DESC LIMIT 1",
+                (since,)
+            ).fetchone()
+            base = row[0] if row else 0
+            db.execute(
+                "CREATE TABLE delta.project_metadata AS SELECT * FROM meta.project_metadata WHERE rowid > ?",
+                (base,)
+            )
+            meta_rowid, = db.execute("SELECT coalesce(max(rowid), 0) FROM meta.project_metadata").fetchone()
+            db.execute("""\
+                INSERT INTO meta.snapshots (serial, meta_rowid, created)
+                VALUES (?, ?, datetime('now'))
+                ON CONFLICT (serial) DO UPDATE SET
+                    meta_rowid = max(meta_rowid, excluded.meta_rowid),
+                    created = excluded.created
+                """,
+                (serial, meta_rowid)
+            )
+
+        db.execute("CREATE TABLE delta.snapshot (since INT, serial INT, created TEXT)")
+        db.execute("INSERT INTO delta.snapshot VALUES (?, ?, datetime('now'))", (since, serial))
+        counts = {
+            table: db.execute(f"SELECT count(*) FROM delta.{table}").fetchone()[0]
+            for table in list(RAW_TABLES) + (["project_metadata"] if attach else [])
+        }
+        db.commit()
+        db.execute("DETACH DATABASE delta")
+    finally:
+        db.close()
+
+    output = Path(output or f"pypidata-{since}-{serial}.db.gz")
+    try:
+        compress(tmp, output)
+    finally:
+        os.unlink(tmp)
+    for table, count in counts.items():
+        print(f"{table}: {count} rows")
+    print(f"Wrote changes {since}..{serial} to {output} ({output.stat().st_size / 2**20:.1f} MiB)")
+
+def apply(raw, meta, delta, force=False):
+    fd, tmp = tempfile.mkstemp(suffix=".db", dir=Path(raw).parent)
+    os.close(fd)
+    try:
+        decompress(delta, tmp)
+        db = connect(raw, "raw", "bulk", attach={"meta": (meta, "meta")} if meta else None)
+        try:
+            apply_delta(db, tmp, force)
+        finally:
+            db.close()
+    finally:
+        os.unlink(tmp)
+
+def apply_delta(db, path, force):
+    db.create_function("shard_of", 2, shard_of, deterministic=True)
+    db.execute("ATTACH DATABASE ? AS delta", (path,))
+    since, serial = db.execute("SELECT since, serial FROM delta.snapshot").fetchone()
+    applied, = db.execute("SELECT max(serial) FROM main.replication").fetchone()
+    if applied is not None and not force:
+        if serial <= applied:
+            print(f"Already at serial {applied}, skipping changes {since}..{serial}")
+            return
+        if since > applied:
+            raise SystemExit(f"The delta starts at serial {since}, but the replica is at {applied}")
+
+    db.execute("BEGIN")
+    try:
+        for table in ("packages", "changelog"):
+            cols = columns(db, "delta", table)
+            db.execute(f"INSERT OR REPLACE INTO main.{table} ({cols}) SELECT {cols} FROM delta.{table}")
+        # Pages go to their shard, if the replica is sharded. Replacing
+        # them fires the triggers that queue them for pkg.
+        schemas = shard_schemas(db)
+        for table in ("json_data", "simple_data"):
+            cols = columns(db, "delta", table)
+            for i, schema in enumerate(schemas):
+                db.execute(f"""\
+                    INSERT OR REPLACE INTO {schema}.{table} ({cols})
+                    SELECT {cols} FROM delta.{table}
+                    WHERE shard_of(name, ?) = ?
+                    """,
+                    (len(schemas), i)
+                )
+        if table_exists(db, "project_metadata", "delta") and table_exists(db, "project_metadata", "meta"):
+            cols = columns(db, "delta", "project_metadata")
+            db.execute(f"INSERT OR REPLACE INTO meta.project_metadata ({cols}) SELECT {cols} FROM delta.project_metadata")
+        db.execute(
+            "INSERT OR REPLACE INTO main.replication (serial, since, applied) VALUES (?, ?, datetime('now'))",
+            (serial, since)
+        )
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    print(f"Applied changes {since}..{serial}")
+
+def main(args):
+    if args.command == "apply":
+        for delta in args.delta:
+            apply(args.raw, args.meta, delta, args.force)
+    else:
+        snapshot(args.raw, args.meta, args.since, args.output)
@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS entries (
+  key TEXT PRIMARY KEY,
+  url TEXT NOT NULL,
+  status INT NOT NULL,
+  headers TEXT,
+  etag TEXT,
+  digest TEXT NOT NULL,
+  size INT NOT NULL,
+  last_used REAL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
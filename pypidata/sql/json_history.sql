@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS json_history (
+  name TEXT NOT NULL,
+  serial INT NOT NULL,
+  keyframe INT NOT NULL,
+  data BLOB,
+  superseded TEXT,
+  PRIMARY KEY (name, serial)
+);
@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS snapshots (
+  serial INT PRIMARY KEY,
+  meta_rowid INT NOT NULL,
+  created TEXT
+);
@@ -0,0 +1,15 @@
+-- Per-project totals over the files and releases of the project's JSON
+-- page, rewritten with the project by write_package
+CREATE TABLE IF NOT EXISTS project_stats (
+    project_name TEXT PRIMARY KEY,
+    file_count INTEGER NOT NULL,
+    total_size INTEGER NOT NULL,
+    release_count INTEGER NOT NULL,
+    sdist_count INTEGER NOT NULL,
+    wheel_count INTEGER NOT NULL,
+    first_upload TEXT,
+    last_upload TEXT
+);
+CREATE INDEX IF NOT EXISTS project_stats_i1 ON project_stats (total_size);
+CREATE INDEX IF NOT EXISTS project_stats_i2 ON project_stats (file_count);
+CREATE INDEX IF NOT EXISTS project_stats_i3 ON project_stats (release_count);
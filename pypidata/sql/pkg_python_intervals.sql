@@ -0,0 +1,22 @@
+-- Each distinct Requires-Python specifier, as written, and the ranges of
+-- Python versions it allows (see requires_python.py). Bounds are version
+-- sort keys (see versions.py), NULL when unbounded. Invalid specifiers
+-- have no intervals.
+CREATE TABLE IF NOT EXISTS python_specifiers (
+    specifier_id INTEGER PRIMARY KEY,
+    specifier TEXT NOT NULL,
+    valid INTEGER NOT NULL,
+    CONSTRAINT python_specifiers_uk UNIQUE (specifier)
+);
+
+CREATE TABLE IF NOT EXISTS python_intervals (
+    specifier_id INTEGER NOT NULL REFERENCES python_specifiers(specifier_id),
+    lower BLOB,
+    lower_version TEXT,
+    lower_inclusive INTEGER,
+    upper BLOB,
+    upper_version TEXT,
+    upper_inclusive INTEGER
+);
+CREATE INDEX IF NOT EXISTS python_intervals_i1 ON python_intervals (lower, upper);
+CREATE INDEX IF NOT EXISTS python_intervals_i2 ON python_intervals (specifier_id);
@@ -1,5 +1,6 @@
 CREATE TABLE IF NOT EXISTS projects (
-    name TEXT PRIMARY KEY,
+    project_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
     display_name TEXT,
     timestamp INTEGER,
     last_serial INTEGER,
@@ -60,4 +61,84 @@ CREATE TABLE IF NOT EXISTS file_digests (
     digest_type TEXT,
     digest TEXT,
     CONSTRAINT file_digests_pk PRIMARY KEY (file_id, digest_type)
-);
\ No newline at end of file
+);
+CREATE TABLE IF NOT EXISTS terms (
+    term_id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    term TEXT NOT NULL,
+    CONSTRAINT terms_uk UNIQUE (kind, term)
+);
+
+-- Posting lists: for each term, the sorted ids of the projects using it
+CREATE TABLE IF NOT EXISTS project_terms (
+    term_id INTEGER NOT NULL REFERENCES terms(term_id),
+    project_id INTEGER NOT NULL,
+    CONSTRAINT project_terms_pk PRIMARY KEY (term_id, project_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS project_terms_i1 ON project_terms (project_id);
+
+-- Full text index over the projects table. The text itself is not stored
+-- in the index (content='projects'), triggers keep the two in step.
+CREATE VIRTUAL TABLE IF NOT EXISTS projects_fts USING fts5 (
+    summary,
+    description,
+    keywords,
+    content='projects',
+    content_rowid='project_id',
+    tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS projects_fts_insert AFTER INSERT ON projects
+BEGIN
+    INSERT INTO projects_fts (rowid, summary, description, keywords)
+    VALUES (NEW.project_id, NEW.summary, NEW.description, NEW.keywords);
+END;
+CREATE TRIGGER IF NOT EXISTS projects_fts_delete AFTER DELETE ON projects
+BEGIN
+    INSERT INTO projects_fts (projects_fts, rowid, summary, description, keywords)
+    VALUES ('delete', OLD.project_id, OLD.summary, OLD.description, OLD.keywords);
+END;
+CREATE TRIGGER IF NOT EXISTS projects_fts_update AFTER UPDATE OF summary, description, keywords ON projects
+WHEN NEW.summary IS NOT OLD.summary
+    OR NEW.description IS NOT OLD.description
+    OR NEW.keywords IS NOT OLD.keywords
+BEGIN
+    INSERT INTO projects_fts (projects_fts, rowid, summary, description, keywords)
+    VALUES ('delete', OLD.project_id, OLD.summary, OLD.description, OLD.keywords);
+    INSERT INTO projects_fts (rowid, summary, description, keywords)
+    VALUES (NEW.project_id, NEW.summary, NEW.description, NEW.keywords);
+END;
+
+-- sort_key is a BLOB which sorts in PEP 440 order (see versions.py),
+-- and is NULL for versions that aren't valid PEP 440 versions
+CREATE TABLE IF NOT EXISTS releases (
+    project_name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    sort_key BLOB,
+    is_prerelease INTEGER,
+    is_postrelease INTEGER,
+    is_devrelease INTEGER,
+    yanked INTEGER,
+    file_count INTEGER,
+    upload_time TEXT,
+    CONSTRAINT releases_pk PRIMARY KEY (project_name, version)
+);
+CREATE INDEX IF NOT EXISTS releases_i1 ON releases (project_name, sort_key);
+
+CREATE TABLE IF NOT EXISTS latest_releases (
+    project_name TEXT PRIMARY KEY,
+    latest_version TEXT,
+    latest_stable_version TEXT
+);
+
+-- requires_dist, parsed (see graph.py). extras are those requested of the
+-- requirement, extra is the extra of project_name that needs it.
+CREATE TABLE IF NOT EXISTS requirements (
+    project_name TEXT NOT NULL,
+    requirement_name TEXT NOT NULL,
+    specifier TEXT,
+    extras TEXT,
+    extra TEXT,
+    marker TEXT
+);
+CREATE INDEX IF NOT EXISTS requirements_i1 ON requirements (project_name);
+CREATE INDEX IF NOT EXISTS requirements_i2 ON requirements (requirement_name);
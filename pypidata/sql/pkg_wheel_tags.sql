@@ -0,0 +1,19 @@
+-- The tags of each wheel, parsed from its filename (see wheel_tags.py).
+-- Compressed tag sets are expanded, so a cp312-abi3-manylinux_2_17_x86_64
+-- .manylinux2014_x86_64 wheel has a row for each platform.
+CREATE TABLE IF NOT EXISTS wheel_tags (
+    tag_id INTEGER PRIMARY KEY,
+    interpreter TEXT NOT NULL,
+    abi TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    CONSTRAINT wheel_tags_uk UNIQUE (interpreter, abi, platform)
+);
+CREATE INDEX IF NOT EXISTS wheel_tags_i1 ON wheel_tags (platform);
+CREATE INDEX IF NOT EXISTS wheel_tags_i2 ON wheel_tags (abi);
+
+CREATE TABLE IF NOT EXISTS file_tags (
+    tag_id INTEGER NOT NULL REFERENCES wheel_tags(tag_id),
+    file_id INTEGER NOT NULL REFERENCES project_files(file_id),
+    CONSTRAINT file_tags_pk PRIMARY KEY (tag_id, file_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS file_tags_i1 ON file_tags (file_id);
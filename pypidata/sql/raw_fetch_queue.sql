@@ -0,0 +1,11 @@
+CREATE TABLE IF NOT EXISTS fetch_queue (
+  page_type TEXT NOT NULL,
+  name TEXT NOT NULL,
+  serial INT NOT NULL,
+  etag TEXT,
+  worker TEXT,
+  lease_expires REAL,
+  attempts INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (page_type, name)
+);
+CREATE INDEX IF NOT EXISTS fetch_queue_lease ON fetch_queue (lease_expires);
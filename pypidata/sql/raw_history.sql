@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS history_settings (
+  keyframe_interval INT NOT NULL,
+  keep INT,
+  keep_days INT
+);
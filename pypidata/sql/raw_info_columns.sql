@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS info_columns (
+  name TEXT PRIMARY KEY,
+  path TEXT NOT NULL
+);
+INSERT OR IGNORE INTO info_columns (name, path) VALUES
+  ('info_version', '$.version'),
+  ('info_requires_python', '$.requires_python'),
+  ('info_license', '$.license'),
+  ('info_summary', '$.summary');
@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS replication (
+  serial INT PRIMARY KEY,
+  since INT NOT NULL,
+  applied TEXT
+);
@@ -22,10 +22,28 @@ CREATE TABLE IF NOT EXISTS changelog (
   timestamp INT,
   action TEXT
 );
-CREATE INDEX changelog_i1 ON changelog (name);
+CREATE INDEX IF NOT EXISTS changelog_i1 ON changelog (name);
 CREATE TABLE IF NOT EXISTS packages (
   name TEXT PRIMARY KEY,
   display_name TEXT,
   last_serial INT NOT NULL
 );
-CREATE INDEX packages_i1 on packages(last_serial);
+CREATE INDEX IF NOT EXISTS packages_i1 ON packages(last_serial);
+
+CREATE TABLE IF NOT EXISTS pkg_dirty (
+  name TEXT PRIMARY KEY,
+  serial INT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS json_data_dirty_insert AFTER INSERT ON json_data
+BEGIN
+  INSERT INTO pkg_dirty (name, serial) VALUES (NEW.name, NEW.serial)
+  ON CONFLICT(name) DO UPDATE SET serial = excluded.serial;
+END;
+CREATE TRIGGER IF NOT EXISTS json_data_dirty_update AFTER UPDATE ON json_data
+WHEN NEW.serial IS NOT OLD.serial
+  OR NEW.info IS NOT OLD.info
+  OR NEW.releases IS NOT OLD.releases
+BEGIN
+  INSERT INTO pkg_dirty (name, serial) VALUES (NEW.name, NEW.serial)
+  ON CONFLICT(name) DO UPDATE SET serial = excluded.serial;
+END;
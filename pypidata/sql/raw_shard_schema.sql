@@ -0,0 +1,33 @@
+CREATE TABLE IF NOT EXISTS json_data (
+    name TEXT PRIMARY KEY,
+    serial INT NOT NULL,
+    url TEXT,
+    etag TEXT,
+    info TEXT,
+    releases TEXT,
+    vulnerabilities TEXT
+);
+CREATE TABLE IF NOT EXISTS simple_data (
+    name TEXT PRIMARY KEY,
+    serial INT NOT NULL,
+    url TEXT,
+    etag TEXT,
+    files TEXT
+);
+CREATE TABLE IF NOT EXISTS pkg_dirty (
+  name TEXT PRIMARY KEY,
+  serial INT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS json_data_dirty_insert AFTER INSERT ON json_data
+BEGIN
+  INSERT INTO pkg_dirty (name, serial) VALUES (NEW.name, NEW.serial)
+  ON CONFLICT(name) DO UPDATE SET serial = excluded.serial;
+END;
+CREATE TRIGGER IF NOT EXISTS json_data_dirty_update AFTER UPDATE ON json_data
+WHEN NEW.serial IS NOT OLD.serial
+  OR NEW.info IS NOT OLD.info
+  OR NEW.releases IS NOT OLD.releases
+BEGIN
+  INSERT INTO pkg_dirty (name, serial) VALUES (NEW.name, NEW.serial)
+  ON CONFLICT(name) DO UPDATE SET serial = excluded.serial;
+END;
@@ -0,0 +1,4 @@
+CREATE TABLE IF NOT EXISTS shards (
+  shard INT PRIMARY KEY,
+  path TEXT NOT NULL
+);
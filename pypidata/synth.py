@@ -0,0 +1,292 @@
+import hashlib
+import json
+import random
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from rich.progress import Progress
+
+from .db import connect
+
+# A synthetic PyPI, for benchmarking.
+#
+# Writes raw and metadata databases with the real schemas, filled with
+# seeded random projects: the package list, changelog, JSON and simple
+# pages, and the wheel metadata. The shapes follow PyPI's: most projects
+# have a handful of releases, but releases per project are drawn from a
+# Pareto distribution, so a long tail of projects has thousands. Sizes of
+# descriptions and METADATA files are lognormal. The same seed and options
+# always produce the same databases.
+
+WORDS = (
+    "data", "web", "py", "http", "async", "tools", "utils", "client", "api",
+    "django", "flask", "test", "json", "cloud", "aws", "sdk", "cli", "core",
+    "lib", "auth", "db", "sql", "config", "log", "parser", "plugin", "ml",
+    "torch", "image", "text", "net", "server", "graph", "time", "task",
+    "queue", "cache", "crypto", "file", "stream", "schema", "model", "ui",
+)
+
+CLASSIFIERS = (
+    "Development Status :: 4 - Beta",
+    "Development Status :: 5 - Production/Stable",
+    "Intended Audience :: Developers",
+    "License :: OSI Approved :: MIT License",
+    "License :: OSI Approved :: Apache Software License",
+    "Operating System :: OS Independent",
+    "Programming Language :: Python :: 3",
+    "Programming Language :: Python :: 3.12",
+    "Programming Language :: Python :: 3.13",
+    "Topic :: Software Development :: Libraries",
+    "Framework :: Django",
+    "Typing :: Typed",
+)
+
+LICENSES = ("MIT", "Apache-2.0", "BSD-3-Clause", "GPL-3.0-or-later", None)
+
+REQUIRES_PYTHON = (">=3.8", ">=3.9", ">=3.10", ">=3.11", ">=3.7, <4", "~=3.9", None)
+
+# Wheel tags, pure Python ones first. Projects with binary wheels ship
+# one per platform.
+PURE_TAGS = ("py3-none-any", "py2.py3-none-any")
+BINARY_TAGS = (
+    "{cp}-{cp}-manylinux_2_17_x86_64.manylinux2014_x86_64",
+    "{cp}-{cp}-manylinux_2_28_aarch64",
+    "{cp}-{cp}-musllinux_1_2_x86_64",
+    "{cp}-{cp}-macosx_11_0_arm64",
+    "{cp}-{cp}-win_amd64",
+)
+CPYTHONS = ("cp39", "cp310", "cp311", "cp312", "cp313")
+
+START = datetime(2005, 1, 1, tzinfo=timezone.utc)
+END = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+PACKAGES_SQL = "INSERT INTO packages (name, display_name, last_serial) VALUES (?, ?, ?)"
+CHANGELOG_SQL = """\
+INSERT INTO changelog (name, display_name, version, timestamp, action, serial)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+JSON_SQL = """\
+INSERT INTO json_data (name, serial, url, etag, info, releases, vulnerabilities)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+SIMPLE_SQL = "INSERT INTO simple_data (name, serial, url, etag, files) VALUES (?, ?, ?, ?, ?)"
+METADATA_SQL = "INSERT INTO project_metadata (filename, content, metadata) VALUES (?, ?, ?)"
+
+class Generator:
+    def __init__(self, args):
+        self.rng = random.Random(args.seed)
+        self.args = args
+        self.serial = 0
+        self.names = []
+
+    def text(self, size):
+        words = []
+        length = 0
+        while length < size:
+            word = self.rng.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words)
+
+    def lognormal(self, median):
+        # sigma 1.5 gives the long tail of READMEs that embed whole manuals
+        return int(self.rng.lognormvariate(0, 1.5) * median)
+
+    def release_count(self):
+        n = int(self.rng.paretovariate(self.args.release_alpha))
+        return max(1, min(n, self.args.max_releases))
+
+    def versions(self, count):
+        major, minor, patch = 0, 1, 0
+        versions = []
+        for _ in range(count):
+            r = self.rng.random()
+            if r < 0.05:
+                major, minor, patch = major + 1, 0, 0
+            elif r < 0.3:
+                minor, patch = minor + 1, 0
+            else:
+                patch += 1
+            v = f"{major}.{minor}.{patch}"
+            if self.rng.random() < 0.1:
+                v += f"rc{self.rng.randint(1, 3)}"
+            versions.append(v)
+        return versions
+
+    def tags(self, binary):
+        if not binary:
+            return [self.rng.choice(PURE_TAGS)]
+        cps = CPYTHONS[self.rng.randrange(len(CPYTHONS)):]
+        platforms = self.rng.sample(BINARY_TAGS, self.rng.randint(1, len(BINARY_TAGS)))
+        return [p.format(cp=cp) for cp in cps for p in platforms]
+
+    def requirements(self):
+        # Preferential attachment: projects created earlier are more likely
+        # to be depended on
+        if not self.names:
+            return None
+        count = min(int(self.rng.expovariate(1 / 3)), len(self.names))
+        reqs = set()
+        for _ in range(count):
+            i = int(len(self.names) * self.rng.random() ** 3)
+            reqs.add(self.names[i])
+        return [f"{r}>=1.0" for r in sorted(reqs)] or None
+
+    def project(self, index):
+        rng = self.rng
+        display_name = f"{rng.choice(WORDS)}-{rng.choice(WORDS)}{index}"
+        if rng.random() < 0.2:
+            display_name = display_name.title()
+        name = display_name.lower()
+        binary = rng.random() < self.args.binary_fraction
+        versions = self.versions(self.release_count())
+        created = START + (END - START) * rng.random()
+        span = (END - created).total_seconds()
+        requires_python = rng.choice(REQUIRES_PYTHON)
+
+        events = [(created, None, "create")]
+        releases = {}
+        simple_files = []
+        wheels = []
+        times = sorted(created + timedelta(seconds=span * rng.random()) for _ in versions)
+        for version, when in zip(versions, times):
+            events.append((when, version, "new release"))
+            upload_time = when.strftime("%Y-%m-%dT%H:%M:%S")
+            stem = f"{name.replace('-', '_')}-{version}"
+            files = [(f"{stem}.tar.gz", "sdist", "source")]
+            if rng.random() < 0.9:
+                for tag in self.tags(binary):
+                    files.append((f"{stem}-{tag}.whl", "bdist_wheel", tag.split("-")[0]))
+            release = []
+            for filename, packagetype, python_version in files:
+                size = max(1000, self.lognormal(self.args.file_size))
+                sha256 = hashlib.sha256(filename.encode("utf-8")).hexdigest()
+                md5 = hashlib.md5(filename.encode("utf-8")).hexdigest()
+                url = f"https://files.pythonhosted.org/packages/{sha256[:2]}/{sha256[2:4]}/{sha256[4:]}/{filename}"
+                yanked = rng.random() < 0.01
+                release.append(dict(
+                    comment_text="",
+                    digests=dict(md5=md5, sha256=sha256),
+                    filename=filename,
+                    has_sig=False,
+                    md5_digest=md5,
+                    packagetype=packagetype,
+                    python_version=python_version,
+                    requires_python=requires_python,
+                    size=size,
+                    upload_time=upload_time,
+                    upload_time_iso_8601=upload_time + ".000000Z",
+                    url=url,
+                    yanked=yanked,
+                    yanked_reason=None,
+                ))
+                simple_files.append({
+                    "filename": filename,
+                    "url": url,
+                    "hashes": {"sha256": sha256},
+                    "requires-python": requires_python,
+                    "size": size,
+                    "upload-time": upload_time + ".000000Z",
+                    "yanked": yanked,
+                })
+                events.append((when, version, f"add {python_version} file {filename}"))
+                if packagetype == "bdist_wheel":
+                    wheels.append((filename, version))
+            releases[version] = release
+
+        requires_dist = self.requirements()
+        info = dict(
+            author=f"{rng.choice(WORDS).title()} Developers",
+            author_email=f"{name}@example.com",
+            bugtrack_url=None,
+            classifiers=sorted(rng.sample(CLASSIFIERS, rng.randint(0, 6))),
+            description=self.text(self.lognormal(self.args.description_size)),
+            description_content_type=rng.choice(("text/markdown", "text/x-rst", None)),
+            docs_url=None,
+            download_url="",
+            home_page=f"https://example.com/{name}",
+            keywords=", ".join(rng.sample(WORDS, rng.randint(0, 5))),
+            license=rng.choice(LICENSES),
+            maintainer=None,
+            maintainer_email=None,
+            name=display_name,
+            package_url=f"https://pypi.org/project/{name}/",
+            platform=None,
+            project_url=f"https://pypi.org/project/{name}/",
+            project_urls={"Homepage": f"https://example.com/{name}"},
+            release_url=f"https://pypi.org/project/{name}/{versions[-1]}/",
+            requires_dist=requires_dist,
+            requires_python=requires_python,
+            summary=f"A {self.text(40)} library",
+            version=versions[-1],
+            yanked=False,
+            yanked_reason=None,
+        )
+
+        changelog = []
+        for when, version, action in events:
+            self.serial += 1
+            changelog.append((name, display_name, version, int(when.timestamp()), action, self.serial))
+        self.names.append(name)
+        return name, display_name, info, releases, simple_files, wheels, changelog
+
+    def metadata(self, name, version, info, filename):
+        headers = [
+            "Metadata-Version: 2.1",
+            f"Name: {info['name']}",
+            f"Version: {version}",
+            f"Summary: {info['summary']}",
+        ]
+        if info["requires_python"]:
+            headers.append(f"Requires-Python: {info['requires_python']}")
+        headers += [f"Requires-Dist: {r}" for r in info["requires_dist"] or []]
+        body = self.text(self.lognormal(self.args.metadata_size))
+        dist_info = f"{name.replace('-', '_')}-{version}.dist-info"
+        content = [
+            {"name": f"{name.replace('-', '_')}/__init__.py", "size": self.rng.randint(0, 50_000), "timestamp": [2020, 1, 1, 0, 0, 0]},
+            {"name": f"{dist_info}/METADATA", "size": len(body), "timestamp": [2020, 1, 1, 0, 0, 0]},
+            {"name": f"{dist_info}/RECORD", "size": 500, "timestamp": [2020, 1, 1, 0, 0, 0]},
+        ]
+        text = "\n".join(headers) + "\n\n" + body
+        return filename, json.dumps(content), zlib.compress(text.encode("utf-8"))
+
+def generate(args):
+    gen = Generator(args)
+    raw = connect(args.database, "raw", "bulk")
+    meta = connect(args.meta, "meta", "bulk")
+    try:
+        existing, = raw.execute("SELECT count(*) FROM packages").fetchone()
+        if existing:
+            raise SystemExit(f"{args.database} already has {existing} projects")
+        files = 0
+        with Progress() as progress:
+            task = progress.add_task("Generating projects", total=args.projects)
+            for start in range(0, args.projects, args.batch_size):
+                with raw, meta:
+                    for index in range(start, min(start + args.batch_size, args.projects)):
+                        name, display_name, info, releases, simple_files, wheels, changelog = gen.project(index)
+                        serial = changelog[-1][-1]
+                        raw.executemany(CHANGELOG_SQL, changelog)
+                        raw.execute(PACKAGES_SQL, (name, display_name, serial))
+                        raw.execute(JSON_SQL, (
+                            name, serial, f"https://pypi.org/pypi/{name}/json", f'"{serial}"',
+                            json.dumps(info), json.dumps(releases), "[]",
+                        ))
+                        raw.execute(SIMPLE_SQL, (
+                            name, serial, f"https://pypi.org/simple/{name}/", f'"{serial}"',
+                            json.dumps(simple_files),
+                        ))
+                        meta.executemany(METADATA_SQL, [
+                            gen.metadata(name, version, info, filename)
+                            for filename, version in wheels
+                            if gen.rng.random() < args.metadata_fraction
+                        ])
+                        files += len(simple_files)
+                        progress.update(task, advance=1)
+    finally:
+        raw.close()
+        meta.close()
+    print(f"Wrote {args.projects} projects, {files} files and {gen.serial} changelog entries")
+
+def main(args):
+    generate(args)
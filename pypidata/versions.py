@@ -0,0 +1,74 @@
+from functools import lru_cache
+
+from packaging.version import InvalidVersion, Version
+
+# Encode PEP 440 versions as byte strings which sort (as SQLite BLOBs,
+# compared with memcmp) in the same order as packaging.version.Version.
+# The encoding follows Version's own comparison key: epoch, release (with
+# trailing zeros removed), pre, post, dev and local segments, with the
+# "infinity" sentinels mapped to bytes below or above any real value.
+
+def enc_int(n):
+    # A length prefix keeps larger numbers sorting after smaller ones
+    data = n.to_bytes(max(1, (n.bit_length() + 7) // 8), "big")
+    return bytes([len(data)]) + data
+
+PRE = {"a": 1, "b": 2, "rc": 3}
+
+@lru_cache(maxsize=100_000)
+def parse(version):
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return None
+
+def encode(v):
+    key = bytearray(enc_int(v.epoch))
+
+    release = list(v.release)
+    while release and release[-1] == 0:
+        release.pop()
+    for n in release:
+        key += b"\x01" + enc_int(n)
+    key += b"\x00"
+
+    # A dev release with no pre or post part sorts before any pre-release
+    if v.pre is None and v.post is None and v.dev is not None:
+        key += b"\x00"
+    elif v.pre is None:
+        key += b"\x04"
+    else:
+        key += bytes([PRE[v.pre[0]]]) + enc_int(v.pre[1])
+
+    if v.post is None:
+        key += b"\x00"
+    else:
+        key += b"\x01" + enc_int(v.post)
+
+    if v.dev is None:
+        key += b"\x02"
+    else:
+        key += b"\x01" + enc_int(v.dev)
+
+    # Local segments compare numbers above strings, and a shorter local
+    # version sorts before a longer one that it prefixes.
+    if v.local is None:
+        key += b"\x00"
+    else:
+        key += b"\x01"
+        for part in v.local.split("."):
+            if part.isdigit():
+                key += b"\x02" + enc_int(int(part))
+            else:
+                key += b"\x01" + part.lower().encode("ascii") + b"\x00"
+        key += b"\x00"
+
+    return bytes(key)
+
+@lru_cache(maxsize=100_000)
+def sort_key(version):
+    # Returns None for versions that aren't valid PEP 440 versions
+    v = parse(version)
+    if v is None:
+        return None
+    return encode(v)
@@ -0,0 +1,53 @@
+from packaging.tags import parse_tag
+from packaging.utils import InvalidWheelFilename, parse_wheel_filename
+
+# Wheel tags are interned into the wheel_tags table, with the files that
+# have each tag in file_tags, so "which projects have cp313 wheels" or
+# "which ship manylinux_2_28_aarch64 wheels" is an index lookup rather
+# than a scan of every filename.
+
+INTERN_SQL = """\
+INSERT INTO wheel_tags (interpreter, abi, platform)
+VALUES (?, ?, ?)
+ON CONFLICT (interpreter, abi, platform) DO NOTHING
+"""
+
+def parse_tags(filename):
+    try:
+        _, _, _, tags = parse_wheel_filename(filename)
+    except InvalidWheelFilename:
+        # Usually a version that isn't valid PEP 440, which doesn't stop
+        # the tags (the last three fields) being read
+        parts = filename[:-len(".whl")].split("-")
+        if len(parts) < 5 or not all(parts[-3:]):
+            return []
+        tags = parse_tag("-".join(parts[-3:]))
+    return sorted((t.interpreter, t.abi, t.platform) for t in tags)
+
+def intern(db, tags):
+    db.executemany(INTERN_SQL, tags)
+    return [
+        tag_id for tag_id, in (
+            db.execute(
+                "SELECT tag_id FROM wheel_tags WHERE interpreter = ? AND abi = ? AND platform = ?", tag
+            ).fetchone()
+            for tag in tags
+        )
+    ]
+
+def write_file_tags(db, file_id, filename):
+    # A wheel's tags are fixed by its filename, so they only need adding
+    if not filename.endswith(".whl"):
+        return
+    db.executemany(
+        "INSERT OR IGNORE INTO file_tags (tag_id, file_id) VALUES (?, ?)",
+        [(tag_id, file_id) for tag_id in intern(db, parse_tags(filename))]
+    )
+
+def rebuild_wheel_tags(db):
+    db.execute("DELETE FROM file_tags")
+    rows = db.execute("SELECT file_id, filename FROM project_files WHERE filename LIKE '%.whl'").fetchall()
+    for file_id, filename in rows:
+        write_file_tags(db, file_id, filename)
+    db.execute("DELETE FROM wheel_tags WHERE tag_id NOT IN (SELECT tag_id FROM file_tags)")
+    return len(rows)
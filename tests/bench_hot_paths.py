@@ -0,0 +1,30 @@
+# Benchmarks of the hot paths, with pytest-benchmark, against a small
+# synthetic database. Not collected by a plain "pytest"; run them with
+#
+#   python -m pytest tests/bench_hot_paths.py
+#
+# and compare runs with --benchmark-autosave and --benchmark-compare.
+
+import pytest
+
+from pypidata import bench
+from pypidata.main import make_parser
+from pypidata.synth import generate
+
+@pytest.fixture(scope="module")
+def args(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("synth")
+    raw, meta = str(tmp / "PyPI_raw.db"), str(tmp / "Metadata.db")
+    parser = make_parser()
+    generate(parser.parse_args([
+        "synth", "--database", raw, "--meta", meta, "--projects", "500", "--seed", "1",
+    ]))
+    return parser.parse_args(["bench", "--raw", raw, "--meta", meta, "--sample", "50"])
+
+@pytest.fixture(scope="module")
+def sample(args):
+    return bench.sample_names(args)
+
+@pytest.mark.parametrize("case", list(bench.CASES))
+def test_case(benchmark, args, sample, case):
+    benchmark(bench.CASES[case], args, sample)
@@ -0,0 +1,27 @@
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Modules that commands import when they run, which --help must not pay for
+HEAVY = {"httpx", "aiosqlite", "rich", "packaging", "pyarrow", "asyncio"}
+
+def imported_modules(*args):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "pypidata", *args],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    # Lines are "import time: self [us] | cumulative | imported package"
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            name = line.rsplit("|", 1)[1].strip()
+            if name != "imported package":
+                modules.add(name)
+    return modules
+
+def test_help_imports_no_heavy_modules():
+    modules = imported_modules("--help")
+    assert "pypidata.main" in modules
+    assert {m.split(".")[0] for m in modules} & HEAVY == set()